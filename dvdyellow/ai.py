@@ -1,12 +1,29 @@
-import sys
-from random import randint
+import argparse
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import partial
+from random import shuffle
 
 import dvdyellow.game as g
+from dvdyellow.rules import rules_for
+from dvdyellow.search import AlphaBetaSearch, EndgameSolver, EvaluationCache, MonteCarloSearch, \
+    ParallelAlphaBetaSearch, init_search_worker
 
+_logger = logging.getLogger("Bot")
 
-def game_found(game : g.Game):
-    game.on_your_turn = my_turn
-    game.on_finish = game_finished
+# fields blocked by moves, shared by all the strategies (and games) of the process which have no own cache
+evaluation_cache = EvaluationCache()
+
+
+def game_found(game : g.Game, strategy=None):
+    strategy = strategy or GreedyStrategy()
+    game.on_your_turn = lambda game: my_turn(game, strategy)
+    game.on_finish = lambda game: game_finished(game, strategy)
+    # the first player gets no notification about its first turn
+    if game.is_active_player():
+        my_turn(game, strategy)
 
 
 def _check_move(pawn : g.TransformablePawn, point, board):
@@ -25,80 +42,510 @@ def _check_move(pawn : g.TransformablePawn, point, board):
     return True
 
 
-def _print_move(pawn : g.TransformablePawn, point, new_board, nr):
-    x, y = point
-    for ix in range(pawn.width):
-        for iy in range(pawn.height):
-            if pawn.get_pawn_point(ix, iy):
-                new_board[x + ix][y + iy] = nr
-
-
 def _calc_points(pawn : g.TransformablePawn, point, move_board, point_board):
     """
-    :param pawn: pawn used for the game
+    :param pawn: pawn used for the move
+    :param point: where the pawn is put
     :param move_board: game history board
-    :param nr: nr which should be printed on unreachable fields
-    :return:
-    """
-    #
-    # we create new board, which starts with all fields set as possible to block
-    #
-    # new_board -> 1 is blocked, 0 is not blocked
-    new_board = [[0 for j in range(len(move_board[0]))] for i in range(len(move_board))]
-    new_board2 = [[0 for j in range(len(move_board[0]))] for i in range(len(move_board))]
-    for i in range(len(move_board)):
-        for j in range(len(move_board[0])):
-            if move_board[i][j] != 0:
-                new_board[i][j] = 1
-                new_board2[i][j] = 1
-    _print_move(pawn, point, new_board, 1)
-    _print_move(pawn, point, new_board2, 1)
-    pawn = pawn.copy()
-    for k in range(4):
-        pawn.rotate_clockwise()
-        for i in range(len(move_board)):
-            for j in range(len(move_board[0])):
-                #
-                # we remove fields which can be covered by a valid move from those possibly blocked
-                #
-                if _check_move(pawn, (i, j), new_board):
-                    _print_move(pawn, (i, j), new_board2, 1)
-    sum_of_points = 0
-    for i in range(len(move_board)):
-        for j in range(len(move_board[0])):
-            #
-            # sum points
-            #
-            if new_board2[i][j] == 0:
-                sum_of_points += point_board[i][j]
-
-    return sum_of_points
-
-
-def my_turn(game):
-    result_set = set() # contains (x, y, pawn, points)
-    quantity = 0
-    w = len(game.move_board)
-    h = len(game.move_board[0])
-    while quantity < 16:     # 8 - number of samples
-        while True:
-            x = randint(0, w - 1)
-            y = randint(0, h - 1)
-            r = randint(0, 3)
-            p = game.get_transformable_pawn()
-            for i in range(r):
-                p.rotate_clockwise()
-            if _check_move(p, (x, y), game.move_board):
+    :param point_board: points of the fields
+    :return: sum of points of fields blocked by the move
+    """
+    pawn_data = [[pawn.get_pawn_point(x, y) for y in range(pawn.height)] for x in range(pawn.width)]
+    rules = rules_for(pawn_data, len(move_board), len(move_board[0]))
+    return evaluation_cache.evaluate_moves(rules, rules.board_to_mask(move_board), [rules.move_mask(pawn, point)],
+                                           rules.point_values(point_board))[0]
+
+
+class Strategy:
+    """
+    Way of choosing moves by the bot.
+    """
+    def __init__(self, cache=None):
+        """
+        :param cache: EvaluationCache used to find fields blocked by moves (None to use the one shared by the process)
+        """
+        self.cache = cache if cache is not None else evaluation_cache
+
+    def choose_move(self, game):
+        """
+        Chooses move in the game.
+        :param game: The game.
+        :return: Tuple (x, y, rotation) or None if there is no legal move.
+        """
+        raise NotImplementedError()
+
+    def move_done(self, game):
+        """
+        Called when move chosen by the strategy was done and opponent is thinking.
+        :param game: The game.
+        """
+        pass
+
+    def game_finished(self, game):
+        """
+        Called when the game is finished (to free resources related to the game).
+        :param game: The game.
+        """
+        pass
+
+    def save_search_state(self, game):
+        """
+        Returns state kept by the strategy between moves of the game which is changed by choose_move
+        (used to think about positions which may not happen in the game).
+        :param game: The game.
+        :return: Object for restore_search_state.
+        """
+        return None
+
+    def restore_search_state(self, game, state):
+        """
+        Brings back state of the game returned by save_search_state.
+        :param game: The game.
+        :param state: The saved state.
+        """
+        pass
+
+    def interrupt(self):
+        """
+        Stops searches run in other threads as soon as possible (they return the best move found so far).
+        New searches are also stopped at once until resume is called.
+        """
+        pass
+
+    def resume(self):
+        """
+        Allows searches stopped by interrupt to run normally.
+        """
+        pass
+
+    def close(self):
+        """
+        Frees resources used by the strategy.
+        """
+        pass
+
+
+class GreedyStrategy(Strategy):
+    """
+    Chooses move giving most points immediately.
+    """
+    def choose_move(self, game):
+        rules = rules_for(game.pawn.data, game.width, game.height)
+        moves = rules.legal_moves(rules.board_to_mask(game.move_board))
+        if not moves:
+            return None
+        # all legal moves are evaluated at once, ties are broken randomly
+        shuffle(moves)
+        values = self.cache.evaluate_moves(rules, rules.board_to_mask(game.move_board), [m[3] for m in moves],
+                                           rules.point_values(game.point_board))
+        best = max(range(len(moves)), key=values.__getitem__)
+        return moves[best][:3]
+
+
+class AlphaBetaStrategy(Strategy):
+    """
+    Chooses move using alpha-beta search limited by time.
+    """
+    def __init__(self, time_budget=1.0, table_size=1 << 16, workers=1, cache=None):
+        """
+        :param time_budget: time for a move (in seconds)
+        :param table_size: number of entries of transposition table (for each game and worker)
+        :param workers: number of processes searching moves in parallel
+        :param cache: evaluation cache (as in Strategy)
+        """
+        super().__init__(cache)
+        self.time_budget = time_budget
+        self.table_size = table_size
+        self.workers = workers
+        self.engines = dict()   # game id -> search engine (transposition table is kept between moves)
+        if workers > 1:
+            # processes are started before the bot connects to the server and check the event themselves,
+            # so interrupt stops them in the middle of a depth
+            self.stop_event = multiprocessing.Event()
+            self.pool = multiprocessing.Pool(workers, initializer=init_search_worker, initargs=(self.stop_event,))
+        else:
+            self.stop_event = threading.Event()
+            self.pool = None
+
+    def choose_move(self, game):
+        engine = self.engines.get(game.gid)
+        if engine is None:
+            rules = rules_for(game.pawn.data, game.width, game.height)
+            values = rules.point_values(game.point_board)
+            if self.pool is not None:
+                engine = ParallelAlphaBetaSearch(rules, values, self.pool, self.workers, self.table_size,
+                                                 self.stop_event, self.cache)
+            else:
+                engine = AlphaBetaSearch(rules, values, self.table_size, self.stop_event, self.cache)
+            self.engines[game.gid] = engine
+        move, value, depth = engine.search(engine.rules.board_to_mask(game.move_board), self.time_budget)
+        _logger.info("Game %s: depth %d, %d nodes, value %s, evaluation cache hit rate %.2f", game.gid, depth,
+                     engine.nodes, value, self.cache.hit_rate)
+        return move[:3] if move else None
+
+    def game_finished(self, game):
+        self.engines.pop(game.gid, None)
+
+    def interrupt(self):
+        self.stop_event.set()
+
+    def resume(self):
+        self.stop_event.clear()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+
+class MonteCarloStrategy(Strategy):
+    """
+    Chooses move using Monte Carlo tree search limited by time or number of iterations.
+    """
+    def __init__(self, time_budget=1.0, iterations=None, cache=None):
+        """
+        :param time_budget: time for a move (in seconds, None for no limit)
+        :param iterations: number of iterations for a move (None for no limit)
+        :param cache: evaluation cache (as in Strategy)
+        """
+        super().__init__(cache)
+        self.time_budget = time_budget
+        self.iterations = iterations
+        self.engines = dict()   # game id -> search engine (search tree is kept between moves)
+        self.stop_event = threading.Event()
+
+    def choose_move(self, game):
+        engine = self.engines.get(game.gid)
+        if engine is None:
+            rules = rules_for(game.pawn.data, game.width, game.height)
+            engine = MonteCarloSearch(rules, rules.point_values(game.point_board), stop_event=self.stop_event,
+                                      cache=self.cache)
+            self.engines[game.gid] = engine
+        difference = game.player_points[game.player_number - 1] - game.player_points[2 - game.player_number]
+        move = engine.search(engine.rules.board_to_mask(game.move_board), difference,
+                             self.time_budget, self.iterations)
+        _logger.info("Game %s: %d playouts (%.0f playouts/s, %.0f placements/s)", game.gid, engine.playouts,
+                     engine.playouts_per_second, engine.placements / engine.elapsed if engine.elapsed else 0.)
+        return move[:3] if move else None
+
+    def game_finished(self, game):
+        self.engines.pop(game.gid, None)
+
+    def save_search_state(self, game):
+        # the search tree of the game is kept from its root - nodes are never removed from the tree
+        engine = self.engines.get(game.gid)
+        return engine.root if engine is not None else None
+
+    def restore_search_state(self, game, state):
+        engine = self.engines.get(game.gid)
+        if engine is not None:
+            engine.root = state
+
+    def interrupt(self):
+        self.stop_event.set()
+
+    def resume(self):
+        self.stop_event.clear()
+
+
+class EndgameStrategy(Strategy):
+    """
+    Uses other strategy until few free fields are left, then plays perfectly using exact solver.
+    """
+    def __init__(self, strategy, threshold=None):
+        """
+        :param strategy: strategy used before the endgame
+        :param threshold: number of free fields from which the game is solved exactly
+        (default is enough fields for 7 moves - time of solving grows very fast with the number of moves)
+        """
+        super().__init__(strategy.cache)
+        self.strategy = strategy
+        self.threshold = threshold
+        self.solvers = dict()   # game id -> solver (solved positions are kept between moves)
+
+    def choose_move(self, game):
+        solver = self.solvers.get(game.gid)
+        if solver is None:
+            rules = rules_for(game.pawn.data, game.width, game.height)
+            threshold = self.threshold if self.threshold is not None else 7 * rules.pawn_size
+            if sum(column.count(0) for column in game.move_board) > threshold:
+                return self.strategy.choose_move(game)
+            solver = EndgameSolver(rules, rules.point_values(game.point_board))
+            self.solvers[game.gid] = solver
+            # state of the other strategy is not needed any more
+            self.strategy.game_finished(game)
+
+        move, value = solver.solve(solver.rules.board_to_mask(game.move_board))
+        difference = game.player_points[game.player_number - 1] - game.player_points[2 - game.player_number]
+        _logger.info("Game %s: endgame solved (%d positions), final difference %d", game.gid, len(solver.memo),
+                     difference + value)
+        return move[:3] if move else None
+
+    def game_finished(self, game):
+        self.solvers.pop(game.gid, None)
+        self.strategy.game_finished(game)
+
+    def save_search_state(self, game):
+        return self.strategy.save_search_state(game)
+
+    def restore_search_state(self, game, state):
+        self.strategy.restore_search_state(game, state)
+
+    def interrupt(self):
+        self.strategy.interrupt()
+
+    def resume(self):
+        self.strategy.resume()
+
+    def close(self):
+        self.strategy.close()
+
+
+class _PredictedGame:
+    """
+    State of the game after predicted move of the opponent (used for pondering).
+    """
+    def __init__(self, game, move_board, player_points):
+        self.gid = game.gid
+        self.pawn = game.pawn
+        self.width = game.width
+        self.height = game.height
+        self.point_board = game.point_board
+        self.player_number = game.player_number
+        self.move_board = move_board
+        self.player_points = player_points
+
+
+class PonderingStrategy(Strategy):
+    """
+    Uses other strategy, but also thinks during opponent's turn: it predicts opponent's replies
+    (the ones giving most points immediately) and chooses answers to them in a background thread.
+    If the opponent makes predicted move, the answer is ready at once.
+    """
+    def __init__(self, strategy, replies=8):
+        """
+        :param strategy: strategy choosing moves
+        :param replies: number of opponent's replies to think about
+        """
+        super().__init__(strategy.cache)
+        self.strategy = strategy
+        self.replies = replies
+        self.thread = None
+        self.stop_event = threading.Event()
+        # game id -> (occupied fields after opponent's move -> (our move, search state after choosing it))
+        self.answers = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def _stop_pondering(self):
+        if self.thread is not None:
+            self.stop_event.set()
+            self.strategy.interrupt()
+            self.thread.join()
+            self.strategy.resume()
+            self.stop_event.clear()
+            self.thread = None
+
+    def _ponder(self, game, state, predictions):
+        """
+        Chooses answers to the predicted moves, every one from the state of the real game.
+        :param game: The game.
+        :param state: Search state of the strategy saved before pondering.
+        :param predictions: List of tuples (occupied fields after opponent's move, _PredictedGame).
+        """
+        answers = self.answers.setdefault(game.gid, dict())
+        for predicted_occupied, predicted_game in predictions:
+            if self.stop_event.is_set():
                 break
-        v = _calc_points(p, (x,y), game.move_board, game.point_board)
-        result_set.add((x, y, p, v))
-        quantity += 1
-    x, y, p, v = max(result_set, key=lambda x: x[3])
-    game.move((x,y), p).result
+            self.strategy.restore_search_state(game, state)
+            move = self.strategy.choose_move(predicted_game)
+            if move is not None and not self.stop_event.is_set():
+                answers[predicted_occupied] = (move, self.strategy.save_search_state(game))
+        # a missed prediction should not spoil the search of the real position
+        self.strategy.restore_search_state(game, state)
+
+    def choose_move(self, game):
+        self._stop_pondering()
+        rules = rules_for(game.pawn.data, game.width, game.height)
+        answer = self.answers.pop(game.gid, dict()).get(rules.board_to_mask(game.move_board))
+        if answer is not None:
+            move, state = answer
+            self.strategy.restore_search_state(game, state)
+            self.hits += 1
+            _logger.info("Game %s: answer found while pondering (%d hits, %d misses)", game.gid, self.hits,
+                         self.misses)
+            return move
+        self.misses += 1
+        return self.strategy.choose_move(game)
+
+    def move_done(self, game):
+        self._stop_pondering()
+        rules = rules_for(game.pawn.data, game.width, game.height)
+        occupied = rules.board_to_mask(game.move_board)
+        moves = rules.legal_moves(occupied)
+        blocked = self.cache.blocked_by_moves(rules, occupied, [m[3] for m in moves])
+        values = rules.point_values(game.point_board)
+        gains = [rules.sum_points(b, values) for b in blocked]
 
+        predictions = []
+        opponent = 2 - game.player_number
+        for i in sorted(range(len(moves)), key=lambda i: -gains[i])[:self.replies]:
+            predicted_occupied = occupied | moves[i][3] | blocked[i]
+            player_points = list(game.player_points)
+            player_points[opponent] += gains[i]
+            predictions.append((predicted_occupied,
+                                _PredictedGame(game, rules.mask_to_board(predicted_occupied), player_points)))
+        if predictions:
+            state = self.strategy.save_search_state(game)
+            self.thread = threading.Thread(target=self._ponder, args=(game, state, predictions), daemon=True)
+            self.thread.start()
 
-def game_finished(game):
-    pass
+    def game_finished(self, game):
+        self._stop_pondering()
+        self.answers.pop(game.gid, None)
+        self.strategy.game_finished(game)
+
+    def close(self):
+        self._stop_pondering()
+        self.strategy.close()
+
+
+class _GameSnapshot:
+    """
+    Copy of the game state which can be sent to other process (used by BotRunner).
+    """
+    def __init__(self, game):
+        self.gid = game.gid
+        self.pawn = g.Pawn(None, game.pawn.data)
+        self.width = game.width
+        self.height = game.height
+        self.point_board = game.point_board
+        self.player_number = game.player_number
+        self.move_board = [list(column) for column in game.move_board]
+        self.player_points = list(game.player_points)
+
+
+_worker_factory = None              # creates strategy of the worker (set by _init_worker)
+_worker_state = threading.local()   # strategy of the worker thread
+
+
+def _init_worker(strategy_factory):
+    """
+    Initializes worker of BotRunner's executor.
+    :param strategy_factory: function creating strategy (must be picklable for process pools)
+    """
+    global _worker_factory
+    _worker_factory = strategy_factory
+
+
+def _choose_move_task(game):
+    """
+    Chooses move in the worker of BotRunner's executor.
+    Next moves of the game may be chosen by other workers, so nothing is kept after the move.
+    :param game: snapshot of the game
+    :return: move as for Strategy.choose_move
+    """
+    strategy = getattr(_worker_state, 'strategy', None)
+    if strategy is None:
+        strategy = _worker_state.strategy = _worker_factory()
+    try:
+        return strategy.choose_move(game)
+    finally:
+        strategy.game_finished(game)
+
+
+class BotRunner:
+    """
+    Plays many games at once on one (non-blocking) session: moves are chosen by workers of the executor,
+    while the runner keeps processing network events and sends moves without waiting for responses.
+    """
+    def __init__(self, session, executor):
+        """
+        :param session: signed in session
+        :param executor: executor initialized with _init_worker (e.g. ProcessPoolExecutor)
+        """
+        self.session = session
+        self.executor = executor
+        self.thinking = dict()  # gid -> (game, future choosing the move)
+        self.moving = dict()    # gid -> (game, query sending the move)
+        self.games_finished = 0
+        session.on_game_found = self._on_game_found
+
+    def _on_game_found(self, game):
+        game.on_your_turn = self._on_your_turn
+        game.on_finish = self._on_finish
+        # the first player gets no notification about its first turn
+        if game.is_active_player():
+            self._on_your_turn(game)
+
+    def _on_your_turn(self, game):
+        self.thinking[game.gid] = (game, self.executor.submit(_choose_move_task, _GameSnapshot(game)))
+
+    def _on_finish(self, game):
+        # move being chosen is not needed any more
+        self.thinking.pop(game.gid, None)
+        self.moving.pop(game.gid, None)
+        self.session.games.pop(game.gid, None)
+        self.games_finished += 1
+
+    @property
+    def active_games(self):
+        """
+        Number of games being played.
+        """
+        return len(self.session.games)
+
+    def step(self, timeout=0.01):
+        """
+        Processes network events, sends chosen moves and checks responses to them.
+        :param timeout: how long to wait for a chosen move or a network event if there is nothing to do
+        """
+        self.session.process_events()
+        busy = False
+
+        for gid, (game, future) in list(self.thinking.items()):
+            if not future.done():
+                continue
+            busy = True
+            del self.thinking[gid]
+            try:
+                move = future.result()
+            except Exception:
+                _logger.exception("Choosing move in game %s failed", gid)
+                continue
+            if move is None or game.is_finished:
+                continue
+            x, y, r = move
+            self.moving[gid] = (game, game.move((x, y), g.TransformablePawn(game.pawn, r)))
+
+        for gid, (game, query) in list(self.moving.items()):
+            if gid in self.moving and query.ready:
+                busy = True
+                del self.moving[gid]
+                if not query.result:
+                    _logger.warning("Move in game %s was rejected", gid)
+
+        if not busy:
+            if self.thinking:
+                wait([future for _, future in self.thinking.values()], timeout, FIRST_COMPLETED)
+            else:
+                # nothing to do until the server sends something
+                self.session.process_events(timeout)
+
+
+def my_turn(game, strategy=None):
+    strategy = strategy or GreedyStrategy()
+    move = strategy.choose_move(game)
+    if move is None:
+        return
+    x, y, r = move
+    if game.move((x, y), g.TransformablePawn(game.pawn, r)).result and not game.is_finished:
+        strategy.move_done(game)
+
+
+def game_finished(game, strategy=None):
+    if strategy:
+        strategy.game_finished(game)
 
 
 def accept_invite(user, func):
@@ -106,28 +553,90 @@ def accept_invite(user, func):
 
 
 def main():
-    if len(sys.argv) != 5:
-        print('Call: <host> <port> <user> <password>')
-        return
+    arg_parser = argparse.ArgumentParser(description="DVD Yellow Project bot")
+    arg_parser.add_argument('host', help="Address of the game server")
+    arg_parser.add_argument('port', type=int, help="Port of the game server")
+    arg_parser.add_argument('user', help="Name of the bot's user")
+    arg_parser.add_argument('password', help="Password of the bot's user")
+    arg_parser.add_argument('--strategy', dest='strategy', choices=['greedy', 'alphabeta', 'mcts'],
+                            default='alphabeta', help="Way of choosing moves")
+    arg_parser.add_argument('--time', metavar='seconds', dest='time', type=float, default=1.0,
+                            help="Time for a move (for alphabeta and mcts strategies)")
+    arg_parser.add_argument('--iterations', metavar='n', dest='iterations', type=int, default=None,
+                            help="Number of iterations for a move (for mcts strategy, instead of time limit)")
+    arg_parser.add_argument('--workers', metavar='n', dest='workers', type=int, default=1,
+                            help="Number of processes searching moves (for alphabeta strategy)")
+    arg_parser.add_argument('--endgame', metavar='n', dest='endgame', type=int, default=None,
+                            help="Number of free fields from which the game is solved exactly "
+                                 "(0 to turn off, default is 7 times pawn size)")
+    arg_parser.add_argument('--ponder', dest='ponder', default=False, action='store_true',
+                            help="Think also during opponent's turn")
+    arg_parser.add_argument('--verbose', dest='verbose', default=False, action='store_true',
+                            help="Print statistics of the search (e.g. playouts per second)")
+    arg_parser.add_argument('--games-workers', metavar='n', dest='games_workers', type=int, default=0,
+                            help="Play many games at once, choosing moves in n processes "
+                                 "(--workers and --ponder are ignored then)")
+    args = arg_parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO)
+
+    if args.games_workers:
+        # workers search with one process each and cannot ponder (they do not keep state between moves)
+        factory = partial(_make_strategy, args.strategy, args.time, args.iterations, 1, args.endgame, False)
+        with ProcessPoolExecutor(args.games_workers, initializer=_init_worker, initargs=(factory,)) as executor:
+            _run(args, executor=executor)
+    else:
+        strategy = _make_strategy(args.strategy, args.time, args.iterations, args.workers, args.endgame, args.ponder)
+        try:
+            _run(args, strategy=strategy)
+        finally:
+            strategy.close()
+
+
+def _make_strategy(name, time_budget, iterations, workers, endgame, ponder, cache=None):
+    """
+    Creates strategy described by command line arguments.
+    :param cache: evaluation cache of the strategy (None to use the one shared by the process)
+    :return: the strategy
+    """
+    if name == 'alphabeta':
+        strategy = AlphaBetaStrategy(time_budget, workers=workers, cache=cache)
+    elif name == 'mcts':
+        strategy = MonteCarloStrategy(None if iterations else time_budget, iterations, cache=cache)
+    else:
+        strategy = GreedyStrategy(cache)
+    if endgame != 0:
+        strategy = EndgameStrategy(strategy, endgame)
+    if ponder:
+        strategy = PonderingStrategy(strategy)
+    return strategy
+
 
+def _run(args, strategy=None, executor=None):
     try:
-        S = g.Session.create(sys.argv[1], int(sys.argv[2]), blocking=True).result
+        S = g.Session.create(args.host, args.port).result
     except:
         print("Could not connect to host!")
         return
 
-    if not S.sign_in(sys.argv[3], sys.argv[4]).result:
+    if not S.sign_in(args.user, args.password).result:
         print("Could not sign in.")
         return
 
     S.game_invitation = accept_invite
-    S.on_game_found = game_found
+    if executor is None:
+        S.on_game_found = lambda game: game_found(game, strategy)
+        # the bot sleeps until the server sends something (waking up sometimes to notice Ctrl+C)
+        step = lambda: S.process_events(1.)
+    else:
+        step = BotRunner(S, executor).step
 
     S.get_waiting_room().result
 
     try:
         while True:
-            S.process_events()
+            step()
     except KeyboardInterrupt:
         S.del_waiting_room().result
         S.sign_out().result
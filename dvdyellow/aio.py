@@ -0,0 +1,608 @@
+"""
+Client of DVD Yellow game server for asyncio programs.
+
+It provides the same operations as game module, but they are coroutines instead of asynchronous
+query objects, so many sessions (e.g. bots or load tests) can run concurrently on one event loop:
+
+    session = await AsyncSession.create('localhost')
+    if await session.sign_in('user', 'password'):
+        room = await session.get_waiting_room()
+
+Handlers of notifications (on_game_found, Game.on_your_turn etc.) can be functions or coroutine
+functions - coroutines are run as tasks. Notifications can be also read with async iterators
+returned by AsyncSession.notifications.
+"""
+import asyncio
+import inspect
+import logging
+import pickle
+import struct
+from collections import deque
+
+from .game import Game, Pawn
+from .network import _accept_message, _hello_message, _hello_message_size, _packet_length_size
+
+_logger = logging.getLogger("Network")
+
+# tasks of coroutine handlers - the event loop keeps only weak references to tasks
+_handler_tasks = set()
+
+
+def _handler_done(task):
+    """
+    Forgets finished task of a handler and logs its error.
+    :param task: The task.
+    """
+    _handler_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        _logger.error("Error in event handler", exc_info=task.exception())
+
+
+def _call(handler, *args):
+    """
+    Calls handler of an event (if it returns awaitable object, it is run as a task).
+    :param handler: The handler or None.
+    :param args: Arguments of the handler.
+    """
+    if handler is not None:
+        result = handler(*args)
+        if inspect.isawaitable(result):
+            task = asyncio.ensure_future(result)
+            _handler_tasks.add(task)
+            task.add_done_callback(_handler_done)
+
+
+class _NotificationIterator:
+    """
+    Async iterator of notifications (pairs (channel, data)), which ends when the connection is closed.
+    Notifications wait in a bounded queue - when it is full, the oldest one is dropped, so an iterator which
+    is not read does not stop the connection nor use more and more memory.
+    """
+    def __init__(self, connection, channels, maxsize):
+        self.connection = connection
+        self.channels = set(channels)
+        self.queue = asyncio.Queue(maxsize)
+        self.dropped = 0    # number of notifications dropped because the queue was full
+
+    def _put(self, item):
+        """
+        Adds notification (or None ending the iteration) to the queue, dropping the oldest one if it is full.
+        """
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(item)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = await self.queue.get()
+        if item is None:
+            raise StopAsyncIteration()
+        return item
+
+    def close(self):
+        """
+        Stops receiving notifications.
+        """
+        if self in self.connection.iterators:
+            self.connection.iterators.remove(self)
+            self._put(None)
+
+
+class AsyncConnection:
+    """
+    Connection to the server on asyncio streams. Queries can be sent one after another without waiting
+    for responses - the server answers queries of a connection in order.
+    """
+    def __init__(self, reader, writer):
+        """
+        Internal ctor (to create connection see open).
+        :param reader: Stream reader of the connection.
+        :param writer: Stream writer of the connection.
+        """
+        self.reader = reader
+        self.writer = writer
+        self.pending = deque()          # futures of queries waiting for responses (in order of sending)
+        self.notification_handler = dict()
+        self.iterators = []             # notification iterators
+        self.closed = False
+        self.drain_lock = asyncio.Lock()
+        self.reader_task = asyncio.ensure_future(self._read_loop())
+
+    @classmethod
+    async def open(cls, address, port, api_version):
+        """
+        Connects to the server and checks API version.
+        :param address: Address of the server.
+        :param port: Port on which the server runs.
+        :param api_version: Version of API used by the client.
+        :return: The connection.
+        :raise ConnectionError: If the server does not accept the client.
+        """
+        reader, writer = await asyncio.open_connection(address, port)
+        writer.write((_hello_message + pickle.dumps(api_version)).ljust(_hello_message_size, b'\x00'))
+        await writer.drain()
+        try:
+            answer = await reader.readexactly(_hello_message_size)
+        except asyncio.IncompleteReadError:
+            answer = None
+        if answer != _accept_message.ljust(_hello_message_size, b'\x00'):
+            writer.close()
+            raise ConnectionError("Server did not accept the client")
+        return cls(reader, writer)
+
+    def query(self, module, data):
+        """
+        Sends command to the server (at once, before the result is awaited).
+        :param module: Module to which send the command.
+        :param data: Parameter of the command - serialized before sending.
+        :return: Future of the response - it waits until the data written so far is sent, so sessions
+        sending faster than the server reads are slowed down.
+        :raise ConnectionError: If the connection is closed.
+        """
+        if self.closed:
+            raise ConnectionError("Connection is closed")
+        msg = pickle.dumps((module, data))
+        future = asyncio.Future()
+        self.pending.append(future)
+        self.writer.write(struct.pack('I', len(msg)) + msg)
+        return asyncio.ensure_future(self._response(future))
+
+    async def _response(self, future):
+        """
+        Waits for the response after the write buffer is drained.
+        :param future: Future of the response set by the read loop.
+        :return: The response.
+        """
+        # older versions of asyncio do not allow draining the stream by many tasks at once
+        async with self.drain_lock:
+            await self.writer.drain()
+        return await future
+
+    def set_notification_handler(self, channel, func):
+        """
+        Sets notifications handler for specified channel.
+        :param channel: Channel to which set notifications handler.
+        :param func: Function (or coroutine function) called with channel and data or None to turn it off.
+        :return: Old notification handler.
+        """
+        old = self.notification_handler.get(channel)
+        self.notification_handler[channel] = func
+        return old
+
+    def notifications(self, *channels, maxsize=1024):
+        """
+        Creates async iterator of notifications (pairs (channel, data)) on specified channels.
+        :param channels: The channels (all channels if none is given).
+        :param maxsize: Number of notifications waiting to be read - when there are more, the oldest ones
+        are dropped (their number is in dropped attribute of the iterator).
+        :return: The iterator - it ends when the connection is closed or close method is called.
+        """
+        iterator = _NotificationIterator(self, channels, maxsize)
+        if self.closed:
+            iterator._put(None)
+        else:
+            self.iterators.append(iterator)
+        return iterator
+
+    async def _read_loop(self):
+        """
+        Receives responses and notifications till the connection is closed.
+        """
+        try:
+            while True:
+                header = await self.reader.readexactly(_packet_length_size)
+                size = struct.unpack('I', header)[0]
+                channel, packet = pickle.loads(await self.reader.readexactly(size))
+                if channel > 0:
+                    try:
+                        _call(self.notification_handler.get(channel), channel, packet)
+                    except Exception:
+                        _logger.exception("Error in handler of notification on channel %d", channel)
+                    for iterator in self.iterators:
+                        if not iterator.channels or channel in iterator.channels:
+                            iterator._put((channel, packet))
+                else:
+                    future = self.pending.popleft()
+                    if not future.done():
+                        future.set_result(packet)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.closed = True
+            for future in self.pending:
+                if not future.done():
+                    future.set_exception(ConnectionError("Connection is closed"))
+            self.pending.clear()
+            for iterator in self.iterators:
+                iterator._put(None)
+            self.iterators = []
+
+    async def close(self):
+        """
+        Closes the connection (queries waiting for responses fail).
+        """
+        self.writer.close()
+        self.reader_task.cancel()
+        try:
+            await self.reader_task
+        except asyncio.CancelledError:
+            pass
+
+
+def _is_ok(response):
+    return response.get('status') == 'ok'
+
+
+class AsyncUser:
+    """
+    Represents a user in DVD Yellow system.
+    """
+    def __init__(self, session, user_id):
+        self._uid = user_id
+        self._name = None
+        self.session = session
+
+    @property
+    def id(self):
+        """
+        ID of the user.
+        """
+        return self._uid
+
+    @property
+    def name(self):
+        """
+        Awaitable name of the user.
+        """
+        return self._get_name()
+
+    async def _get_name(self):
+        if self._name is None:
+            response = await self.session.connection.query(3, {'command': 'get-name', 'id': self._uid})
+            if not _is_ok(response):
+                raise ValueError("No user with ID {}".format(self._uid))
+            self._name = response['name']
+        return self._name
+
+
+class AsyncGame(Game):
+    """
+    Represents a game (moves are coroutines, handlers can be coroutine functions).
+    """
+    async def move(self, point, pawn, optimistic=False):
+        """
+        Makes move. It puts pawn (TransformablePawn) at specified point.
+        :param point: Where to put the pawn.
+        :param pawn: TransformablePawn to put.
+        :param optimistic: If the move should be applied to the boards before the server answers (see Game.move).
+        :return: True if move command succeeded.
+        """
+        if self.is_finished:
+            raise AssertionError("The game was finished!")
+        future = self.session.connection.query(5, self._move_data(point, pawn))
+        applied = self._apply_move(point, pawn) if optimistic else None
+        try:
+            done = self._process_move_response(await future)
+        except ConnectionError:
+            self._reconcile_move(applied, False)
+            raise
+        self._reconcile_move(applied, done)
+        return done
+
+    async def abandon(self):
+        """
+        Abandons the game.
+        :return: True if abandoning succeeded.
+        """
+        if self.is_finished:
+            raise AssertionError("The game was finished!")
+        response = await self.session.connection.query(5, {
+            'command': 'abandon-game',
+            'game-nr': self.gid,
+            'player-nr': self.player_number,
+        })
+        if _is_ok(response):
+            self.result = 'defeated'
+            return True
+        return False
+
+    def _call_handler(self, handler):
+        _call(handler, self)
+
+
+class AsyncWaitingRoom:
+    """
+    Represents waiting room of the server.
+    """
+    def __init__(self, session):
+        self.session = session
+        self.status = dict()        # user ID -> status
+        self.status_changed = None  # (user, old status, new status) -> ()
+
+    def _on_change_status(self, channel, data):
+        if data.get('notification') != 'status-change':
+            return
+        uid = data.get('user')
+        status = data.get('status')
+        old_status = self.status.get(uid, 'disconnected')
+        if status == 'disconnected':
+            self.status.pop(uid, None)
+        else:
+            self.status[uid] = status
+        _call(self.status_changed, self.session._make_user(uid), old_status, status)
+
+    def get_online_users(self):
+        """
+        Gets list of users in Waiting Room.
+        :return: List of users.
+        """
+        return [self.session._make_user(uid) for uid in self.status.keys()]
+
+    def get_status_by_user(self, user):
+        """
+        Gets status of specified user.
+        :param user: The user.
+        :return: User status.
+        """
+        return self.status.get(user.id, 'disconnected')
+
+    async def set_status_by_user(self, user, status):
+        """
+        Sets status of specified user.
+        :param user: The user.
+        :param status: New status.
+        :return: True if query succeeded, otherwise False.
+        """
+        response = await self.session.connection.query(4, {
+            'command': 'set-status',
+            'new-status': status,
+            'uid': user.id,
+        })
+        return _is_ok(response)
+
+    async def get_ranking(self):
+        """
+        Gets ranking of users.
+        :return: List of pairs (user, points) or None if query failed.
+        """
+        response = await self.session.connection.query(5, {'command': 'get-ranking'})
+        if not _is_ok(response):
+            return None
+        result = []
+        for e in response.get('ranking'):
+            user = self.session._make_user(e['id'])
+            user._name = e['username']
+            result.append((user, e['points']))
+        return result
+
+
+class AsyncSession:
+    """
+    Represents simple operations that can be done on the server.
+    """
+    def __init__(self, connection):
+        """
+        Internal ctor (to create session see create).
+        :param connection: Connection to the server.
+        """
+        self.connection = connection
+        self.known_users = dict()
+        self.games = dict()     # id -> game object
+        self.waiting_room = None
+        self.on_game_found = None               # type: ( Game ) -> ()
+        self.game_invitation = None             # type: ( User, bool -> coroutine ) -> ()
+        self.game_invitation_cancelled = None   # type: ( User ) -> ()
+        self.game_invitation_declined = None    # type: ( User ) -> ()
+
+        connection.set_notification_handler(14, lambda ch, data: self._on_new_game(data))
+        connection.set_notification_handler(15, lambda ch, data: self._on_your_turn_in_game(data))
+        connection.set_notification_handler(16, lambda ch, data: self._on_invitation_notification(data))
+
+    @classmethod
+    async def create(cls, address, port=42371):
+        """
+        Connects to DVD Yellow game server and creates session.
+        :param address: Address of the game server.
+        :param port: Port number of the game server.
+        :return: The session.
+        :raise ConnectionError: If the server does not accept the client.
+        """
+        connection = await AsyncConnection.open(address, port, 1)
+        return cls(connection)
+
+    async def close(self):
+        """
+        Closes connection to the server.
+        """
+        await self.connection.close()
+
+    def notifications(self, *channels, maxsize=1024):
+        """
+        Creates async iterator of notifications (see AsyncConnection.notifications).
+        """
+        return self.connection.notifications(*channels, maxsize=maxsize)
+
+    def _make_user(self, uid):
+        if uid not in self.known_users:
+            self.known_users[uid] = AsyncUser(self, uid)
+        return self.known_users[uid]
+
+    async def _command(self, module, data):
+        response = await self.connection.query(module, data)
+        return _is_ok(response)
+
+    async def _command_steps(self, module, steps):
+        """
+        Sends commands which do not depend on each other at once and checks their responses in order.
+        All the responses are awaited, even if an earlier one failed.
+        :param module: Module to which send the commands.
+        :param steps: Parameters of the commands.
+        :return: List of responses or None if some command failed.
+        :raise ConnectionError: If the connection is closed.
+        """
+        responses = await asyncio.gather(*[self.connection.query(module, data) for data in steps],
+                                         return_exceptions=True)
+        for response in responses:
+            if isinstance(response, Exception):
+                raise response
+            if not _is_ok(response):
+                return None
+        return responses
+
+    def sign_in(self, login, password):
+        """
+        Signs in using specified authentication data.
+        :return: Coroutine returning True if signing in succeeded, otherwise False.
+        """
+        return self._command(3, {'command': 'sign-in', 'username': login, 'password': password})
+
+    def sign_out(self):
+        """
+        Signs out from the server.
+        :return: Coroutine returning True if signing out succeeded, otherwise False.
+        """
+        return self._command(3, {'command': 'sign-out'})
+
+    def sign_up(self, login, password):
+        """
+        Signs up using specified authentication data.
+        :return: Coroutine returning True if signing up succeeded, otherwise False.
+        """
+        return self._command(3, {'command': 'sign-up', 'username': login, 'password': password})
+
+    async def get_signed_in_user(self):
+        """
+        Returns currently signed in user.
+        :return: The user or None if nobody is signed in.
+        """
+        response = await self.connection.query(3, {'command': 'get-status'})
+        if _is_ok(response) and response['authenticated']:
+            return self._make_user(response['id'])
+        return None
+
+    async def prefetch_users(self, users):
+        """
+        Gets names of many users with one query (names already known are not asked for).
+        :param users: Iterable of user objects or users' IDs.
+        :return: List of user objects (in the same order).
+        """
+        users = [u if isinstance(u, AsyncUser) else self._make_user(u) for u in users]
+        missing = list({u.id for u in users if u._name is None})
+        if missing:
+            response = await self.connection.query(3, {'command': 'get-names', 'ids': missing})
+            if _is_ok(response):
+                for uid, name in response['names'].items():
+                    self._make_user(uid)._name = name
+        return users
+
+    def _on_new_game(self, data):
+        game = AsyncGame(session=self,
+                         gid=data['game-nr'],
+                         opponent=self._make_user(data['opponent-id']),
+                         pawn=Pawn(self, data['game-pawn']),
+                         point_board=data['game-board'],
+                         player_number=data['player-number'])
+        self.games[game.gid] = game
+        _call(self.on_game_found, game)
+        return game
+
+    def _on_your_turn_in_game(self, data):
+        game = self.games.get(data['game-nr'])
+        if game:
+            game._notification(data)
+
+    def _on_invitation_notification(self, data):
+        challenger = self._make_user(data.get('challenger'))
+        if data.get('notification') == 'random-game-challenge':
+            async def answer(accept):
+                response = await self.connection.query(5, {
+                    'command': 'accept-challenge' if accept else 'decline-challenge',
+                    'opponent': challenger.id
+                })
+                if accept:
+                    return self._on_new_game(response) if _is_ok(response) else None
+                return _is_ok(response)
+
+            _call(self.game_invitation, challenger, answer)
+        elif data.get('notification') == 'challenge-backed':
+            _call(self.game_invitation_cancelled, challenger)
+        elif data.get('notification') == 'challenge-declined':
+            _call(self.game_invitation_declined, challenger)
+
+    async def get_waiting_room(self):
+        """
+        Gets (and creates if needed) Waiting Room object.
+        :return: Waiting Room object or None if joining it failed.
+        """
+        if self.waiting_room:
+            return self.waiting_room
+
+        wr = AsyncWaitingRoom(self)
+        self.connection.set_notification_handler(13, wr._on_change_status)
+        steps = ({'command': 'set-status', 'new-status': 'connected'}, {'command': 'start-listening'},
+                 {'command': 'get-waiting-room'})
+        responses = None
+        try:
+            responses = await self._command_steps(4, steps)
+        finally:
+            if responses is None:
+                # joining failed (or the connection was closed), so nobody uses the room
+                self.connection.set_notification_handler(13, None)
+        if responses is None:
+            return None
+        wr.status = responses[-1]['waiting-dict']
+        self.waiting_room = wr
+        return wr
+
+    async def del_waiting_room(self):
+        """
+        Logs out from Waiting Room (and removes Waiting Room object).
+        :return: True if succeeded, otherwise False (None if there was no Waiting Room).
+        """
+        if not self.waiting_room:
+            return None
+
+        self.connection.set_notification_handler(13, None)
+        steps = ({'command': 'stop-listening'}, {'command': 'set-status', 'new-status': 'disconnected'})
+        if await self._command_steps(4, steps) is None:
+            # the room is still used, so its status is updated again
+            self.connection.set_notification_handler(13, self.waiting_room._on_change_status)
+            return False
+        self.waiting_room = None
+        return True
+
+    async def set_want_to_play(self):
+        """
+        Sets that player wants to play a game with some player.
+        :return: Game if somebody wants to play with one, None if there's no such player.
+        """
+        response = await self.connection.query(5, {'command': 'find-random-game'})
+        if not _is_ok(response) or 'game-status' not in response:
+            raise AssertionError("Server error - FIXIT")
+        if response['game-status'] == 'waiting':
+            return None
+        return self._on_new_game(response)
+
+    def cancel_want_to_play(self):
+        """
+        Cancels player's want to play the game.
+        :return: Coroutine returning True if succeeded, otherwise False.
+        """
+        return self._command(5, {'command': 'quit-searching'})
+
+    def invite_to_game(self, user):
+        """
+        Invites user to a game.
+        :return: Coroutine returning True if succeeded, otherwise False.
+        """
+        return self._command(5, {'command': 'challenge', 'opponent': user.id})
+
+    def cancel_invite(self, user):
+        """
+        Cancels invitation of the user.
+        :return: Coroutine returning True if succeeded, otherwise False.
+        """
+        return self._command(5, {'command': 'cancel-challenge', 'challenger': user.id})
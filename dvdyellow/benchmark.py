@@ -0,0 +1,159 @@
+"""
+Benchmark of database-heavy server operations (signing in and finishing games).
+
+Run it with different SQLite profiles to compare them, e.g.:
+    python -m dvdyellow.benchmark --profile default performance
+or with in-memory repository to measure the server without database costs:
+    python -m dvdyellow.benchmark --backend memory
+
+With sqlalchemy backend it also compares the prepared hot queries (baked user lookups
+and the cached result insert) with the same queries built by the ORM every time.
+"""
+import argparse
+import os
+import tempfile
+from time import perf_counter
+
+from .network import Deferred
+from .server import ServerManager
+
+
+def _run_query(handler, client_id, data):
+    """
+    Runs query handler (computing deferred result in the current thread).
+    :param handler: Query handler.
+    :param client_id: Client sending the query.
+    :param data: The query.
+    :return: Response to the query.
+    """
+    result = handler(client_id, data)
+    while isinstance(result, Deferred):
+        value = result.work()
+        result = result.then(value) if result.then else value
+    return result
+
+
+def run_benchmark(backend, profile, count, path):
+    """
+    Measures throughput of signing in and finishing games.
+    :param backend: Repository used by the server ('sqlalchemy' or 'memory').
+    :param profile: SQLite profile to use.
+    :param count: Number of operations of each kind.
+    :param path: Path of the database file to create.
+    :return: Tuple of sign-ins per second and finished games per second.
+    """
+    server_manager = ServerManager(config_object={'database': {'backend': backend, 'name': path,
+                                                               'sqlite': {'profile': profile}}})
+    user_manager = server_manager.user_manager
+    game_manager = server_manager.game_manager
+
+    with server_manager.repository.unit_of_work() as unit:
+        for i in range(count):
+            unit.add_user('user{}'.format(i), 'password{}'.format(i), ranking=0)
+
+    start = perf_counter()
+    for i in range(count):
+        response = _run_query(user_manager._query_handler, i + 1,
+                              {'command': 'sign-in', 'username': 'user{}'.format(i), 'password': 'password{}'.format(i)})
+        assert response['status'] == 'ok'
+    sign_in_time = perf_counter() - start
+
+    start = perf_counter()
+    for i in range(count):
+        game_manager._update_ranking_after_game(i % count + 1, 10, (i + 1) % count + 1, 20, 2)
+    game_finish_time = perf_counter() - start
+
+    server_manager._finalize()
+    return count / sign_in_time, count / game_finish_time
+
+
+def _timed(count, operation):
+    """
+    Runs the operation count times.
+    :param count: Number of runs.
+    :param operation: Function taking the number of the run.
+    :return: Number of runs per second.
+    """
+    start = perf_counter()
+    for i in range(count):
+        operation(i)
+    return count / (perf_counter() - start)
+
+
+def run_query_benchmark(count, path):
+    """
+    Measures throughput of the hot queries, prepared ones and built by the ORM every time.
+    :param count: Number of runs of each query.
+    :param path: Path of the database file to create.
+    :return: List of tuples (query name, prepared queries per second, ORM queries per second).
+    """
+    from . import orm
+    from .orm import GameResult, SqlRepository, User
+
+    repository = SqlRepository({'drivername': 'sqlite', 'database': path})
+    with repository.unit_of_work() as unit:
+        for i in range(count):
+            unit.add_user('user{}'.format(i), 'password{}'.format(i), ranking=0)
+
+    def plain_user_by_name(db_session, name):
+        return db_session.query(User).filter(User.name == name).first()
+
+    def plain_user_by_id(db_session, uid):
+        return db_session.query(User).filter(User.id == uid).first()
+
+    def plain_add_game_result(db_session, player1, points1, player2, points2, winner):
+        db_session.add(GameResult(player1=player1, points1=points1, player2=player2, points2=points2, winner=winner))
+        db_session.flush()
+
+    queries = [
+        ('user-by-name', orm.get_user_by_name, plain_user_by_name, lambda i: ('user{}'.format(i % count),)),
+        ('user-by-id', orm.get_user_by_id, plain_user_by_id, lambda i: (i % count + 1,)),
+        ('add-result', orm.add_game_result, plain_add_game_result,
+         lambda i: (i % count + 1, 10, (i + 1) % count + 1, 20, 2)),
+    ]
+    results = []
+    for name, prepared, plain, arguments in queries:
+        speeds = []
+        for query in (prepared, plain):
+            db_session = repository.session_type()
+            try:
+                speeds.append(_timed(count, lambda i: query(db_session, *arguments(i))))
+                db_session.commit()
+            finally:
+                db_session.close()
+        results.append((name, speeds[0], speeds[1]))
+
+    repository.close()
+    return results
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="DVD Yellow Project database benchmark")
+    arg_parser.add_argument('--backend', metavar='name', dest='backend', default='sqlalchemy',
+                            help="Repository used by the server (sqlalchemy or memory)")
+    arg_parser.add_argument('--profile', metavar='name', dest='profiles', nargs='+', default=['default', 'performance'],
+                            help="SQLite profiles to compare")
+    arg_parser.add_argument('--count', metavar='n', dest='count', type=int, default=1000,
+                            help="Number of sign-ins and finished games")
+    args = arg_parser.parse_args()
+
+    # SQLite profiles do not matter for in-memory repository
+    profiles = args.profiles if args.backend == 'sqlalchemy' else ['default']
+    print('{:<15}{:>15}{:>15}'.format('profile', 'sign-in/s', 'game-finish/s'))
+    with tempfile.TemporaryDirectory() as directory:
+        for i, profile in enumerate(profiles):
+            path = os.path.join(directory, 'benchmark-{}.db'.format(i))
+            sign_in, game_finish = run_benchmark(args.backend, profile, args.count, path)
+            label = profile if args.backend == 'sqlalchemy' else args.backend
+            print('{:<15}{:>15.1f}{:>15.1f}'.format(label, sign_in, game_finish))
+
+        if args.backend == 'sqlalchemy':
+            print()
+            print('{:<15}{:>15}{:>15}'.format('query', 'prepared/s', 'orm/s'))
+            path = os.path.join(directory, 'benchmark-queries.db')
+            for name, prepared, plain in run_query_benchmark(args.count, path):
+                print('{:<15}{:>15.1f}{:>15.1f}'.format(name, prepared, plain))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,26 @@
 # -*- coding: utf-8 -*-
 
 import os
+import queue
+import threading
+import traceback
+from time import perf_counter
 from dvdyellow.game import *
 import sfml as sf
 from math import floor
 
 data_directory = 'data'
-fontCeltic = sf.Font.from_file(os.path.join(data_directory, "celtic.ttf"))
-fontArial = sf.Font.from_file(os.path.join(data_directory, "arial.ttf"))
+# czcionki i tekstury są wczytywane dopiero przy pierwszym użyciu (czcionka, tekstura)
+fontCeltic = "celtic.ttf"
+fontArial = "arial.ttf"
 
 gra = None
 figura = None
-session = None
+session = None  # używana tylko w wątku sieciowym
+siec = None
+polaczono = False
 moj_login = ""
+nazwa_przeciwnika = ""
 
 zlozone_wyzwanie = 0  # 1 - złożone, 0 - niezłożone, -1 - odrzucone
 wyzywajacy = None
@@ -20,23 +28,150 @@ wyzwany = None
 decyzja = None
 
 moja_tura = 0
+ruch_wyslany = False
 
+czcionki = dict()
 tekstury = dict()
 
 
+def czcionka(nazwa):
+    if nazwa not in czcionki:
+        czcionki[nazwa] = sf.Font.from_file(os.path.join(data_directory, nazwa))
+    return czcionki[nazwa]
+
+
+def tekstura(nazwa):
+    if nazwa not in tekstury:
+        tekstury[nazwa] = sf.Texture.from_file(os.path.join(data_directory, nazwa))
+    return tekstury[nazwa]
+
+
+class WatekSieciowy(threading.Thread):
+    """
+    Wątek, który jako jedyny używa sesji - okno nigdy nie czeka na serwer.
+    Okno zleca polecenia (funkcje wykonywane w tym wątku), a ich wyniki i zdarzenia sesji trafiają
+    do skrzynki, którą okno opróżnia raz na klatkę.
+    """
+    def __init__(self):
+        threading.Thread.__init__(self, daemon=True)
+        self.polecenia = queue.Queue()  # (funkcja, funkcja wywoływana w oknie z wynikiem) lub None - koniec
+        self.skrzynka = queue.Queue()   # (funkcja, argumenty) do wywołania w oknie
+
+    def zlec(self, polecenie, po_wykonaniu=None):
+        self.polecenia.put((polecenie, po_wykonaniu))
+
+    def przekaz(self, funkcja):
+        """
+        Zwraca funkcję, która zamiast wywołać podaną, wkłada ją do skrzynki (dla zdarzeń sesji).
+        """
+        return lambda *args: self.skrzynka.put((funkcja, args))
+
+    def odbierz(self):
+        """
+        Wywołuje w oknie wszystko, co jest w skrzynce (nie czeka).
+        """
+        while True:
+            try:
+                funkcja, args = self.skrzynka.get_nowait()
+            except queue.Empty:
+                return
+            funkcja(*args)
+
+    def zakoncz(self, czas=2.):
+        """
+        Kończy wątek po wykonaniu zleconych poleceń (czeka na to najwyżej podany czas).
+        """
+        self.polecenia.put(None)
+        self.join(czas)
+
+    def run(self):
+        while True:
+            try:
+                # bez sesji nie ma zdarzeń, więc można czekać na polecenia
+                while True:
+                    zadanie = self.polecenia.get(block=session is None)
+                    if zadanie is None:
+                        return
+                    self._wykonaj(*zadanie)
+            except queue.Empty:
+                pass
+            try:
+                session.process_events(0.01)
+            except Exception:
+                # połączenie zerwane - kolejne polecenia nie mają sesji
+                traceback.print_exc()
+                rozlacz()
+
+    def _wykonaj(self, polecenie, po_wykonaniu):
+        try:
+            wynik = polecenie()
+        except Exception:
+            traceback.print_exc()
+            wynik = None
+        if po_wykonaniu:
+            self.skrzynka.put((po_wykonaniu, (wynik,)))
+
+
+class ListyGraczy:
+    """
+    Listy graczy pokazywane w menu - okno rysuje tylko z nich i nigdy nie pyta przy tym serwera.
+    Lista zalogowanych jest pobierana ponownie tylko po powiadomieniu o zmianie statusu (kanał 13),
+    a ranking, gdy jest wyświetlany i starszy niż CZAS_RANKINGU sekund.
+    """
+    CZAS_RANKINGU = 30.
+
+    def __init__(self):
+        self.online = []            # nazwy zalogowanych graczy (bez nas)
+        self.ranking = []           # (nazwa, punkty)
+        self.online_aktualne = False
+        self.czas_rankingu = None   # kiedy pobrano ranking (perf_counter)
+        self.pobieranie_online = False
+        self.pobieranie_rankingu = False
+
+    def uniewaznij(self):
+        self.online_aktualne = False
+
+    def odswiez_online(self):
+        if not self.online_aktualne and not self.pobieranie_online:
+            self.pobieranie_online = True
+            self.online_aktualne = True  # zmiana w trakcie pobierania unieważni listę ponownie
+            siec.zlec(zalogowani, self._ustaw_online)
+
+    def odswiez_ranking(self):
+        if self.pobieranie_rankingu:
+            return
+        if self.czas_rankingu is None or perf_counter() - self.czas_rankingu > self.CZAS_RANKINGU:
+            self.pobieranie_rankingu = True
+            siec.zlec(lista_rankingowa, self._ustaw_ranking)
+
+    def _ustaw_online(self, lista):
+        self.pobieranie_online = False
+        if lista is None:
+            self.online_aktualne = False
+        else:
+            self.online = lista
+
+    def _ustaw_ranking(self, lista):
+        self.pobieranie_rankingu = False
+        if lista is not None:
+            self.ranking = lista
+            self.czas_rankingu = perf_counter()
+
+
+listy = ListyGraczy()
+
+
 # Przycisk
 class Przycisk(sf.Drawable):
     def __init__(self, napis, x, y, minus_y=20, jasnosc=255, lenx=250, leny=60, fo=fontCeltic, color=sf.Color.BLACK,
                  style=sf.Text.BOLD, size=30, texture="czerwony.JPG"):
         sf.Drawable.__init__(self)
-        if texture not in tekstury:
-            tekstury[texture] = sf.Texture.from_file(os.path.join(data_directory, texture))
-        self.pole = sf.Sprite(tekstury[texture])
+        self.pole = sf.Sprite(tekstura(texture))
         self.pole.texture_rectangle = sf.Rectangle(sf.Vector2(x - lenx / 2, y - leny / 2), sf.Vector2(lenx, leny))
         self.pole.color = sf.Color(255, 255, 255, jasnosc)  # RGB, jasność
         self.pole.position = sf.Vector2(x - lenx / 2, y - leny / 2)
         self.tekst = sf.Text(napis)
-        self.tekst.font = fo
+        self.tekst.font = czcionka(fo)
         self.tekst.character_size = size
         self.tekst.style = style
         self.tekst.color = color
@@ -50,21 +185,192 @@ class Przycisk(sf.Drawable):
         target.draw(self.tekst, states)
 
 
+class Napis(sf.Drawable):
+    """
+    Tekst tworzony raz na ekran - ustaw zmienia go tylko, gdy wartość jest inna niż poprzednio.
+    """
+    def __init__(self, x, y, tek="", **kwargs):
+        sf.Drawable.__init__(self)
+        self.wartosc = tek
+        self.tekst = txt(x, y, tek=tek, **kwargs)
+
+    def ustaw(self, tek):
+        if tek != self.wartosc:
+            self.wartosc = tek
+            self.tekst.string = tek
+        return self
+
+    def draw(self, target, states):
+        target.draw(self.tekst, states)
+
+
+class Tabela(sf.Drawable):
+    """
+    Wiersze przycisków (np. lista graczy) budowane na nowo tylko wtedy, gdy dostaną nową listę.
+    """
+    def __init__(self, kolumny, y, **kwargs):
+        """
+        :param kolumny: Lista par (środek kolumny, szerokość).
+        :param y: Środek pierwszego wiersza.
+        :param kwargs: Argumenty przycisków.
+        """
+        sf.Drawable.__init__(self)
+        self.kolumny = kolumny
+        self.y = y
+        self.kwargs = kwargs
+        self.dane = None
+        self.przyciski = []
+
+    def ustaw(self, wiersze):
+        """
+        :param wiersze: Lista krotek wartości (po jednej na kolumnę) lub pojedynczych wartości dla jednej kolumny.
+        """
+        if wiersze is not self.dane:
+            self.dane = wiersze
+            self.przyciski = []
+            for i, wiersz in enumerate(wiersze):
+                if not isinstance(wiersz, tuple):
+                    wiersz = (wiersz,)
+                for napis, (x, lenx) in zip(wiersz, self.kolumny):
+                    self.przyciski.append(Przycisk(str(napis), x, self.y + 50 * i, lenx=lenx, **self.kwargs))
+        return self
+
+    def draw(self, target, states):
+        for przycisk in self.przyciski:
+            target.draw(przycisk, states)
+
+
+class Plansza(sf.Drawable):
+    """
+    Plansza gry rysowana w kilku wywołaniach: pola to jedna tablica teksturowanych czworokątów, a liczby
+    punktów - druga, złożona z glifów czcionki (budowana raz, bo punkty się nie zmieniają).
+    Pola są poprawiane tylko po zmianie move_board gry i tylko te, które się zmieniły.
+    """
+    # -3 - pole nieistniejące, -2, -1 - zablokowane przez graczy 1 i 2, 0 - wolne, 1, 2 - przykryte przez graczy
+    KOLORY = {
+        -3: sf.Color(255, 255, 255, 0),
+        -2: sf.Color(64, 32, 192, 150),
+        -1: sf.Color(255, 255, 0, 150),
+        0: sf.Color(255, 255, 255, 255),
+        1: sf.Color(255, 255, 0, 255),
+        2: sf.Color(64, 32, 192, 255),
+    }
+
+    def __init__(self, game, tekstura, fo=fontArial, x=250, y=50, bok=504):
+        sf.Drawable.__init__(self)
+        self.gra = game
+        self.x, self.y = x, y
+        self.wym = int(bok / max(game.width, game.height))
+        self.tekstura = tekstura
+        self.pola = sf.VertexArray(sf.PrimitiveType.QUADS, 4 * game.width * game.height)
+        self.wartosci = [[None] * game.height for _ in range(game.width)]
+        self.plansza = None  # move_board, z którego zbudowano pola
+        self.liczby = sf.VertexArray(sf.PrimitiveType.QUADS)
+        self.tekstura_liczb = self._zbuduj_liczby(fo)
+        self.podglad = sf.VertexArray(sf.PrimitiveType.QUADS)
+        self.klucz_podgladu = None
+
+    def _czworokat(self, tablica, x, y, kolor, i=None):
+        w = self.wym
+        for k, (dx, dy) in enumerate(((0, 0), (w, 0), (w, w), (0, w))):
+            wierzcholek = sf.Vertex((x + dx, y + dy), kolor, (10 + dx, 10 + dy))
+            if i is None:
+                tablica.append(wierzcholek)
+            else:
+                tablica[i + k] = wierzcholek
+
+    def _zbuduj_liczby(self, fo):
+        fo = czcionka(fo)
+        rozmiar = int(self.wym * 3 / 5)
+        glify = {c: fo.get_glyph(ord(c), rozmiar, False) for c in "-0123456789"}
+        for poz_x in range(self.gra.width):
+            for poz_y in range(self.gra.height):
+                pole, punkty = self.gra.get_field(poz_x, poz_y)
+                if pole == -3:
+                    continue
+                # tak jak sf.Text w txt(): przesunięcie o 10 i linia bazowa o rozmiar czcionki niżej
+                pioro = self.x + poz_x * self.wym + self.wym / (8 if punkty < 0 else 5) + 10
+                linia = self.y + poz_y * self.wym + 10 + rozmiar
+                for c in str(punkty):
+                    g = glify[c]
+                    b, t = g.bounds, g.texture_rectangle
+                    for dx, dy in ((0, 0), (1, 0), (1, 1), (0, 1)):
+                        self.liczby.append(sf.Vertex((pioro + b.left + dx * b.width, linia + b.top + dy * b.height),
+                                                     sf.Color.BLACK,
+                                                     (t.left + dx * t.width, t.top + dy * t.height)))
+                    pioro += g.advance
+        # tekstura pobrana po załadowaniu wszystkich glifów
+        return fo.get_texture(rozmiar)
+
+    def aktualizuj(self):
+        """
+        Poprawia pola, które zmieniły się od ostatniego wywołania.
+        """
+        if self.gra.move_board is self.plansza:
+            return
+        self.plansza = self.gra.move_board
+        for poz_x in range(self.gra.width):
+            for poz_y in range(self.gra.height):
+                wartosc = self.plansza[poz_x][poz_y]
+                if self.wartosci[poz_x][poz_y] != wartosc:
+                    self.wartosci[poz_x][poz_y] = wartosc
+                    self._czworokat(self.pola, self.x + poz_x * self.wym, self.y + poz_y * self.wym,
+                                    self.KOLORY[wartosc], 4 * (poz_x * self.gra.height + poz_y))
+
+    def ustaw_podglad(self, figura, kw_x, kw_y):
+        """
+        Ustawia podgląd ruchu (zielony, gdy figurę można tam położyć, czerwony w przeciwnym razie).
+        :param figura: Figura (TransformablePawn) lub None, gdy podglądu ma nie być.
+        :param kw_x: Pole planszy pod lewym górnym rogiem figury.
+        :param kw_y: Pole planszy pod lewym górnym rogiem figury.
+        """
+        klucz = None if figura is None else (kw_x, kw_y, figura.rotation, id(self.plansza))
+        if klucz == self.klucz_podgladu:
+            return
+        self.klucz_podgladu = klucz
+        self.podglad.clear()
+        if figura is None:
+            return
+        kolor = sf.Color(0, 255, 0, 200) if self.gra.is_legal((kw_x, kw_y), figura) else sf.Color(255, 0, 0, 200)
+        for ix in range(figura.width):
+            for iy in range(figura.height):
+                poz_x, poz_y = kw_x + ix, kw_y + iy
+                if figura.get_pawn_point(ix, iy) and 0 <= poz_x < self.gra.width and 0 <= poz_y < self.gra.height:
+                    self._czworokat(self.podglad, self.x + poz_x * self.wym, self.y + poz_y * self.wym, kolor)
+
+    def draw(self, target, states):
+        states.texture = self.tekstura
+        target.draw(self.pola, states)
+        states.texture = self.tekstura_liczb
+        target.draw(self.liczby, states)
+        states.texture = self.tekstura
+        target.draw(self.podglad, states)
+
+
+# FUNKCJE WYKONYWANE W OKNIE
+
 def ustaw_gre(game):
     if game is not None:
-        global gra, figura, moja_tura, zlozone_wyzwanie, wyzwany, wyzywajacy
+        global gra, figura, moja_tura, zlozone_wyzwanie, wyzwany, wyzywajacy, nazwa_przeciwnika, ruch_wyslany
         gra = game
-        gra.on_your_turn = zmiana_tury
         moja_tura = 1 if gra.player_number == 1 else 0
+        ruch_wyslany = False
         figura = gra.get_transformable_pawn()
         zlozone_wyzwanie = 0
         wyzwany = None
         wyzywajacy = None
+        nazwa_przeciwnika = ""
+        siec.zlec(lambda: game.opponent.name.result, ustaw_przeciwnika)
+
+
+def ustaw_przeciwnika(nazwa):
+    global nazwa_przeciwnika
+    nazwa_przeciwnika = nazwa or ""
 
 
 def txt(x, y, color=sf.Color.BLACK, size=25, fo=fontArial, tek="", style=sf.Text.REGULAR):
     tekst = sf.Text(tek)
-    tekst.font = fo
+    tekst.font = czcionka(fo)
     tekst.character_size = size
     tekst.style = style
     tekst.color = color
@@ -72,9 +378,77 @@ def txt(x, y, color=sf.Color.BLACK, size=25, fo=fontArial, tek="", style=sf.Text
     return tekst
 
 
+def przeciwnik():
+    if gra is not None or wyzywajacy is not None:
+        return nazwa_przeciwnika
+    else:
+        return None
+
+
+def zmiana_tury(game):
+    global moja_tura
+    if moja_tura:
+        moja_tura = 0
+    else:
+        moja_tura = 1
+
+
+def rysuj(window, *args):
+    for a in args:
+        window.draw(a)
+
+
+def wyzwanie(kto, funkcja_decyzyjna):
+    global wyzywajacy, decyzja, nazwa_przeciwnika
+    siec.zlec(wyjscie_z_menu)
+    wyzywajacy = kto
+    decyzja = funkcja_decyzyjna
+    nazwa_przeciwnika = ""
+    siec.zlec(lambda: kto.name.result, ustaw_przeciwnika)
+
+
+def odpowiedz(zgoda):
+    # nowa gra przychodzi przez session.on_game_found
+    funkcja_decyzyjna = decyzja
+    siec.zlec(lambda: funkcja_decyzyjna(zgoda).result)
+
+
+def odrzucenie_wyzwania(user):
+    global zlozone_wyzwanie
+    zlozone_wyzwanie = -1
+
+
+def rezygnacja_wyzywajacego(user):
+    global wyzywajacy
+    wyzywajacy = None
+
+
+def wyslij_ruch(pole):
+    global ruch_wyslany
+    ruch_wyslany = True
+    g, f = gra, figura.copy()
+    # ruch od razu pojawia się na planszy, serwer go potwierdza albo jest cofany
+    siec.zlec(lambda: g.move(pole, f, optimistic=True).result, po_ruchu)
+
+
+def po_ruchu(udany):
+    global ruch_wyslany
+    ruch_wyslany = False
+    if udany:
+        zmiana_tury(gra)
+
+
+def porzuc_gre():
+    global gra
+    g, gra = gra, None
+    siec.zlec(lambda: g.abandon().result)
+
+
+# FUNKCJE WYKONYWANE W WĄTKU SIECIOWYM
+
 def przeslij(typ, fi, sec):
     if typ == 1:
-        ustaw_sesje(fi, sec)
+        return ustaw_sesje(fi, sec)
     elif typ == 2:
         session.sign_in(fi, sec)
         return session.get_signed_in_user().result
@@ -88,24 +462,34 @@ def wylogowywanie():
 
 
 def zalogowani():
+    if wyzywajacy:
+        return None
     lista = []
-    if not wyzywajacy:
-        for u in session.get_waiting_room().result.get_online_users().result:
-            if u.name.result != moj_login:
-                lista.append(u.name.result)
+    poczekalnia = session.get_waiting_room().result
+    # poczekalnia sama śledzi statusy z powiadomień, okno trzeba tylko powiadomić o zmianie
+    poczekalnia.status_changed = siec.przekaz(lambda user, stary, nowy: listy.uniewaznij())
+    uzytkownicy = poczekalnia.get_online_users().result
+    # nazwy są pobierane tylko dla nowych graczy
+    for u in session.prefetch_users(uzytkownicy).result:
+        if u.name.result != moj_login:
+            lista.append(u.name.result)
     return lista
 
 
 def lista_rankingowa():
+    if wyzywajacy:
+        return None
     lista = []
-    if not wyzywajacy:
-        for u in session.get_waiting_room().result.get_ranking().result:
-            lista.append((u[0].name.result, int(u[1] * 100)))
+    ranking = session.get_waiting_room().result.get_ranking().result
+    for u in ranking:
+        lista.append((u[0].name.result, int(u[1] * 100)))
     return lista
 
 
 def wyjscie_z_menu():
     session.del_waiting_room().result
+    # poza poczekalnią nie ma powiadomień, więc po powrocie listę trzeba pobrać od nowa
+    siec.przekaz(listy.uniewaznij)()
 
 
 def rezygnacja():
@@ -118,63 +502,37 @@ def rezygnacja():
         session.cancel_want_to_play().result
 
 
-def przeciwnik():
-    if gra is not None:
-        return gra.opponent.name.result
-    elif wyzywajacy is not None:
-        return wyzywajacy.name.result
-    else:
-        return None
-
-
-def zmiana_tury(game):
-    global moja_tura
-    if moja_tura:
-        moja_tura = 0
-    else:
-        moja_tura = 1
-
-
-def rysuj(window, *args):
-    for a in args:
-        window.draw(a)
+def nowa_gra(game):
+    # handler musi być ustawiony, zanim przyjdzie pierwsze powiadomienie
+    game.on_your_turn = siec.przekaz(zmiana_tury)
+    siec.przekaz(ustaw_gre)(game)
 
 
 def ustaw_sesje(host, port):
     global session
     try:
-        session = make_session(host, int(port)).result
+        nowa_sesja = make_session(host, int(port)).result
     except:
         return 0
-    session.on_game_found = ustaw_gre
-    session.game_invitation = wyzwanie
-    session.game_invitation_declined = odrzucenie_wyzwania
-    session.game_invitation_cancelled = rezygnacja_wyzywajacego
+    nowa_sesja.on_game_found = nowa_gra
+    nowa_sesja.game_invitation = siec.przekaz(wyzwanie)
+    nowa_sesja.game_invitation_declined = siec.przekaz(odrzucenie_wyzwania)
+    nowa_sesja.game_invitation_cancelled = siec.przekaz(rezygnacja_wyzywajacego)
+    session = nowa_sesja
     return 1
 
 
-def wyzwanie(kto, funkcja_decyzyjna):
-    global wyzywajacy, decyzja
-    wyjscie_z_menu()
-    wyzywajacy = kto
-    decyzja = funkcja_decyzyjna
-
-
-def odrzucenie_wyzwania(user):
-    global zlozone_wyzwanie
-    zlozone_wyzwanie = -1
-
-
-def rezygnacja_wyzywajacego(user):
-    global wyzywajacy
-    wyzywajacy = None
+def rozlacz():
+    global session
+    session = None
 
 
 def zapros(num):
     global zlozone_wyzwanie, wyzwany
     zlozone_wyzwanie = 1
     lista = []
-    for u in session.get_waiting_room().result.get_online_users().result:
+    uzytkownicy = session.get_waiting_room().result.get_online_users().result
+    for u in session.prefetch_users(uzytkownicy).result:
         if u.name.result != moj_login:
             lista.append(u)
     if 0 <= num < len(lista):
@@ -186,8 +544,10 @@ def zapros(num):
 
 def main():
     # ZMIENNE WYSTĘPUJĄCE NA WIELU STRONACH
-    global gra, figura, session, moj_login, wyzywajacy, zlozone_wyzwanie
-    ground = sf.Sprite(sf.Texture.from_file(os.path.join(data_directory, "back.jpg")))
+    global gra, figura, siec, polaczono, moj_login, wyzywajacy, zlozone_wyzwanie
+    siec = WatekSieciowy()
+    siec.start()
+    ground = sf.Sprite(tekstura("back.jpg"))
     actual = 0  # 0 - strona startowa, 1 - wybór serwera, 2 - logowanie, 3 - rejestracja, 4-menu główne, 5-gra sieciowa, 6 - gra lokalna
     GREY = sf.Color(195, 195, 195)
     menu = Przycisk("Menu", 400, 530, 20, 255)
@@ -245,17 +605,101 @@ def main():
     alert = Przycisk("", 400, 300, lenx=400, leny=300, texture="black.jpg")
     ok = Przycisk("accept", 300, 400, 20, fo=fontArial, lenx=160, leny=80)
     no = Przycisk("reject", 500, 400, 20, fo=fontArial, lenx=160, leny=80)
+    heading_online = txt(300, 200, tek="Online Players", size=33, fo=fontCeltic)
+    heading_ranking = txt(475, 200, tek="Ranking", size=33, fo=fontCeltic)
+    h_name = Przycisk("Name", 412, 295, 20, 100, lenx=224, leny=40, fo=fontArial,
+                      color=GREY, style=sf.Text.REGULAR)
+    h_score = Przycisk("Score", 638, 295, 20, 100, lenx=224, leny=40, fo=fontArial,
+                       color=GREY, style=sf.Text.REGULAR)
+    tabela_online = Tabela([(525, 450)], 295, minus_y=20, jasnosc=100, leny=40, fo=fontArial,
+                           color=sf.Color.WHITE, style=sf.Text.REGULAR)
+    tabela_rankingu = Tabela([(412, 224), (638, 224)], 345, minus_y=20, jasnosc=100, leny=40, fo=fontArial,
+                             color=sf.Color.WHITE, style=sf.Text.REGULAR)
+    info = Napis(210, 180, color=sf.Color.BLACK, size=35)
 
     # GRA PRZEZ SIEĆ
     big_box = Przycisk("", 500, 300, 0, 255, lenx=560, leny=560)
     big_box2 = Przycisk("", 500, 300, 0, 255, lenx=550, leny=550, color=sf.Color(73, 99, 135, 255))
     finish = Przycisk("Finish game", 110, 50, 20, 255, 180, 60)
     wym = None
-    kwadrat = sf.Sprite(sf.Texture.from_file(os.path.join(data_directory, "black.jpg")))
+    plansza = None
+    play_upp = Napis(20, 80, size=42, fo=fontCeltic)
+    res_upp = Napis(20, 130, size=42, fo=fontCeltic)
+    play_low = Napis(20, 500, size=42, fo=fontCeltic)
+    res_low = Napis(20, 450, size=42, fo=fontCeltic)
+    wait = Napis(250, 250, color=GREY, size=35, fo=fontCeltic)
+    score = Napis(250, 350, color=GREY, size=35, fo=fontCeltic)
+    result = {
+        'won': txt(250, 250, color=GREY, size=35, fo=fontCeltic, tek="Congratulations, you won!"),
+        'defeated': txt(250, 250, color=GREY, size=35, fo=fontCeltic, tek="Sorry, you are defeated. \nNext time will be better!"),
+        'draw': txt(250, 250, color=GREY, size=35, fo=fontCeltic, tek="Draw, no one won!")
+    }
+
+    # GRA LOKALNA
+    lazy = txt(160, 200, color=GREY, size=35, fo=fontCeltic,
+               tek="Error 404 - this page isn't available now, \nbecause programmers are too lazy. Sorry")
+
+    # ODPOWIEDZI SERWERA (wywoływane w oknie przez siec.odbierz)
+    czekanie = False  # czy trwa łączenie lub logowanie
+
+    def polacz_z_serwerem():
+        nonlocal czekanie
+        if not czekanie:
+            czekanie = True
+            adres, numer = host_txt.string, port_txt.string
+            siec.zlec(lambda: ustaw_sesje(adres, numer), po_polaczeniu)
+
+    def po_polaczeniu(udane):
+        global polaczono
+        nonlocal actual, error, czekanie
+        czekanie = False
+        if udane:
+            polaczono = True
+            if actual == 1:
+                actual = 0
+                host_txt.string = "localhost"
+                host_txt.color = sf.Color(255, 255, 255, 200)
+                host_txt.style = sf.Text.ITALIC
+                port_txt.string = "42371"
+                port_txt.color = sf.Color(255, 255, 255, 200)
+                port_txt.style = sf.Text.ITALIC
+                error = 0
+        else:
+            error = 1
+
+    def wyslij_dane():
+        nonlocal czekanie
+        if not czekanie:
+            czekanie = True
+            typ, nazwa, tajne = actual, login_txt.string, moje_haslo
+            siec.zlec(lambda: przeslij(typ, nazwa, tajne), lambda udane: po_przeslaniu(typ, nazwa, udane))
+
+    def po_przeslaniu(typ, nazwa, udane):
+        global moj_login
+        nonlocal actual, error, chosen, moje_haslo, czekanie
+        czekanie = False
+        if actual != typ:
+            return
+        if udane:
+            actual = 4 if typ == 2 else 0
+            error = 0
+            chosen = 0
+            moj_login = nazwa
+            login_txt.string = ""
+            haslo_txt.string = ""
+            moje_haslo = ""
+        else:
+            error = 1
+
+    def po_zaproszeniu(udane):
+        nonlocal actual, option
+        if udane:
+            option = 0
+            actual = 5
+            siec.zlec(wyjscie_z_menu)
 
     while window.is_open:
-        if session:
-            session.process_events()
+        siec.odbierz()
 
         for event in window.events:
             if event == sf.MouseMoveEvent:
@@ -269,13 +713,14 @@ def main():
                 # Klikanie
                 elif event == sf.MouseButtonEvent and event.released:
                     # serwer już wprowadzony
-                    if session:
+                    if polaczono:
                         if log.zawiera(x, y):
                             actual = 2
                         elif konto.zawiera(x, y):
                             actual = 3
                         elif disconnect.zawiera(x, y):
-                            session = None
+                            polaczono = False
+                            siec.zlec(rozlacz)
                     # lub nie
                     else:
                         if web.zawiera(x, y):
@@ -305,17 +750,7 @@ def main():
                         port_txt.style = sf.Text.ITALIC
                         error = 0
                     elif polacz.zawiera(x, y):
-                        if ustaw_sesje(host_txt.string, port_txt.string):
-                            actual = 0
-                            host_txt.string = "localhost"
-                            host_txt.color = sf.Color(255, 255, 255, 200)
-                            host_txt.style = sf.Text.ITALIC
-                            port_txt.string = "42371"
-                            port_txt.color = sf.Color(255, 255, 255, 200)
-                            port_txt.style = sf.Text.ITALIC
-                            error = 0
-                        else:
-                            error = 1
+                        polacz_z_serwerem()
 
                     if host.zawiera(x, y):
                         chosen = 1
@@ -346,13 +781,7 @@ def main():
                 # Klawiatura
                 elif event == sf.KeyEvent and event.released:
                     if event.code == sf.Keyboard.RETURN:
-                        if ustaw_sesje(host_txt.string, port_txt.string):
-                            actual = 0
-                            error = 0
-                            host_txt.string = ""
-                            port_txt.string = ""
-                        else:
-                            error = 1
+                        polacz_z_serwerem()
                     elif event.code == sf.Keyboard.TAB:
                         chosen = (chosen + 1) % 3
 
@@ -373,15 +802,7 @@ def main():
                         moje_haslo = ""
                         moj_login = ""
                     elif submit[actual - 2].zawiera(x, y):
-                        if przeslij(actual, login_txt.string, moje_haslo):
-                            actual = 4 if actual == 2 else 0
-                            error = 0
-                            moj_login = login_txt.string
-                            login_txt.string = ""
-                            haslo_txt.string = ""
-                            moje_haslo = ""
-                        else:
-                            error = 1
+                        wyslij_dane()
 
                     if login.zawiera(x, y):
                         chosen = 1
@@ -408,16 +829,7 @@ def main():
                 # Klawiatura
                 elif event == sf.KeyEvent and event.released:
                     if event.code == sf.Keyboard.RETURN:
-                        if przeslij(actual, login_txt.string, moje_haslo):
-                            actual = 4 if actual == 2 else 0
-                            error = 0
-                            chosen = 0
-                            moj_login = login_txt.string
-                            login_txt.string = ""
-                            haslo_txt.string = ""
-                            moje_haslo = ""
-                        else:
-                            error = 1
+                        wyslij_dane()
                     elif event.code == sf.Keyboard.TAB:
                         chosen = (chosen + 1) % 3
 
@@ -425,8 +837,8 @@ def main():
             elif actual == 4:
                 # Zamykanie
                 if event == sf.CloseEvent:
-                    wyjscie_z_menu()
-                    wylogowywanie()
+                    siec.zlec(wyjscie_z_menu)
+                    siec.zlec(wylogowywanie)
                     window.close()
 
                 # Klikanie
@@ -437,21 +849,20 @@ def main():
                             if ok.zawiera(x, y):
                                 actual = 5
                                 option = 0
-                                ustaw_gre(decyzja(True).result)
+                                odpowiedz(True)
                             else:
-                                decyzja(False).result
+                                odpowiedz(False)
                     else:
                         if option == 1:
                             if random.zawiera(x, y):
                                 option = 0
                                 actual = 5
-                                wyjscie_z_menu()
-                                ustaw_gre(session.set_want_to_play().result)
+                                siec.zlec(wyjscie_z_menu)
+                                # gra przychodzi przez session.on_game_found
+                                siec.zlec(lambda: session.set_want_to_play().result)
                             elif box.zawiera(x, y) and not 20 <= (y - 295) % 50 <= 30:
-                                if zapros(int((y - 295) / 50)):
-                                    option = 0
-                                    actual = 5
-                                    wyjscie_z_menu()
+                                num = int((y - 295) / 50)
+                                siec.zlec(lambda num=num: zapros(num), po_zaproszeniu)
 
 
                         if nowa.zawiera(x, y):
@@ -463,8 +874,8 @@ def main():
                         elif zmiany.zawiera(x, y):
                             option = 4
                         elif wyloguj.zawiera(x, y):
-                            wyjscie_z_menu()
-                            wylogowywanie()
+                            siec.zlec(wyjscie_z_menu)
+                            siec.zlec(wylogowywanie)
                             moj_login = ""
                             actual = 0
                             option = 0
@@ -476,30 +887,29 @@ def main():
                 if event == sf.CloseEvent:
                     window.close()
                     if gra and not gra.is_finished:
-                        gra.abandon().result
-                        gra = None
+                        porzuc_gre()
                     elif not gra:
-                        rezygnacja()
-                    wylogowywanie()
+                        siec.zlec(rezygnacja)
+                    siec.zlec(wylogowywanie)
                 if not gra:  # czekanie
                     # Klikanie
                     if event == sf.MouseButtonEvent and event.released:
                         if menu.zawiera(x, y):
                             actual = 4
-                            rezygnacja()
+                            siec.zlec(rezygnacja)
 
                 elif not gra.is_finished:  # trwa rozgrywka
                     # Klikanie
                     if event == sf.MouseButtonEvent and event.released:
                         if finish.zawiera(x, y):
                             actual = 4
-                            gra.abandon().result
-                            gra = None
-                        if moja_tura:
+                            porzuc_gre()
+                        elif moja_tura and not ruch_wyslany:
                             xx = int((x - 250) / wym)
                             yy = int((y - 50) / wym)
-                            if 0 <= xx < gra.width and 0 <= yy < gra.height and gra.move((xx, yy), figura).result:
-                                zmiana_tury(gra)
+                            # niedozwolony ruch nie jest wysyłany do serwera
+                            if gra.is_legal((xx, yy), figura):
+                                wyslij_ruch((xx, yy))
 
                     # Obracanie figury
                     elif event == sf.KeyEvent and event.released:
@@ -538,7 +948,7 @@ def main():
 
         # STRONA STARTOWA
         if actual == 0:
-            if session:
+            if polaczono:
                 rysuj(window, game, log, konto, disconnect)
             else:
                 rysuj(window, game, web, local, exit)
@@ -590,146 +1000,59 @@ def main():
         elif actual == 4:
             rysuj(window, game, nowa, ranking, przyjaciele, zmiany, wyloguj)
             if option == 1:
-                heading = txt(300, 200, tek="Online Players", size=33, fo=fontCeltic)
-                rysuj(window, box, heading, random)
-                counter = 0
-                for gamer in zalogowani():
-                    player = Przycisk(gamer, 525, 295 + 50 * counter, 20, 100, lenx=450, leny=40, fo=fontArial,
-                                      color=sf.Color.WHITE, style=sf.Text.REGULAR)
-                    rysuj(window, player)
-                    counter += 1
+                if not wyzywajacy:
+                    listy.odswiez_online()
+                rysuj(window, box, heading_online, random, tabela_online.ustaw(listy.online))
             elif option == 2:
-                heading = txt(475, 200, tek="Ranking", size=33, fo=fontCeltic)
-                h_name = Przycisk("Name", 412, 295, 20, 100, lenx=224, leny=40, fo=fontArial,
-                                  color=GREY, style=sf.Text.REGULAR)
-                h_score = Przycisk("Score", 638, 295, 20, 100, lenx=224, leny=40, fo=fontArial,
-                                   color=GREY, style=sf.Text.REGULAR)
-                rysuj(window, box, heading, h_name, h_score)
-                counter = 1
-                for (gamer, score) in lista_rankingowa():
-                    player = Przycisk(gamer, 412, 295 + 50 * counter, 20, 100, lenx=224, leny=40, fo=fontArial,
-                                      color=sf.Color.WHITE, style=sf.Text.REGULAR)
-                    points = Przycisk(str(score), 638, 295 + 50 * counter, 20, 100, lenx=224, leny=40, fo=fontArial,
-                                      color=sf.Color.WHITE, style=sf.Text.REGULAR)
-                    rysuj(window, player, points)
-                    counter += 1
+                if not wyzywajacy:
+                    listy.odswiez_ranking()
+                rysuj(window, box, heading_ranking, h_name, h_score, tabela_rankingu.ustaw(listy.ranking))
             elif option != 0:
                 rysuj(window, box)
 
             if wyzywajacy:
-                info = txt(210, 180, color=sf.Color.BLACK, size=35,
-                           tek="       CHALLENGE!\n" + przeciwnik() + " has challenged you!")
-                rysuj(window, alert, info, ok, no)
+                rysuj(window, alert, info.ustaw("       CHALLENGE!\n" + przeciwnik() + " has challenged you!"), ok, no)
 
         # GRA PRZEZ SIEĆ
         elif actual == 5:
             if not gra:  # czekanie
                 napis = "The opponent rejected your invitation" if zlozone_wyzwanie == -1 else "Waiting for opponent"
-                wait = txt(250, 250, color=GREY, size=35, fo=fontCeltic, tek=napis)
-                rysuj(window, wait, menu)
+                rysuj(window, wait.ustaw(napis), menu)
 
             elif gra.is_finished:  # koniec gry
-                score = txt(250, 350, color=GREY, size=35, fo=fontCeltic,
-                            tek="Your score: " + str(gra.player_points[gra.player_number - 1])
-                                + "\nOpponent's score: " + str(gra.player_points[2 - gra.player_number]))
-                result = {
-                    'won': txt(250, 250, color=GREY, size=35, fo=fontCeltic, tek="Congratulations, you won!"),
-                    'defeated': txt(250, 250, color=GREY, size=35, fo=fontCeltic, tek="Sorry, you are defeated. \nNext time will be better!"),
-                    'draw': txt(250, 250, color=GREY, size=35, fo=fontCeltic, tek="Draw, no one won!")
-                }
-
+                score.ustaw("Your score: " + str(gra.player_points[gra.player_number - 1])
+                            + "\nOpponent's score: " + str(gra.player_points[2 - gra.player_number]))
                 rysuj(window, result[gra.result], score, menu)
 
             else:  # rozgrywka
 
                 rysuj(window, big_box, big_box2, finish)
 
-                kol1 = sf.Color(255, 255, 0, 255)
-                kol1b = sf.Color(255, 255, 0, 150)
-                kol2 = sf.Color(64, 32, 192, 255)
-                kol2b = sf.Color(64, 32, 192, 150)
-
-                play_upp = txt(20, 80, tek=moj_login, size=42, fo=fontCeltic,
-                               color=(kol1 if gra.player_number == 1 else kol2))
-                res_upp = txt(20, 130, tek=str(gra.player_points[gra.player_number - 1]), size=42, fo=fontCeltic,
-                              color=(kol1 if gra.player_number == 1 else kol2))
-                play_low = txt(20, 500, tek=przeciwnik(), size=42, fo=fontCeltic,
-                               color=(kol2 if gra.player_number == 1 else kol1))
-                res_low = txt(20, 450, tek=str(gra.player_points[2 - gra.player_number]), size=42, fo=fontCeltic,
-                              color=(kol2 if gra.player_number == 1 else kol1))
-
-                list_fig = []
-                czy_zielona = 1
-
-                wym = int(504 / max(gra.width, gra.height))
-                kwadrat.texture_rectangle = sf.Rectangle((10, 10), (wym, wym))
-
-                """
-                -3 - pole nieistniejące
-                -2, -1 - pola zablokowane przez graczy 1 i 2
-                0 - wolne pole na planszy
-                1, 2 - pola przykryte przez graczy 1 i 2
-                """
-                poz_y = 0
-                while poz_y < gra.height:
-                    poz_x = 0
-                    while poz_x < gra.width:
-                        kw_x = int((x - 250) / wym)
-                        kw_y = int((y - 50) / wym)
-                        if figura.get_pawn_point(poz_x - kw_x, poz_y - kw_y) \
-                                and kw_y <= poz_y < kw_y + figura.height \
-                                and kw_x <= poz_x < kw_x + figura.width \
-                                and moja_tura:
-                            if gra.get_field(poz_x, poz_y)[0] != 0 or kw_x + figura.width > gra.width \
-                                    or kw_y + figura.height > gra.height:
-                                czy_zielona = 0
-                            list_fig.append((250 + poz_x * wym, 50 + poz_y * wym))
-                        else:
-                            if gra.get_field(poz_x, poz_y)[0] == 0:
-                                kwadrat.color = sf.Color(255, 255, 255, 255)
-                            elif gra.get_field(poz_x, poz_y)[0] == 1:
-                                kwadrat.color = kol1
-                            elif gra.get_field(poz_x, poz_y)[0] == -1:
-                                kwadrat.color = kol1b
-                            elif gra.get_field(poz_x, poz_y)[0] == 2:
-                                kwadrat.color = kol2
-                            elif gra.get_field(poz_x, poz_y)[0] == -2:
-                                kwadrat.color = kol2b
-                            elif gra.get_field(poz_x, poz_y)[0] == -3:
-                                kwadrat.color = sf.Color(255, 255, 255, 0)
-
-                            kwadrat.position = sf.Vector2(250 + poz_x * wym, 50 + poz_y * wym)
-                            rysuj(window, kwadrat)
-                        if gra.get_field(poz_x, poz_y)[1] < 0:
-                            numerek = txt(250 + poz_x * wym + wym / 8, 50 + poz_y * wym,
-                                          tek=str(gra.get_field(poz_x, poz_y)[1]), size=wym * 3 / 5)
-                        else:
-                            numerek = txt(250 + poz_x * wym + wym / 5, 50 + poz_y * wym,
-                                          tek=str(gra.get_field(poz_x, poz_y)[1]), size=wym * 3 / 5)
-                        if gra.get_field(poz_x, poz_y)[0] != -3:
-                            rysuj(window, numerek)
-                        poz_x += 1
-                    poz_y += 1
-
-                for poz in list_fig:
-                    if czy_zielona:
-                        kwadrat.color = sf.Color(0, 255, 0, 200)
-                    else:
-                        kwadrat.color = sf.Color(255, 0, 0, 200)
-                    kwadrat.position = sf.Vector2(poz[0], poz[1])
-                    rysuj(window, kwadrat)
+                if plansza is None or plansza.gra is not gra:
+                    # nowa gra - kolory graczy zależą od kolejności
+                    plansza = Plansza(gra, tekstura("black.jpg"))
+                    kol1, kol2 = Plansza.KOLORY[gra.player_number], Plansza.KOLORY[3 - gra.player_number]
+                    play_upp.tekst.color = res_upp.tekst.color = kol1
+                    play_low.tekst.color = res_low.tekst.color = kol2
+                wym = plansza.wym
+                plansza.aktualizuj()
+                plansza.ustaw_podglad(figura if moja_tura and not ruch_wyslany else None, int((x - 250) / wym), int((y - 50) / wym))
 
-                rysuj(window, play_upp, play_low, res_upp, res_low)
+                play_upp.ustaw(moj_login)
+                play_low.ustaw(przeciwnik())
+                res_upp.ustaw(str(gra.player_points[gra.player_number - 1]))
+                res_low.ustaw(str(gra.player_points[2 - gra.player_number]))
+                rysuj(window, plansza, play_upp, play_low, res_upp, res_low)
 
 
         # GRA LOKALNA
         elif actual == 6:
-            lazy = txt(160, 200, color=GREY, size=35, fo=fontCeltic,
-                       tek="Error 404 - this page isn't available now, \nbecause programmers are too lazy. Sorry")
             rysuj(window, game, lazy, menu)
 
         window.display()
 
+    siec.zakoncz()
+
 
 if __name__ == "__main__":
     main()
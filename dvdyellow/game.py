@@ -4,9 +4,10 @@ Here would be objects that client will use to play the game.
 So classes like Board, WaitingRoom (from Client Game Interface)
 will be here implemented.
 """
-from sfml.system import sleep, milliseconds
+from time import perf_counter, sleep
 
 from .network import Client
+from .rules import rules_for
 
 
 class AsyncQuery:
@@ -49,29 +50,50 @@ class AsyncQuery:
         """
         return self.checker(self.object)
 
+    def wait(self, timeout=None):
+        """
+        Waits for completion of the query. Network queries sleep until data comes from the server.
+        :param timeout: Maximal time of waiting in seconds (None to wait without limit).
+        :return: True if query is completed.
+        """
+        deadline = None if timeout is None else perf_counter() + timeout
+        while not self.checker(self.object):
+            remaining = None if deadline is None else deadline - perf_counter()
+            if remaining is not None and remaining <= 0:
+                return False
+            if hasattr(self.object, 'wait'):
+                self.object.wait(remaining)
+            else:
+                sleep(0.001)
+        return True
+
     @property
     def result(self):
         """
         Returns the result (waits for completion if needed).
         :return:
         """
-        while not self.checker(self.object):
-            sleep(milliseconds(1))
+        self.wait()
         return self.result_getter(self.object)
 
 
 class AsyncQueryChain:
     """
     Represents chain of asynchronous queries that must be run one after another.
+    In pipelined mode all the queries are sent at once (the server answers them in order), so the chain takes
+    one round-trip instead of one per query - results are still checked in order and the ones after the first
+    failure are discarded.
     """
-    def __init__(self, query, *args):
+    def __init__(self, query, *args, pipelined=False):
         """
         Creates chain of asynchronous queries.
         :param query: First query to run.
         :param args: Other queries to run.
+        :param pipelined: If all the queries should be run at once (when they do not depend on previous results).
         """
         self.queries = list(args)
         self.queries.insert(0, query)
+        self.pipelined = pipelined
         self.current = 0
         self.started = False
         self._result = None
@@ -81,14 +103,15 @@ class AsyncQueryChain:
 
     def run(self):
         """
-        Run the queries sequentially.
+        Run the queries sequentially (or all at once in pipelined mode).
         :return: Asynchronous query (self).
         """
         old_started, self.started = self.started, True
         if old_started:
             raise AssertionError("Runned running query")
 
-        self.queries[0][0].run()
+        for query, _ in (self.queries if self.pipelined else self.queries[:1]):
+            query.run()
 
         return self
 
@@ -116,18 +139,32 @@ class AsyncQueryChain:
                         self._result = result
                         return True
                     else:
-                        self.queries[self.current][0].run()
+                        if not self.pipelined:
+                            self.queries[self.current][0].run()
                         continue
             else:
                 return False
 
+    def wait(self, timeout=None):
+        """
+        Waits for completion of all the queries.
+        :param timeout: Maximal time of waiting in seconds (None to wait without limit).
+        :return: True if the queries are completed.
+        """
+        deadline = None if timeout is None else perf_counter() + timeout
+        while not self.ready:
+            remaining = None if deadline is None else deadline - perf_counter()
+            if remaining is not None and remaining <= 0:
+                return False
+            self.queries[self.current][0].wait(remaining)
+        return True
+
     @property
     def result(self):
         """
         Result of last query in the chain.
         """
-        while not self.ready:
-            sleep(milliseconds(1))
+        self.wait()
         return self._result
     
     @property
@@ -135,8 +172,7 @@ class AsyncQueryChain:
         """
         Array of results of all queries in the chain.
         """
-        while not self.ready:
-            sleep(milliseconds(1))
+        self.wait()
         return self._all_results
 
 
@@ -207,6 +243,30 @@ class Session:
             self.known_users[uid] = User(self, uid)
         return self.known_users[uid]
 
+    def prefetch_users(self, users):
+        """
+        Gets names of many users with one query (names already known are not asked for).
+        :param users: Iterable of user objects or users' IDs.
+        :return: Asynchronous query returning list of user objects (in the same order).
+        """
+        users = [u if isinstance(u, User) else self._make_user(u) for u in users]
+        missing = list({u.id for u in users if u._name is None})
+        if not missing:
+            return AsyncQuery(lambda: None, lambda _: True, lambda _: users).run()
+
+        data = {
+            'command': 'get-names',
+            'ids': missing
+        }
+
+        def result_processor(r):
+            if r.response.get('status') == 'ok':
+                for uid, name in r.response['names'].items():
+                    self._make_user(uid)._name = name
+            return users
+
+        return AsyncQuery(lambda: self.client.query(3, data), lambda r: r.check(), result_processor).run()
+
     def _make_pawn(self, pawn_data):
         """
         Creates pawn object within the session.
@@ -215,11 +275,13 @@ class Session:
         """
         return Pawn(self, pawn_data)
 
-    def process_events(self):
+    def process_events(self, timeout=0):
         """
         Processes network events and call related callbacks.
+        :param timeout: Time of waiting for events if there are none (in seconds, None to wait without limit).
         """
-        self.client.receive_all()
+        if not self.client.receive_all() and timeout != 0 and self.client.wait(timeout):
+            self.client.receive_all()
 
     def sign_in(self, login, password):
         """
@@ -367,10 +429,14 @@ class Session:
             else:
                 return None
 
+        # the steps do not depend on each other, so they are sent at once
         return AsyncQueryChain(
-            (AsyncQuery(lambda: self.client.query(4, data_sign_in), lambda r: r.check(), _check_result_ok), lambda r: r),
-            (AsyncQuery(lambda: self.client.query(4, data_listen), lambda r: r.check(), _check_result_ok), lambda r: r),
-            (AsyncQuery(lambda: self.client.query(4, data_get), lambda r: r.check(), wr_setter), lambda r: r)
+            (AsyncQuery(lambda: self.client.query(4, data_sign_in), lambda r: r.check(), _check_result_ok),
+             lambda r: r[-1]),
+            (AsyncQuery(lambda: self.client.query(4, data_listen), lambda r: r.check(), _check_result_ok),
+             lambda r: r[-1]),
+            (AsyncQuery(lambda: self.client.query(4, data_get), lambda r: r.check(), wr_setter), lambda r: r[-1]),
+            pipelined=True
         ).run()
 
     def del_waiting_room(self):
@@ -399,10 +465,14 @@ class Session:
             else:
                 return False
 
-        return AsyncQueryChain(
-            (AsyncQuery(lambda: self.client.query(4, data_listen), lambda r: r.check(), _check_result_ok), lambda r: r),
-            (AsyncQuery(lambda: self.client.query(4, data_sign_in), lambda r: r.check(), wr_setter), lambda r: r)
-        ).run()
+        chain = AsyncQueryChain(
+            (AsyncQuery(lambda: self.client.query(4, data_listen), lambda r: r.check(), _check_result_ok),
+             lambda r: r[-1]),
+            (AsyncQuery(lambda: self.client.query(4, data_sign_in), lambda r: r.check(), wr_setter), lambda r: r[-1]),
+            pipelined=True
+        )
+        chain.error_result = False
+        return chain.run()
 
     def set_want_to_play(self):
         """
@@ -587,7 +657,12 @@ class WaitingRoom:
         def parse_ranking(query):
             if query.response.get('status') == 'ok':
                 ranking = query.response.get('ranking')
-                return [(self.session._make_user(e['id']), e['points']) for e in ranking]
+                result = []
+                for e in ranking:
+                    user = self.session._make_user(e['id'])
+                    user._name = e['username']
+                    result.append((user, e['points']))
+                return result
             else:
                 return None
 
@@ -717,10 +792,68 @@ class Game:
         self.on_your_turn = None   # what to do on your turn (Game -> ())
         self.on_finish = None      # what to do when game is finished (Game -> ())
         self.result = None         # 'won', 'defeated' or 'draw' when game finished
+        self._rules = None
+        self._legal = None         # legal top-left corners for each rotation (computed when needed)
         self.move_board = [[-3 if self.point_board[i][j] == 0 else 0 for j in range(self.height)] for i in range(self.width)]
         self.active_player = 1
         self.player_points = [0, 0]
 
+    @property
+    def move_board(self):
+        """
+        Board of moves (see get_field). It is replaced as a whole, so legal placements are updated then.
+        """
+        return self._move_board
+
+    @move_board.setter
+    def move_board(self, board):
+        self._move_board = board
+        self._legal = None
+
+    @property
+    def rules(self):
+        """
+        Move generator for the pawn and board of the game (see rules.Rules).
+        """
+        if self._rules is None:
+            self._rules = rules_for(self.pawn.data, self.width, self.height)
+        return self._rules
+
+    def _legal_anchors(self):
+        """
+        Gets bitboards of legal top-left corners for each rotation of the pawn.
+        :return: List of 4 bitboards.
+        """
+        if self._legal is None:
+            self._legal = self.rules.legal_anchors_by_rotation(self.rules.board_to_mask(self._move_board))
+        return self._legal
+
+    def is_legal(self, point, pawn):
+        """
+        Checks locally (without asking the server) if the pawn can be put at specified point.
+        :param point: Where to put the pawn (top-left corner).
+        :param pawn: TransformablePawn to put.
+        :return: True if the move is legal.
+        """
+        x, y = point
+        if x < 0 or x >= self.width or y < 0 or y >= self.height:
+            return False
+        return bool((self._legal_anchors()[pawn.rotation] >> (x * self.height + y)) & 1)
+
+    def legal_placements(self):
+        """
+        Lists all legal moves (rotations giving the same shape are listed separately).
+        :return: List of tuples (x, y, rotation).
+        """
+        result = []
+        for rotation, anchors in enumerate(self._legal_anchors()):
+            while anchors:
+                low = anchors & -anchors
+                x, y = divmod(low.bit_length() - 1, self.height)
+                result.append((x, y, rotation))
+                anchors ^= low
+        return result
+
     def get_field(self, x, y):
         """
         Gets information about specific field.
@@ -759,16 +892,76 @@ class Game:
         """
         return self.active_player == self.player_number and not self.is_finished
 
-    def move(self, point, pawn):
+    def move(self, point, pawn, optimistic=False):
         """
         Makes move. It puts pawn (TransformablePawn) at specified point.
         :param point: Where to put the pawn.
         :param pawn: TransformablePawn to put.
+        :param optimistic: If the move should be applied to the boards at once (without waiting for the server).
+        The response of the server replaces them anyway and the move is rolled back if the server rejects it.
         :return: Query which result is if move command succeeded.
         """
         if self.is_finished:
             raise AssertionError("The game was finished!")
-        data = {
+        data = self._move_data(point, pawn)
+        applied = self._apply_move(point, pawn) if optimistic else None
+
+        def result_processor(r):
+            done = self._process_move_response(r.response) if r else False
+            self._reconcile_move(applied, done)
+            return done
+
+        return AsyncQuery(lambda: self.session.client.query(5, data), lambda r: r.check(), result_processor).run()
+
+    def _apply_move(self, point, pawn):
+        """
+        Applies the move locally like the server does: marks fields covered by the pawn and the fields blocked
+        by the move (giving their points to the player).
+        :param point: Where to put the pawn.
+        :param pawn: TransformablePawn to put.
+        :return: Tuple (state before the move, board after the move) or None if the move is illegal.
+        """
+        if not self.is_legal(point, pawn):
+            return None
+        rules = self.rules
+        mask = rules.move_mask(pawn, point)
+        blocked = rules.blocked_by_moves(rules.board_to_mask(self.move_board), [mask])[0]
+        before = self.move_board, self.player_points
+        board = [list(column) for column in self.move_board]
+        points = list(self.player_points)
+        changed = mask | blocked
+        while changed:
+            low = changed & -changed
+            x, y = rules.field(low.bit_length() - 1)
+            if mask & low:
+                board[x][y] = self.player_number
+            else:
+                board[x][y] = -self.player_number
+                points[self.player_number - 1] += self.point_board[x][y]
+            changed ^= low
+        self.move_board = board
+        self.player_points = points
+        return before, board
+
+    def _reconcile_move(self, applied, done):
+        """
+        Rolls back the locally applied move if the server rejected it (boards of accepted moves are already
+        replaced by the ones from the server).
+        :param applied: Result of _apply_move.
+        :param done: If the server accepted the move.
+        """
+        # the board could be replaced in the meantime (e.g. the game was finished)
+        if applied and not done and self.move_board is applied[1]:
+            self.move_board, self.player_points = applied[0]
+
+    def _move_data(self, point, pawn):
+        """
+        Makes query data of the move.
+        :param point: Where to put the pawn.
+        :param pawn: TransformablePawn to put.
+        :return: The data.
+        """
+        return {
             'command': 'move',
             'game-nr': self.gid,
             'player-nr': self.player_number,
@@ -776,27 +969,37 @@ class Game:
             'rotation': pawn.rotation
         }
 
-        def result_processor(r):
-            if r and r.response.get('status') == 'ok':
-                data = r.response
-                if data.get('game-status') == 'opponents-turn':
-                    self.player_points = data['player_points']
-                    self.move_board = data.get('game_move_board')   # TODO - operator [] zamiast get
-                elif data.get('game-status') == 'finished':
-                    # game finished
-                    if data['winner'] == 0:
-                        self.result = 'draw'
-                    elif data['winner'] == self.player_number:
-                        self.result = 'won'
-                    else:
-                        self.result = 'defeated'
-                    self.player_points = data['player_points']
-                    self.move_board = data.get('game_move_board')   # TODO - operator [] zamiast get
-                return True
+    def _process_move_response(self, data):
+        """
+        Updates the game after response to the move.
+        :param data: Response of the server.
+        :return: True if the move was done.
+        """
+        if data.get('status') != 'ok':
+            return False
+        if data.get('game-status') == 'opponents-turn':
+            self.player_points = data['player_points']
+            self.move_board = data.get('game_move_board')   # TODO - operator [] zamiast get
+        elif data.get('game-status') == 'finished':
+            # game finished
+            if data['winner'] == 0:
+                self.result = 'draw'
+            elif data['winner'] == self.player_number:
+                self.result = 'won'
             else:
-                return False
+                self.result = 'defeated'
+            self.player_points = data['player_points']
+            self.move_board = data.get('game_move_board')   # TODO - operator [] zamiast get
+            self._call_handler(self.on_finish)
+        return True
 
-        return AsyncQuery(lambda: self.session.client.query(5, data), lambda r: r.check(), result_processor).run()
+    def _call_handler(self, handler):
+        """
+        Calls handler of game event.
+        :param handler: The handler (function taking the game) or None.
+        """
+        if handler:
+            handler(self)
 
     def abandon(self):
         """
@@ -835,9 +1038,9 @@ class Game:
                 self.result = 'defeated'
             self.player_points = data['player_points']
             self.move_board = data['game_move_board']
+            self._call_handler(self.on_finish)
         elif data.get('notification') == 'your-new-turn':
             # your turn
             self.move_board = data['game_move_board']
             self.player_points = data['player_points']
-            if self.on_your_turn:
-                self.on_your_turn(self)
+            self._call_handler(self.on_your_turn)
@@ -1,10 +1,12 @@
+import errno
 import logging
 import pickle
+import selectors
+import socket
 import struct
 from collections import deque
-
-import sfml as sf
-import sfml.network as net
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
 
 _hello_message_size = 64
 _hello_message = b'dvdyellow hello: '
@@ -14,16 +16,35 @@ _packet_length_size = 4
 
 _logger = logging.getLogger("Network")
 
+_receive_size = 65536
+
+
+def _send_all(sock, data):
+    """
+    Sends all the data (waiting for the socket if it is non-blocking and its buffer is full).
+    :param sock: The socket.
+    :param data: Data to send.
+    """
+    view = memoryview(data)
+    while view:
+        try:
+            view = view[sock.send(view):]
+        except BlockingIOError:
+            with selectors.DefaultSelector() as selector:
+                selector.register(sock, selectors.EVENT_WRITE)
+                selector.select()
+
 
 class Client:
     def __init__(self, api_version, blocking=False):
         self.api_version = api_version
-        self.socket = net.TcpSocket()
-        self.socket.blocking = blocking
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.setblocking(blocking)
         self.notification_handler = dict()
-        self.buffer = b''
-        self.current_packet_size = -1
+        self.buffer = bytearray()   # received data not processed yet
         self.receiving_queries_queue = deque()
+        self.selector = None    # created when the socket is connected
 
     def connect(self, address, port):
         """
@@ -31,10 +52,8 @@ class Client:
         :param address: Network address of the server.
         :param port: Port on which the server runs.
         :return: Temporary object to query if connecting to client succeeded.
+        :raise ConnectionError: (when checking is_connected) If the connection is refused.
         """
-        if isinstance(address, str):
-            address = net.IpAddress.from_string(address)
-
         class Connector:
             """
             Waits for connection to the server and does API version checking
@@ -61,28 +80,45 @@ class Client:
             def is_connected(self):
                 return self._accepted if self._run() else False
 
+            def wait(self, timeout=None):
+                """
+                Waits for the next step of connecting.
+                :param timeout: Maximal time of waiting in seconds (None to wait without limit).
+                """
+                if self.state == 2:
+                    self.client.wait(timeout)
+                elif self.state == 1:
+                    # socket becomes writable when connecting is finished
+                    with selectors.DefaultSelector() as selector:
+                        selector.register(self.client.socket, selectors.EVENT_WRITE)
+                        selector.select(timeout)
+
             def _run(self):
                 """
                 Runs some stuff to check if connected...
                 :return: True if connecting process is finished.
                 """
                 if self.state == 0 or self.state == 1:
-                    try:
-                        self.client.socket.connect(self.address, self.port)
-                    except net.SocketNotReady:
+                    code = self.client.socket.connect_ex((self.address, self.port))
+                    if code in (errno.EINPROGRESS, errno.EALREADY, errno.EWOULDBLOCK):
+                        self.state = 1
                         return False
+                    if code not in (0, errno.EISCONN):
+                        raise ConnectionError(code, "Cannot connect to the server")
                     # connected - send hello message
                     message = (_hello_message + pickle.dumps(self.client.api_version)).ljust(64, b'\x00')
-                    self.client.socket.send(message)
+                    _send_all(self.client.socket, message)
                     self.state = 2
 
                 if self.state == 2:
                     try:
-                        tmp = self.client.socket.receive(self.missing)
-                        self.missing -= len(tmp)
-                        self.buffer += tmp
-                    except net.SocketNotReady:
+                        tmp = self.client.socket.recv(self.missing)
+                    except BlockingIOError:
                         return False
+                    if not tmp:
+                        raise ConnectionResetError("Server closed the connection")
+                    self.missing -= len(tmp)
+                    self.buffer += tmp
 
                     if self.missing > 0:
                         return False
@@ -92,7 +128,7 @@ class Client:
                         self._accepted = True
                     else:
                         self._accepted = False
-                        self.client.socket.disconnect()
+                        self.client.disconnect()
                     self.state = 3
                     return True
 
@@ -108,7 +144,10 @@ class Client:
         """
         Closes connection and frees all the resources.
         """
-        self.socket.disconnect()
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
+        self.socket.close()
 
     def query(self, module, data):
         """
@@ -118,8 +157,7 @@ class Client:
         :return: Temporary object to get the answer for the query.
         """
         msg = pickle.dumps((module, data))
-        self.socket.send(struct.pack('I', len(msg)))
-        self.socket.send(msg)
+        _send_all(self.socket, struct.pack('I', len(msg)) + msg)
 
         class Query:
             def __init__(self, client):
@@ -137,10 +175,23 @@ class Client:
                         return False
                 return True
 
+            def wait(self, timeout=None):
+                """
+                Waits for the response (sleeping until data comes from the server).
+                :param timeout: Maximal time of waiting in seconds (None to wait without limit).
+                :return: True if the response came.
+                """
+                deadline = None if timeout is None else perf_counter() + timeout
+                while not self.check():
+                    remaining = None if deadline is None else deadline - perf_counter()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self.client.wait(remaining)
+                return True
+
             @property
             def response(self):
-                while not self.check():
-                    pass
+                self.wait()
                 return self._response_object
 
             def _set_response(self, value):
@@ -151,27 +202,54 @@ class Client:
         self.receiving_queries_queue.append(qr)
         return qr
 
-    def _receive_to_buffer(self, data_size):
+    def wait(self, timeout=None):
         """
-        Receives data from server.
-        :param data_size: Amount of data to receive.
-        :return: If the data was fully received.
+        Waits until data from the server can be received (the thread sleeps in the meantime).
+        :param timeout: Maximal time of waiting in seconds (None to wait without limit).
+        :return: True if there is data to receive.
         """
-        length = data_size - len(self.buffer)
-        if length > 0:
-            try:
-                received_data = self.socket.receive(length)
-                length -= len(received_data)
-                self.buffer += received_data
-            except net.SocketNotReady:
-                return False
-
-        return length == 0
+        if self._packet_size():
+            return True     # already received
+        if self.selector is None:
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(self.socket, selectors.EVENT_READ)
+        return bool(self.selector.select(timeout))
+
+    def _receive_to_buffer(self):
+        """
+        Receives data waiting in the socket (many packets can be received at once).
+        :return: If any data was received.
+        :raise ConnectionResetError: If the server closed the connection.
+        """
+        try:
+            received_data = self.socket.recv(_receive_size)
+        except BlockingIOError:
+            return False
+        if not received_data:
+            raise ConnectionResetError("Server closed the connection")
+        self.buffer += received_data
+        return True
+
+    def _packet_size(self):
+        """
+        Checks if the first packet in the buffer is complete.
+        :return: Size of the packet with its length or 0 if it is not received yet.
+        """
+        if len(self.buffer) < _packet_length_size:
+            return 0
+        size = _packet_length_size + struct.unpack_from('I', self.buffer)[0]
+        return size if len(self.buffer) >= size else 0
 
-    def _get_buffer(self):
-        msg = self.buffer
-        self.buffer = b''
-        self.current_packet_size = -1
+    def _get_packet(self):
+        """
+        Takes the first complete packet from the buffer.
+        :return: The packet or None if it is not received yet.
+        """
+        size = self._packet_size()
+        if not size:
+            return None
+        msg = bytes(self.buffer[_packet_length_size:size])
+        del self.buffer[:size]
         return msg
 
     def receive(self):
@@ -179,27 +257,23 @@ class Client:
         Processes a notification or response from server.
         :return: If there was something processed.
         """
-        if self.current_packet_size == -1:
-            if self._receive_to_buffer(_packet_length_size):
-                msg = self.buffer
-                self.buffer = b''
-                self.current_packet_size = struct.unpack('I', msg)[0]
-
-        if self.current_packet_size >= 0:
-            if self._receive_to_buffer(self.current_packet_size):
-                msg = self._get_buffer()
-                channel, packet = pickle.loads(msg)
-                if channel > 0:
-                    # notification => run handler
-                    handler = self.notification_handler.get(channel)
-                    if handler:
-                        handler(channel, packet)
-                else:
-                    # put packet to right receiver structure
-                    self.receiving_queries_queue.popleft()._set_response(packet)
-                return True
-
-        return False
+        msg = self._get_packet()
+        if msg is None and self._receive_to_buffer():
+            msg = self._get_packet()
+
+        if msg is None:
+            return False
+
+        channel, packet = pickle.loads(msg)
+        if channel > 0:
+            # notification => run handler
+            handler = self.notification_handler.get(channel)
+            if handler:
+                handler(channel, packet)
+        else:
+            # put packet to right receiver structure
+            self.receiving_queries_queue.popleft()._set_response(packet)
+        return True
 
     def receive_all(self):
         """
@@ -223,12 +297,35 @@ class Client:
         return old
 
 
+class Deferred:
+    """
+    Result of a query handler that is computed in a worker thread of the server.
+    """
+    def __init__(self, work, then=None):
+        """
+        Creates deferred result.
+        :param work: Function called in a worker thread (it should not modify server state).
+        :param then: Function called in the server thread with the result of work, returning the response
+        (or another deferred result). If not set, the result of work is the response.
+        """
+        self.work = work
+        self.then = then
+        self.future = None
+
+
 class _ClientData:
-    def __init__(self, client_id, socket):
+    def __init__(self, client_id, socket, selector, outgoing_limit):
         self.client_id = client_id
         self.socket = socket
+        self.selector = selector
         self.buffer = b''
         self.current_packet_size = -1
+        self.queries = deque()  # received queries waiting for processing
+        self.deferred = None    # deferred result the client is waiting for
+        self.outgoing = bytearray()     # data not sent yet (the socket is non-blocking)
+        self.outgoing_limit = outgoing_limit
+        self.overflowed = False     # if the client did not receive its data in time (it is to be disconnected)
+        self.writing = False    # if the selector waits until the socket is writable
 
     def receive_to_buffer(self, data_size):
         """
@@ -238,7 +335,12 @@ class _ClientData:
         """
         length = data_size - len(self.buffer)
         if length > 0:
-            received_data = self.socket.receive(length)
+            try:
+                received_data = self.socket.recv(length)
+            except BlockingIOError:
+                return False
+            if not received_data:
+                raise ConnectionResetError("Client closed the connection")
             length -= len(received_data)
             self.buffer += received_data
 
@@ -250,12 +352,63 @@ class _ClientData:
         self.current_packet_size = -1
         return msg
 
+    def send(self, channel, data):
+        """
+        Sends a packet to the client.
+        :param channel: Channel of the packet (0 for responses to queries).
+        :param data: Data to be sent.
+        """
+        msg = pickle.dumps((channel, data))
+        self.send_raw(struct.pack('I', len(msg)) + msg)
+
+    def send_raw(self, data):
+        """
+        Sends the data as soon as the client receives it (never waits for the client).
+        If more data than the limit waits for the client, it is marked as overflowed and nothing
+        more is sent to it.
+        :param data: Bytes to be sent.
+        """
+        if self.overflowed:
+            return
+        self.outgoing += data
+        self.flush()
+        if len(self.outgoing) > self.outgoing_limit:
+            self.overflowed = True
+            self.outgoing = bytearray()
+
+    def flush(self):
+        """
+        Sends as much of the waiting data as the socket accepts now, the rest is sent when
+        the selector reports that the socket is writable.
+        """
+        while self.outgoing:
+            try:
+                sent = self.socket.send(self.outgoing)
+            except BlockingIOError:
+                break
+            del self.outgoing[:sent]
+        writing = bool(self.outgoing)
+        if writing != self.writing:
+            self.writing = writing
+            self.selector.modify(self.socket, selectors.EVENT_READ | (selectors.EVENT_WRITE if writing else 0))
+
 
 class Server:
-    def __init__(self, api_version_checker):
+    def __init__(self, api_version_checker, workers=4, outgoing_limit=1 << 24):
+        """
+        Creates server.
+        :param api_version_checker: Function checking if client API version is supported.
+        :param workers: Number of worker threads computing deferred results of query handlers.
+        :param outgoing_limit: Number of bytes which can wait for a client - clients receiving
+        slower than the server sends are disconnected when they have more data waiting.
+        """
         self.api_version_checker = api_version_checker
-        self.listener = net.TcpListener()
-        self.selector = net.SocketSelector()
+        self.workers = workers
+        self.outgoing_limit = outgoing_limit
+        self.executor = None
+        self.listener = None
+        self.selector = None
+        self.wakeup_sockets = None  # pair of sockets waking up the server thread (receiving and sending one)
         self.working = False
         self.query_handlers = dict()
         self.accept_handler = None
@@ -264,6 +417,7 @@ class Server:
 
         self.clients = dict()
         self.unaccepted = dict()
+        self.deferred_clients = set()
 
         def seq_id_generator(start):
             while True:
@@ -277,22 +431,131 @@ class Server:
         :param address: Network address specifying interface.
         :param port: Port number.
         """
-        if isinstance(address, str):
-            address = net.IpAddress.from_string(address)
-
-        self.listener.listen(port)
-        self.selector.add(self.listener)
+        # like before, the server listens on all interfaces
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('', port))
+        self.listener.listen(socket.SOMAXCONN)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.wakeup_sockets = socket.socketpair()
+        for sock in self.wakeup_sockets:
+            sock.setblocking(False)
+        self.selector.register(self.wakeup_sockets[0], selectors.EVENT_READ)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
         self.working = True
-        self._work()
-        self._disconnect_all()
+        try:
+            self._work()
+        finally:
+            self._disconnect_all()
+            self.selector.close()
+            self.listener.close()
+            for sock in self.wakeup_sockets:
+                sock.close()
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    def _process_queries(self, client_id, data):
+        """
+        Processes received queries of the client (stops on the first deferred result,
+        so the queries of one client are always processed and answered in order).
+        :param client_id: The client.
+        :param data: Client's connection data.
+        """
+        while data.deferred is None and data.queries:
+            module, packet = data.queries.popleft()
+            handler = self.query_handlers.get(module)
+            if handler and (not self.permission_checker or self.permission_checker(client_id, module)):
+                result = handler(client_id, packet)
+            else:
+                result = None
+            self._respond(client_id, data, result)
+
+    def _respond(self, client_id, data, result):
+        """
+        Sends response to the query or starts computing it if it is deferred.
+        :param client_id: The client.
+        :param data: Client's connection data.
+        :param result: Result of query handler.
+        """
+        if isinstance(result, Deferred):
+            result.future = self.executor.submit(result.work)
+            result.future.add_done_callback(self._wake_up)
+            data.deferred = result
+            self.deferred_clients.add(client_id)
+        else:
+            # channel 0 => response to query
+            data.send(0, result)
+
+    def _process_deferred(self):
+        """
+        Sends responses for completed deferred results.
+        """
+        for client_id in list(self.deferred_clients):
+            data = self.clients.get(client_id)
+            if not data:
+                # client disconnected - nobody waits for the result
+                self.deferred_clients.discard(client_id)
+                continue
+            deferred = data.deferred
+            if not deferred.future.done():
+                continue
+            self.deferred_clients.discard(client_id)
+            data.deferred = None
+            try:
+                result = deferred.future.result()
+                if deferred.then:
+                    result = deferred.then(result)
+            except Exception:
+                _logger.exception("Deferred query of client %s failed", client_id)
+                # clients expect a dictionary with status
+                result = {'status': 'error', 'code': 'INTERNAL_ERROR'}
+            try:
+                self._respond(client_id, data, result)
+                self._process_queries(client_id, data)
+            except ConnectionError:
+                pass    # will be noticed by receiving
+
+    def _wake_up(self, future=None):
+        """
+        Makes the server thread stop waiting for network events (can be called from any thread).
+        :param future: Completed future (when used as its callback).
+        """
+        try:
+            self.wakeup_sockets[1].send(b'\x00')
+        except OSError:
+            pass    # already woken up (the buffer is full) or the server is closed
+
+    def _remove_socket(self, sock):
+        """
+        Stops watching the socket and closes it.
+        :param sock: Socket of a client.
+        """
+        self.selector.unregister(sock)
+        sock.close()
 
     def _work(self):
         while self.working:
-            if self.selector.wait(sf.milliseconds(100)):
+            self._process_deferred()
+            # completed deferred results and closing wake the server up
+            events = self.selector.select(0.1)
+            if events:
+                ready = {key.fileobj: mask for key, mask in events}
+                if self.wakeup_sockets[0] in ready:
+                    try:
+                        while self.wakeup_sockets[0].recv(_receive_size):
+                            pass
+                    except BlockingIOError:
+                        pass
                 clients_to_remove = set()
                 unaccepted_to_remove = set()
                 for client_id, data in self.clients.items():
-                    if self.selector.is_ready(data.socket):
+                    if ready.get(data.socket, 0) & selectors.EVENT_WRITE:
+                        try:
+                            data.flush()
+                        except ConnectionError:
+                            pass    # will be noticed by receiving
+                    if ready.get(data.socket, 0) & selectors.EVENT_READ:
                         try:
                             if data.current_packet_size == -1:
                                 if data.receive_to_buffer(_packet_length_size):
@@ -302,27 +565,16 @@ class Server:
                             else:
                                 if data.receive_to_buffer(data.current_packet_size):
                                     msg = data.get_buffer()
-                                    module, packet = pickle.loads(msg)
-                                    handler = self.query_handlers.get(module)
-                                    if handler and \
-                                            (not self.permission_checker or self.permission_checker(client_id, module)):
-                                        result = handler(client_id, packet)
-                                    else:
-                                        result = None
-                                    # send result
-                                    # channel 0 => response to query
-                                    msg = pickle.dumps((0, result))
-                                    data.socket.send(struct.pack('I', len(msg)))
-                                    data.socket.send(msg)
-                                    data.current_packet_size = -1
-                        except net.SocketDisconnected:
+                                    data.queries.append(pickle.loads(msg))
+                                    self._process_queries(client_id, data)
+                        except ConnectionError:
                             if self.disconnect_handler:
                                 self.disconnect_handler(client_id)
-                            self.selector.remove(data.socket)
+                            self._remove_socket(data.socket)
                             clients_to_remove.add(client_id)
 
                 for client_id, data in self.unaccepted.items():
-                    if self.selector.is_ready(data.socket):
+                    if ready.get(data.socket, 0) & selectors.EVENT_READ:
                         try:
                             if data.receive_to_buffer(_hello_message_size):
                                 msg = data.get_buffer()
@@ -330,26 +582,23 @@ class Server:
                                     try:
                                         api_version = int(pickle.loads(msg[len(_hello_message):]))
                                         if self.api_version_checker(api_version):
-                                            data.socket.send(_accept_message.ljust(_hello_message_size, b'\x00'))
+                                            data.send_raw(_accept_message.ljust(_hello_message_size, b'\x00'))
                                             self.clients[client_id] = data
                                             data.current_packet_size = -1
                                             unaccepted_to_remove.add(client_id)
                                             if self.accept_handler:
                                                 self.accept_handler(client_id)
                                         else:
-                                            data.socket.disconnect()
-                                            self.selector.remove(data.socket)
+                                            self._remove_socket(data.socket)
                                             unaccepted_to_remove.add(client_id)
                                     except TypeError:
-                                        data.socket.disconnect()
-                                        self.selector.remove(data.socket)
+                                        self._remove_socket(data.socket)
                                         unaccepted_to_remove.add(client_id)
                                 else:
-                                    data.socket.disconnect()
-                                    self.selector.remove(data.socket)
+                                    self._remove_socket(data.socket)
                                     unaccepted_to_remove.add(client_id)
-                        except net.SocketDisconnected:
-                            self.selector.remove(data.socket)
+                        except ConnectionError:
+                            self._remove_socket(data.socket)
                             unaccepted_to_remove.add(client_id)
 
                 for client_id in clients_to_remove:
@@ -358,24 +607,49 @@ class Server:
                 for client_id in unaccepted_to_remove:
                     del self.unaccepted[client_id]
 
-                if self.selector.is_ready(self.listener):
-                    socket = self.listener.accept()
+                if self.listener in ready:
+                    sock, _ = self.listener.accept()
+                    # the server never waits for a single client
+                    sock.setblocking(False)
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
                     client_id = next(self.id_generator)
-                    self.unaccepted[client_id] = _ClientData(client_id, socket)
-                    self.selector.add(socket)
+                    self.unaccepted[client_id] = _ClientData(client_id, sock, self.selector, self.outgoing_limit)
+                    self.selector.register(sock, selectors.EVENT_READ)
+            self._disconnect_overflowed()
+
+    def _disconnect_overflowed(self):
+        """
+        Disconnects clients which did not receive data sent to them in time (see _ClientData.send_raw).
+        """
+        while True:
+            # disconnect handlers may send data to other clients
+            overflowed = [(client_id, data) for client_id, data in self.clients.items() if data.overflowed]
+            if not overflowed:
+                break
+            for client_id, data in overflowed:
+                _logger.warning("Client %s does not receive data in time - disconnecting it", client_id)
+                if self.disconnect_handler:
+                    self.disconnect_handler(client_id)
+                self._remove_socket(data.socket)
+                del self.clients[client_id]
 
     def _disconnect_all(self):
         for client_id, data in self.clients.items():
-            self.selector.remove(data.socket)
-            data.socket.disconnect()
+            self._remove_socket(data.socket)
+        for client_id, data in self.unaccepted.items():
+            self._remove_socket(data.socket)
 
         self.clients.clear()
+        self.unaccepted.clear()
+        self.deferred_clients.clear()
 
     def close(self):
         """
         Stops listening and frees resources.
         """
         self.working = False
+        if self.wakeup_sockets is not None:
+            self._wake_up()
 
     def set_accept_handler(self, func):
         """
@@ -415,13 +689,13 @@ class Server:
         :param channel: Channel by which send the notification.
         :param data: Data to be sent.
         """
-        # send result
-        msg = pickle.dumps((channel, data))
         client_data = self.clients.get(client_id)
         if not client_data:
             return      # notifying not existing client
-        client_data.socket.send(struct.pack('I', len(msg)))
-        client_data.socket.send(msg)
+        try:
+            client_data.send(channel, data)
+        except ConnectionError:
+            pass    # will be noticed by receiving
 
     def set_permission_checker(self, func):
         """
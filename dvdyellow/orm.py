@@ -1,9 +1,21 @@
 """
 Here will be classes stored in database.
 """
+import random
+from contextlib import contextmanager
+from threading import RLock
 
+from sqlalchemy.engine import create_engine
+from sqlalchemy.engine.url import URL
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext import baked
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, Float, ForeignKey
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, bindparam, desc, event, func
+from sqlalchemy.orm.session import sessionmaker
+from sqlalchemy.pool import QueuePool, StaticPool
+from sqlalchemy.util import LRUCache
+
+from .repository import Repository, UnitOfWork, ConstraintError
 
 Database = declarative_base()
 
@@ -61,4 +73,185 @@ class GamePawn(Database):
 
 
 def create_schemes(engine):
-    Database.metadata.create_all(engine)
\ No newline at end of file
+    Database.metadata.create_all(engine)
+
+
+#
+# Prepared queries for hot paths - compiled once and then reused
+#
+_bakery = baked.bakery()
+_compiled_cache = LRUCache(64)
+_insert_game_result = GameResult.__table__.insert()
+
+
+def get_user_by_name(db_session, name):
+    """
+    Finds user with specified name.
+    :param db_session: Database session.
+    :param name: User's name.
+    :return: User object or None if there is no such user.
+    """
+    query = _bakery(lambda s: s.query(User))
+    query += lambda q: q.filter(User.name == bindparam('name'))
+    return query(db_session).params(name=name).first()
+
+
+def get_user_by_id(db_session, uid):
+    """
+    Finds user with specified ID.
+    :param db_session: Database session.
+    :param uid: User's ID.
+    :return: User object or None if there is no such user.
+    """
+    query = _bakery(lambda s: s.query(User))
+    query += lambda q: q.filter(User.id == bindparam('uid'))
+    return query(db_session).params(uid=uid).first()
+
+
+def add_game_result(db_session, player1, points1, player2, points2, winner):
+    """
+    Stores result of a finished game.
+    :param db_session: Database session.
+    :param player1: ID of the first player.
+    :param points1: Points of the first player.
+    :param player2: ID of the second player.
+    :param points2: Points of the second player.
+    :param winner: Number of the winner (0 if draw).
+    """
+    connection = db_session.connection().execution_options(compiled_cache=_compiled_cache)
+    connection.execute(_insert_game_result, player1=player1, points1=points1, player2=player2, points2=points2,
+                       winner=winner)
+
+
+class SqlRepository(Repository):
+    """
+    Repository storing data in a database through SQLAlchemy.
+    """
+    def __init__(self, url_options, pool_options=None, sqlite_pragmas=None):
+        """
+        Connects to the database (and creates tables if needed).
+        :param url_options: Parts of database URL (drivername, username, password, host, port, database, query).
+        :param pool_options: Options of connection pool (pool_size, max_overflow, pool_recycle, pool_timeout).
+        :param sqlite_pragmas: Pragmas set on every SQLite connection (name -> value).
+        """
+        self.url = URL(**url_options)
+        self.sqlite_pragmas = sqlite_pragmas or dict()
+        self.lock = None
+
+        engine_options = dict()
+        if self.url.drivername.startswith('sqlite'):
+            # pooled sqlite connections are handed over between threads
+            engine_options['connect_args'] = {'check_same_thread': False}
+            if self.url.database in (None, '', ':memory:'):
+                # in-memory database exists only within its connection, so everybody has to share it
+                # and units of work have to be run one after another
+                engine_options['poolclass'] = StaticPool
+                self.lock = RLock()
+            else:
+                engine_options['poolclass'] = QueuePool
+
+        if engine_options.get('poolclass') is not StaticPool and pool_options:
+            engine_options.update(pool_options)
+
+        self.engine = create_engine(self.url, **engine_options)
+        if self.url.drivername.startswith('sqlite') and self.sqlite_pragmas:
+            event.listen(self.engine, 'connect', self._apply_sqlite_pragmas)
+        create_schemes(self.engine)
+
+        self.session_type = sessionmaker(bind=self.engine)
+
+    def _apply_sqlite_pragmas(self, dbapi_connection, connection_record):
+        """
+        Configures new SQLite connection.
+        """
+        cursor = dbapi_connection.cursor()
+        for pragma, value in self.sqlite_pragmas.items():
+            cursor.execute('PRAGMA {} = {}'.format(pragma, value))
+        cursor.close()
+
+    @contextmanager
+    def unit_of_work(self):
+        """
+        Creates database session for the unit of work.
+        Session is committed when the unit of work ends, rolled back on errors and always closed,
+        so no objects are kept in memory between units of work.
+        """
+        if self.lock:
+            self.lock.acquire()
+        db_session = self.session_type()
+        try:
+            yield _SqlUnitOfWork(db_session)
+            db_session.commit()
+        except IntegrityError as e:
+            db_session.rollback()
+            raise ConstraintError(str(e))
+        except BaseException:
+            db_session.rollback()
+            raise
+        finally:
+            db_session.close()
+            if self.lock:
+                self.lock.release()
+
+    def close(self):
+        self.engine.dispose()
+
+
+class _SqlUnitOfWork(UnitOfWork):
+    def __init__(self, db_session):
+        self.db_session = db_session
+
+    def get_user_by_name(self, name):
+        return get_user_by_name(self.db_session, name)
+
+    def get_user_by_id(self, uid):
+        return get_user_by_id(self.db_session, uid)
+
+    def get_users(self, uids):
+        uids = set(uids)
+        if not uids:
+            return []
+        return self.db_session.query(User).filter(User.id.in_(uids)).all()
+
+    def get_users_by_ranking(self):
+        return self.db_session.query(User).order_by(desc(User.ranking)).all()
+
+    def add_user(self, name, password, ranking=0):
+        self.db_session.add(User(name=name, password=password, ranking=ranking))
+        self.db_session.flush()
+
+    def add_to_ranking(self, uid, delta):
+        # changed in the database (not read and written back), so concurrent games of the user are counted
+        self.db_session.query(User).filter(User.id == uid).update(
+            {User.ranking: func.coalesce(User.ranking, 0) + delta}, synchronize_session=False)
+
+    def get_game_results(self, player1=None, player2=None):
+        query = self.db_session.query(GameResult)
+        if player1 is not None:
+            query = query.filter(GameResult.player1 == player1)
+        if player2 is not None:
+            query = query.filter(GameResult.player2 == player2)
+        return query.all()
+
+    def add_game_result(self, player1, points1, player2, points2, winner):
+        add_game_result(self.db_session, player1, points1, player2, points2, winner)
+
+    def get_random_board(self):
+        return self._get_random(GameBoard)
+
+    def add_board(self, name, width, height, shapestring, author_name=None):
+        self.db_session.add(GameBoard(name=name, width=width, height=height, shapestring=shapestring,
+                                      author_name=author_name))
+        self.db_session.flush()
+
+    def get_random_pawn(self):
+        return self._get_random(GamePawn)
+
+    def add_pawn(self, name, width, height, shapestring, author_name=None):
+        self.db_session.add(GamePawn(name=name, width=width, height=height, shapestring=shapestring,
+                                     author_name=author_name))
+        self.db_session.flush()
+
+    def _get_random(self, cls):
+        objects = self.db_session.query(cls)
+        return objects.offset(int(objects.count() * random.random())).first()
@@ -0,0 +1,253 @@
+"""
+Storage of server data (users, results of games, boards and pawns).
+
+The server uses the data through a repository, so the storage can be changed
+in configuration. SQLAlchemy implementation is in orm module, here is the interface
+and the in-memory implementation (which does not need any database).
+"""
+import random
+from contextlib import contextmanager
+from threading import RLock
+
+
+class ConstraintError(Exception):
+    """
+    Raised when a change would break some constraint of stored data (e.g. duplicated user name).
+    """
+    pass
+
+
+class Repository:
+    """
+    Interface of the storage used by the server.
+    """
+    def unit_of_work(self):
+        """
+        Starts unit of work - all the operations on the data are done within some unit of work.
+        Objects returned by the unit of work can be modified only before it ends.
+        :return: Context manager returning UnitOfWork object.
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        """
+        Frees resources used by the repository.
+        """
+        pass
+
+
+class UnitOfWork:
+    """
+    Interface of operations done within a unit of work.
+    """
+    def get_user_by_name(self, name):
+        """
+        Finds user with specified name.
+        :param name: User's name.
+        :return: User object or None if there is no such user.
+        """
+        raise NotImplementedError()
+
+    def get_user_by_id(self, uid):
+        """
+        Finds user with specified ID.
+        :param uid: User's ID.
+        :return: User object or None if there is no such user.
+        """
+        raise NotImplementedError()
+
+    def get_users(self, uids):
+        """
+        Finds users with specified IDs (IDs of non-existing users are skipped).
+        :param uids: Iterable of users' IDs.
+        :return: List of user objects.
+        """
+        raise NotImplementedError()
+
+    def get_users_by_ranking(self):
+        """
+        Returns all users ordered by ranking (the best one first).
+        :return: List of user objects.
+        """
+        raise NotImplementedError()
+
+    def add_user(self, name, password, ranking=0):
+        """
+        Adds new user.
+        :param name: User's name (must be unique).
+        :param password: User's password.
+        :param ranking: User's ranking.
+        """
+        raise NotImplementedError()
+
+    def add_to_ranking(self, uid, delta):
+        """
+        Changes user's ranking by the value (atomically, so concurrent changes are not lost).
+        :param uid: User's ID.
+        :param delta: Value added to the ranking (user without ranking gets it as the ranking).
+        """
+        raise NotImplementedError()
+
+    def get_game_results(self, player1=None, player2=None):
+        """
+        Returns results of finished games.
+        :param player1: ID of the first player (or None for any player).
+        :param player2: ID of the second player (or None for any player).
+        :return: List of game result objects.
+        """
+        raise NotImplementedError()
+
+    def add_game_result(self, player1, points1, player2, points2, winner):
+        """
+        Stores result of a finished game.
+        :param player1: ID of the first player.
+        :param points1: Points of the first player.
+        :param player2: ID of the second player.
+        :param points2: Points of the second player.
+        :param winner: Number of the winner (0 if draw).
+        """
+        raise NotImplementedError()
+
+    def get_random_board(self):
+        """
+        Returns randomly chosen game board.
+        :return: Game board object or None if there are no boards.
+        """
+        raise NotImplementedError()
+
+    def add_board(self, name, width, height, shapestring, author_name=None):
+        """
+        Adds new game board.
+        :param name: Name of the board (must be unique).
+        :param width: Width of the board.
+        :param height: Height of the board.
+        :param shapestring: Fields of the board (row by row, '1' for existing field).
+        :param author_name: Author of the board.
+        """
+        raise NotImplementedError()
+
+    def get_random_pawn(self):
+        """
+        Returns randomly chosen game pawn.
+        :return: Game pawn object or None if there are no pawns.
+        """
+        raise NotImplementedError()
+
+    def add_pawn(self, name, width, height, shapestring, author_name=None):
+        """
+        Adds new game pawn.
+        :param name: Name of the pawn (must be unique).
+        :param width: Width of the pawn.
+        :param height: Height of the pawn.
+        :param shapestring: Fields of the pawn (row by row, '1' for field belonging to the pawn).
+        :param author_name: Author of the pawn.
+        """
+        raise NotImplementedError()
+
+
+class UserRecord:
+    def __init__(self, uid, name, password, ranking):
+        self.id = uid
+        self.name = name
+        self.password = password
+        self.ranking = ranking
+
+
+class GameResultRecord:
+    def __init__(self, rid, player1, points1, player2, points2, winner):
+        self.id = rid
+        self.player1 = player1
+        self.points1 = points1
+        self.player2 = player2
+        self.points2 = points2
+        self.winner = winner
+
+
+class ShapeRecord:
+    """
+    Game board or game pawn.
+    """
+    def __init__(self, sid, name, width, height, shapestring, author_name):
+        self.id = sid
+        self.name = name
+        self.author_name = author_name
+        self.width = width
+        self.height = height
+        self.shapestring = shapestring
+
+
+class MemoryRepository(Repository):
+    """
+    Repository storing everything in memory (data is lost when server stops).
+    Units of work are run one after another and their changes are not rolled back on errors.
+    """
+    def __init__(self):
+        self.lock = RLock()
+        self.users = dict()         # id -> user
+        self.user_names = dict()    # name -> user
+        self.game_results = []
+        self.boards = []
+        self.pawns = []
+
+    @contextmanager
+    def unit_of_work(self):
+        with self.lock:
+            yield _MemoryUnitOfWork(self)
+
+
+class _MemoryUnitOfWork(UnitOfWork):
+    def __init__(self, repository):
+        self.repository = repository
+
+    def get_user_by_name(self, name):
+        return self.repository.user_names.get(name)
+
+    def get_user_by_id(self, uid):
+        return self.repository.users.get(uid)
+
+    def get_users(self, uids):
+        return [self.repository.users[uid] for uid in set(uids) if uid in self.repository.users]
+
+    def get_users_by_ranking(self):
+        # users without ranking are the last ones (like NULLs in database)
+        return sorted(self.repository.users.values(), key=lambda u: (u.ranking is not None, u.ranking or 0),
+                      reverse=True)
+
+    def add_user(self, name, password, ranking=0):
+        if name in self.repository.user_names:
+            raise ConstraintError("User '{}' already exists".format(name))
+        user = UserRecord(len(self.repository.users) + 1, name, password, ranking)
+        self.repository.users[user.id] = user
+        self.repository.user_names[name] = user
+
+    def add_to_ranking(self, uid, delta):
+        # units of work are run one after another, so nobody changes the ranking in the meantime
+        user = self.repository.users.get(uid)
+        if user is not None:
+            user.ranking = (user.ranking or 0) + delta
+
+    def get_game_results(self, player1=None, player2=None):
+        return [r for r in self.repository.game_results
+                if (player1 is None or r.player1 == player1) and (player2 is None or r.player2 == player2)]
+
+    def add_game_result(self, player1, points1, player2, points2, winner):
+        results = self.repository.game_results
+        results.append(GameResultRecord(len(results) + 1, player1, points1, player2, points2, winner))
+
+    def get_random_board(self):
+        return random.choice(self.repository.boards) if self.repository.boards else None
+
+    def add_board(self, name, width, height, shapestring, author_name=None):
+        self._add_shape(self.repository.boards, name, width, height, shapestring, author_name)
+
+    def get_random_pawn(self):
+        return random.choice(self.repository.pawns) if self.repository.pawns else None
+
+    def add_pawn(self, name, width, height, shapestring, author_name=None):
+        self._add_shape(self.repository.pawns, name, width, height, shapestring, author_name)
+
+    @staticmethod
+    def _add_shape(shapes, name, width, height, shapestring, author_name):
+        if any(s.name == name for s in shapes):
+            raise ConstraintError("Shape '{}' already exists".format(name))
+        shapes.append(ShapeRecord(len(shapes) + 1, name, width, height, shapestring, author_name))
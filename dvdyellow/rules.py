@@ -0,0 +1,321 @@
+"""
+Rules of the game computed on bitboards.
+
+Board of width W and height H is represented as Python int, field (x, y) is bit number x * H + y.
+Thanks to this all placements of a pawn orientation can be checked at once with few shifts and ANDs.
+"""
+from functools import lru_cache
+
+
+def _rotate_clockwise(data):
+    """
+    Rotates pawn the same way as TransformablePawn.rotate_clockwise does.
+    :param data: Pawn as list of columns (data[x][y] is True when (x, y) belongs to the pawn).
+    :return: Rotated pawn (tuple of columns).
+    """
+    width, height = len(data), len(data[0])
+    return tuple(tuple(bool(data[y][height - x - 1]) for y in range(width)) for x in range(height))
+
+
+class _Orientation:
+    """
+    One of the (distinct) rotations of the pawn.
+    """
+    def __init__(self, rotation, data, board_height):
+        self.rotation = rotation
+        self.width = len(data)
+        self.height = len(data[0])
+        # shifts of the pawn's fields relatively to its top-left corner
+        self.offsets = [x * board_height + y for x in range(self.width) for y in range(self.height) if data[x][y]]
+        self.mask = 0
+        for offset in self.offsets:
+            self.mask |= 1 << offset
+        self.anchors = 0    # positions where the pawn fits into the board (ignoring occupied fields)
+
+
+class Rules:
+    """
+    Move generator for the given pawn and board size.
+    """
+    def __init__(self, pawn_data, width, height):
+        """
+        Creates move generator (use rules_for to get a cached one).
+        :param pawn_data: Pawn as list of columns (data[x][y] is True when (x, y) belongs to the pawn).
+        :param width: Width of the board.
+        :param height: Height of the board.
+        """
+        self.width = width
+        self.height = height
+        self.full = (1 << (width * height)) - 1
+        self.pawn_size = sum(1 for column in pawn_data for v in column if v)
+
+        self.orientations = []
+        self.by_rotation = []   # orientation used for each rotation (None if the pawn does not fit)
+        seen = dict()
+        data = tuple(tuple(bool(v) for v in column) for column in pawn_data)
+        self.pawn_data = data
+        for rotation in range(4):
+            # symmetric pawns have some orientations equal - they give the same moves
+            if data not in seen:
+                seen[data] = None
+                if any(any(column) for column in data):
+                    orientation = _Orientation(rotation, data, height)
+                    if orientation.width <= width and orientation.height <= height:
+                        column = ((1 << (height - orientation.height + 1)) - 1)
+                        for x in range(width - orientation.width + 1):
+                            orientation.anchors |= column << (x * height)
+                        self.orientations.append(orientation)
+                        seen[data] = orientation
+            self.by_rotation.append(seen[data])
+            data = _rotate_clockwise(data)
+
+    def board_to_mask(self, board):
+        """
+        Converts board to bitboard.
+        :param board: Game board (list of columns), non-zero fields are taken as occupied.
+        :return: Bitboard of occupied fields.
+        """
+        mask = 0
+        for x, column in enumerate(board):
+            for y, value in enumerate(column):
+                if value != 0:
+                    mask |= 1 << (x * self.height + y)
+        return mask
+
+    def mask_to_board(self, mask):
+        """
+        Converts bitboard to board.
+        :param mask: Bitboard of occupied fields.
+        :return: Board (list of columns) with 1 on occupied fields and 0 on free ones.
+        """
+        return [[(mask >> (x * self.height + y)) & 1 for y in range(self.height)] for x in range(self.width)]
+
+    def field(self, bit):
+        """
+        Converts bit number to field coordinates.
+        :param bit: Bit number.
+        :return: Tuple (x, y).
+        """
+        return divmod(bit, self.height)
+
+    def legal_anchors(self, occupied):
+        """
+        Finds all legal placements of the pawn.
+        :param occupied: Bitboard of occupied fields.
+        :return: List of pairs (orientation, bitboard of legal top-left corners).
+        """
+        free = self.full & ~occupied
+        result = []
+        for orientation in self.orientations:
+            anchors = orientation.anchors
+            for offset in orientation.offsets:
+                anchors &= free >> offset
+                if not anchors:
+                    break
+            result.append((orientation, anchors))
+        return result
+
+    def legal_anchors_by_rotation(self, occupied):
+        """
+        Finds legal placements for every rotation of the pawn (rotations giving the same shape share them).
+        :param occupied: Bitboard of occupied fields.
+        :return: List of 4 bitboards of legal top-left corners (indexed by rotation).
+        """
+        legal = {id(orientation): anchors for orientation, anchors in self.legal_anchors(occupied)}
+        return [legal[id(orientation)] if orientation else 0 for orientation in self.by_rotation]
+
+    def legal_moves(self, occupied):
+        """
+        Enumerates all legal moves.
+        :param occupied: Bitboard of occupied fields.
+        :return: List of tuples (x, y, rotation, mask) - mask is the bitboard of fields covered by the move.
+        """
+        moves = []
+        for orientation, anchors in self.legal_anchors(occupied):
+            while anchors:
+                low = anchors & -anchors
+                bit = low.bit_length() - 1
+                x, y = divmod(bit, self.height)
+                moves.append((x, y, orientation.rotation, orientation.mask << bit))
+                anchors ^= low
+        return moves
+
+    def covered(self, occupied):
+        """
+        Finds fields which can still be covered by some legal move.
+        :param occupied: Bitboard of occupied fields.
+        :return: Bitboard of coverable fields.
+        """
+        cover = 0
+        for orientation, anchors in self.legal_anchors(occupied):
+            if anchors:
+                for offset in orientation.offsets:
+                    cover |= anchors << offset
+        return cover
+
+    def blocked(self, occupied):
+        """
+        Finds free fields which cannot be covered by any legal move.
+        :param occupied: Bitboard of occupied fields.
+        :return: Bitboard of blocked fields.
+        """
+        return self.full & ~occupied & ~self.covered(occupied)
+
+    def point_values(self, point_board):
+        """
+        Converts point board to list indexed by bit numbers.
+        :param point_board: Points of the fields (list of columns).
+        :return: List of points of the fields.
+        """
+        values = [0] * (self.width * self.height)
+        for x, column in enumerate(point_board):
+            for y, value in enumerate(column):
+                values[x * self.height + y] = value
+        return values
+
+    @staticmethod
+    def sum_points(mask, values):
+        """
+        Sums points of the fields.
+        :param mask: Bitboard of the fields.
+        :param values: Points of the fields (see point_values).
+        :return: Sum of the points.
+        """
+        result = 0
+        while mask:
+            low = mask & -mask
+            result += values[low.bit_length() - 1]
+            mask ^= low
+        return result
+
+    def blocked_by_moves(self, occupied, move_masks):
+        """
+        Finds fields blocked by each of the moves (free fields which no legal move can cover after it).
+        Legal placements are found once and then every move only removes placements it collides with.
+        :param occupied: Bitboard of occupied fields.
+        :param move_masks: Iterable of bitboards of fields covered by the moves.
+        :return: List of bitboards of blocked fields (in the same order as the moves).
+        """
+        legal = [(orientation.offsets, anchors) for orientation, anchors in self.legal_anchors(occupied) if anchors]
+        free = self.full & ~occupied
+        result = []
+        for move in move_masks:
+            cover = 0
+            for offsets, anchors in legal:
+                # placements colliding with the move are no longer legal
+                for offset in offsets:
+                    anchors &= ~(move >> offset)
+                    if not anchors:
+                        break
+                else:
+                    for offset in offsets:
+                        cover |= anchors << offset
+            result.append(free & ~move & ~cover)
+        return result
+
+    def evaluate_moves(self, occupied, move_masks, values):
+        """
+        Computes points for the fields blocked by each of the moves.
+        :param occupied: Bitboard of occupied fields.
+        :param move_masks: Iterable of bitboards of fields covered by the moves.
+        :param values: Points of the fields (see point_values).
+        :return: List of points (in the same order as the moves).
+        """
+        return [self.sum_points(blocked, values) for blocked in self.blocked_by_moves(occupied, move_masks)]
+
+    def playout(self, occupied, values, generator):
+        """
+        Plays the game till the end with random moves.
+        :param occupied: Bitboard of occupied fields (blocked fields must be already occupied).
+        :param values: Points of the fields (see point_values).
+        :param generator: Random number generator (random.Random object).
+        :return: Tuple (point difference for the player to move, number of moves done).
+        """
+        full = self.full
+        orientations = [(o.mask, o.offsets, o.anchors) for o in self.orientations]
+        difference = 0
+        sign = 1    # 1 if the player to move is the one who started the playout
+        moves = 0
+        while True:
+            free = full & ~occupied
+            legal = []
+            total = 0
+            for mask, offsets, anchors in orientations:
+                for offset in offsets:
+                    anchors &= free >> offset
+                    if not anchors:
+                        break
+                else:
+                    count = bin(anchors).count('1')
+                    legal.append((mask, offsets, anchors, count))
+                    total += count
+
+            if moves:
+                # fields which cannot be covered now are blocked by the previous move
+                cover = 0
+                for mask, offsets, anchors, count in legal:
+                    for offset in offsets:
+                        cover |= anchors << offset
+                blocked = free & ~cover
+                if blocked:
+                    difference -= sign * self.sum_points(blocked, values)
+                    occupied |= blocked
+
+            if not total:
+                return difference, moves
+
+            # orientation is chosen proportionally to the number of its placements, then
+            # the placement is the first one from a random position (which is cheap, but not uniform)
+            k = generator.randrange(total)
+            for mask, offsets, anchors, count in legal:
+                if k < count:
+                    break
+                k -= count
+            start = generator.randrange(anchors.bit_length())
+            rest = anchors >> start
+            if rest:
+                bit = start + (rest & -rest).bit_length() - 1
+            else:
+                bit = (anchors & -anchors).bit_length() - 1
+            occupied |= mask << bit
+            sign = -sign
+            moves += 1
+
+    def move_mask(self, pawn, point):
+        """
+        Computes bitboard of fields covered by the pawn.
+        :param pawn: Pawn (object with width, height and get_pawn_point like TransformablePawn).
+        :param point: Position of top-left corner of the pawn.
+        :return: Bitboard of fields covered by the pawn.
+        """
+        x, y = point
+        mask = 0
+        for ix in range(pawn.width):
+            for iy in range(pawn.height):
+                if pawn.get_pawn_point(ix, iy):
+                    mask |= 1 << ((x + ix) * self.height + y + iy)
+        return mask
+
+    def has_legal_move(self, occupied):
+        """
+        Checks if any move is possible.
+        :param occupied: Bitboard of occupied fields.
+        :return: True if there is at least one legal move.
+        """
+        return any(anchors for _, anchors in self.legal_anchors(occupied))
+
+
+@lru_cache(maxsize=32)
+def _cached_rules(pawn_data, width, height):
+    return Rules(pawn_data, width, height)
+
+
+def rules_for(pawn_data, width, height):
+    """
+    Returns move generator for the given pawn and board size (generators are cached).
+    :param pawn_data: Pawn as list of columns (data[x][y] is True when (x, y) belongs to the pawn).
+    :param width: Width of the board.
+    :param height: Height of the board.
+    :return: Rules object.
+    """
+    return _cached_rules(tuple(tuple(bool(v) for v in column) for column in pawn_data), width, height)
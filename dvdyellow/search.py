@@ -0,0 +1,663 @@
+"""
+Game tree search used by the bot.
+
+Position is the bitboard of occupied fields (see rules module). Next moves do not depend on the player
+who moves, so value of a position is the best point difference the player to move can get till the end.
+"""
+import itertools
+import math
+import random
+import threading
+import weakref
+from collections import OrderedDict
+from time import perf_counter
+
+from .rules import rules_for
+
+_EXACT = 0
+_LOWER = 1
+_UPPER = 2
+
+
+class Zobrist:
+    """
+    Zobrist hashing of bitboards - a random 64-bit key for every field, XOR-ed for occupied fields.
+    """
+    def __init__(self, size, seed=0):
+        """
+        Creates hashing for boards of specified size.
+        :param size: Number of fields of the board.
+        :param seed: Seed of the random keys.
+        """
+        generator = random.Random(seed)
+        self.keys = [generator.getrandbits(64) for _ in range(size)]
+
+    def hash(self, mask):
+        """
+        Computes hash of the fields (hash of a position is a hash of its occupied fields).
+        :param mask: Bitboard of the fields.
+        :return: 64-bit hash.
+        """
+        result = 0
+        keys = self.keys
+        while mask:
+            low = mask & -mask
+            result ^= keys[low.bit_length() - 1]
+            mask ^= low
+        return result
+
+
+class TranspositionTable:
+    """
+    Hash table of searched positions with a bounded number of entries.
+    Entry of the current search replaces an entry of an older search or an entry searched less deep.
+    """
+    def __init__(self, size=1 << 16):
+        """
+        Creates the table.
+        :param size: Number of entries (rounded up to a power of 2).
+        """
+        self.size = 1
+        while self.size < size:
+            self.size *= 2
+        self.entries = [None] * self.size
+        self.generation = 0
+
+    def new_search(self):
+        """
+        Marks entries stored so far as old ones (they are replaced first).
+        """
+        self.generation += 1
+
+    def probe(self, key):
+        """
+        Finds entry of the position.
+        :param key: Hash of the position.
+        :return: Tuple (depth, value, flag, best move mask) or None if position is not in the table.
+        """
+        entry = self.entries[key & (self.size - 1)]
+        if entry is not None and entry[0] == key:
+            return entry[1:5]
+        return None
+
+    def store(self, key, depth, value, flag, best_move):
+        """
+        Stores entry of the position (if replacement policy allows it).
+        :param key: Hash of the position.
+        :param depth: Depth of the search.
+        :param value: Value of the position.
+        :param flag: If value is exact or is lower or upper bound.
+        :param best_move: Mask of the best move found.
+        """
+        index = key & (self.size - 1)
+        entry = self.entries[index]
+        if entry is None or entry[5] != self.generation or entry[1] <= depth:
+            self.entries[index] = (key, depth, value, flag, best_move, self.generation)
+
+
+class EvaluationCache:
+    """
+    Bounded cache of fields blocked by moves, which can be shared by many games and threads.
+    Blocked fields depend only on the rules and the fields occupied after the move, so the key is the number
+    of the rules with the bitboard of the resulting board - candidates leading to the same board
+    and positions repeated in later turns are evaluated once. The least recently used entries are evicted.
+    """
+    def __init__(self, size=1 << 16):
+        """
+        Creates the cache.
+        :param size: Maximal number of entries.
+        """
+        self.size = size
+        self.entries = OrderedDict()    # (rules tag, board after the move) -> blocked fields
+        # rules -> number distinguishing their keys (numbers are not reused, as entries of forgotten rules
+        # stay in the cache until they are evicted)
+        self.tags = weakref.WeakKeyDictionary()
+        self.tag_generator = itertools.count(1)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def blocked_by_moves(self, rules, occupied, move_masks):
+        """
+        Finds fields blocked by each of the moves (like Rules.blocked_by_moves, but using the cache).
+        :param rules: Rules of the game (from rules.rules_for).
+        :param occupied: Bitboard of occupied fields.
+        :param move_masks: List of bitboards of fields covered by the moves.
+        :return: List of bitboards of blocked fields (in the same order as the moves).
+        """
+        result = [None] * len(move_masks)
+        missing = []
+        entries = self.entries
+        with self.lock:
+            tag = self.tags.get(rules)
+            if tag is None:
+                tag = self.tags[rules] = next(self.tag_generator)
+            for i, move in enumerate(move_masks):
+                key = (tag, occupied | move)
+                blocked = entries.get(key)
+                if blocked is None:
+                    missing.append(i)
+                else:
+                    entries.move_to_end(key)
+                    result[i] = blocked
+            self.hits += len(move_masks) - len(missing)
+            self.misses += len(missing)
+        if not missing:
+            return result
+
+        # all missing moves are evaluated at once (legal placements are found only once)
+        computed = rules.blocked_by_moves(occupied, [move_masks[i] for i in missing])
+        with self.lock:
+            for i, blocked in zip(missing, computed):
+                result[i] = blocked
+                entries[(tag, occupied | move_masks[i])] = blocked
+            while len(entries) > self.size:
+                entries.popitem(last=False)
+        return result
+
+    def evaluate_moves(self, rules, occupied, move_masks, values):
+        """
+        Computes points for the fields blocked by each of the moves (like Rules.evaluate_moves).
+        :param rules: Rules of the game (from rules.rules_for).
+        :param occupied: Bitboard of occupied fields.
+        :param move_masks: List of bitboards of fields covered by the moves.
+        :param values: Points of the fields (see Rules.point_values).
+        :return: List of points (in the same order as the moves).
+        """
+        return [rules.sum_points(b, values) for b in self.blocked_by_moves(rules, occupied, move_masks)]
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.
+
+
+def _blocked_by_moves(rules, cache, occupied, move_masks):
+    """
+    Finds fields blocked by the moves using the evaluation cache if there is one.
+    """
+    if cache is None:
+        return rules.blocked_by_moves(occupied, move_masks)
+    return cache.blocked_by_moves(rules, occupied, move_masks)
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+class AlphaBetaSearch:
+    """
+    Negamax search with alpha-beta pruning and transposition table run with iterative deepening.
+    """
+    def __init__(self, rules, values, table_size=1 << 16, stop_event=None, cache=None):
+        """
+        Creates search engine for a game.
+        :param rules: Rules of the game (from rules.rules_for).
+        :param values: Points of the fields (see Rules.point_values).
+        :param table_size: Number of entries of the transposition table.
+        :param stop_event: Event (threading.Event) which stops the search when it is set (like end of time).
+        :param cache: EvaluationCache used to find fields blocked by moves (None to compute them every time).
+        """
+        self.rules = rules
+        self.values = values
+        self.cache = cache
+        self.zobrist = Zobrist(rules.width * rules.height)
+        self.table = TranspositionTable(table_size)
+        self.stop_event = stop_event
+        self.deadline = None
+        self.nodes = 0
+        # if only entries searched exactly as deep are used (entries of deeper searches make the result
+        # depend on the history of the table)
+        self.exact_depth = False
+
+    def _children(self, occupied, cached=True):
+        """
+        Generates moves from the position.
+        :param occupied: Bitboard of occupied fields.
+        :param cached: If the evaluation cache should be used (horizon nodes are too many to be worth caching).
+        :return: Tuple of lists: moves (see Rules.legal_moves), fields blocked by them and gained points.
+        """
+        moves = self.rules.legal_moves(occupied)
+        blocked = _blocked_by_moves(self.rules, self.cache if cached else None, occupied, [m[3] for m in moves])
+        gains = [self.rules.sum_points(b, self.values) for b in blocked]
+        return moves, blocked, gains
+
+    def _order(self, moves, gains, first_mask):
+        """
+        Orders moves - the best move from previous search first, then by points gained immediately.
+        :return: List of indexes of the moves.
+        """
+        return sorted(range(len(moves)), key=lambda i: (moves[i][3] != first_mask, -gains[i]))
+
+    def _negamax(self, occupied, key, depth, alpha, beta):
+        """
+        Computes value of the position.
+        :param occupied: Bitboard of occupied fields.
+        :param key: Hash of the position.
+        :param depth: Number of moves to search.
+        :param alpha: Lower bound of interesting values.
+        :param beta: Upper bound of interesting values.
+        :return: Value of the position (exact if it is between alpha and beta, otherwise a bound).
+        """
+        self.nodes += 1
+        if perf_counter() > self.deadline or (self.stop_event is not None and self.stop_event.is_set()):
+            raise SearchTimeout()
+        if occupied == self.rules.full or depth == 0:
+            return 0
+
+        original_alpha = alpha
+        best_move = None
+        entry = self.table.probe(key)
+        if entry is not None:
+            entry_depth, value, flag, best_move = entry
+            if entry_depth == depth or (entry_depth > depth and not self.exact_depth):
+                if flag == _EXACT:
+                    return value
+                elif flag == _LOWER:
+                    alpha = max(alpha, value)
+                else:
+                    beta = min(beta, value)
+                if alpha >= beta:
+                    return value
+
+        moves, blocked, gains = self._children(occupied, depth > 1)
+        if depth == 1:
+            best = max(range(len(moves)), key=gains.__getitem__)
+            best_value = gains[best]
+        else:
+            best_value = None
+            for i in self._order(moves, gains, best_move):
+                changed = moves[i][3] | blocked[i]
+                value = gains[i] - self._negamax(occupied | changed, key ^ self.zobrist.hash(changed), depth - 1,
+                                                 gains[i] - beta, gains[i] - alpha)
+                if best_value is None or value > best_value:
+                    best_value, best = value, i
+                    alpha = max(alpha, value)
+                    if alpha >= beta:
+                        break
+
+        if best_value <= original_alpha:
+            flag = _UPPER
+        elif best_value >= beta:
+            flag = _LOWER
+        else:
+            flag = _EXACT
+        self.table.store(key, depth, best_value, flag, moves[best][3])
+        return best_value
+
+    def _depth_limit(self, occupied, max_depth):
+        """
+        Computes maximal depth worth searching.
+        :param occupied: Bitboard of occupied fields.
+        :param max_depth: Maximal depth requested (or None).
+        :return: The depth.
+        """
+        # the game cannot last longer than till all free fields are covered
+        free_fields = bin(self.rules.full & ~occupied).count('1')
+        depth_limit = free_fields // self.rules.pawn_size
+        if max_depth is not None:
+            depth_limit = min(depth_limit, max_depth)
+        return depth_limit
+
+    def _root_values(self, occupied, key, candidates, depth):
+        """
+        Searches moves from the root one after another (with alpha-beta bound from the best move so far).
+        :param occupied: Bitboard of occupied fields.
+        :param key: Hash of the position.
+        :param candidates: List of tuples (move index, fields changed by the move, gained points).
+        :param depth: Depth of the search.
+        :return: Generator of pairs (move index, value) for moves better than all the previous ones.
+        """
+        alpha = None
+        for index, changed, gain in candidates:
+            upper = float('inf') if alpha is None else gain - alpha
+            value = gain - self._negamax(occupied | changed, key ^ self.zobrist.hash(changed), depth - 1,
+                                         float('-inf'), upper)
+            if alpha is None or value > alpha:
+                alpha = value
+                yield index, value
+
+    def search(self, occupied, time_budget, max_depth=None):
+        """
+        Finds the best move, searching deeper and deeper until time is over.
+        :param occupied: Bitboard of occupied fields.
+        :param time_budget: Time for the search (in seconds).
+        :param max_depth: Maximal depth of the search.
+        :return: Tuple (move, value, depth) - move as in Rules.legal_moves (None if there are no moves),
+        its value and depth of the last (at least partially) finished search.
+        """
+        self.deadline = perf_counter() + time_budget
+        self.nodes = 0
+        self.table.new_search()
+        key = self.zobrist.hash(occupied)
+        moves, blocked, gains = self._children(occupied)
+        if not moves:
+            return None, 0, 0
+
+        best = max(range(len(moves)), key=gains.__getitem__)
+        best_value, depth = gains[best], 1
+        for current_depth in range(2, self._depth_limit(occupied, max_depth) + 1):
+            candidates = [(i, moves[i][3] | blocked[i], gains[i]) for i in self._order(moves, gains, moves[best][3])]
+            current_best = None
+            try:
+                for current_best, value in self._root_values(occupied, key, candidates, current_depth):
+                    pass
+            except SearchTimeout:
+                # the best move of previous iteration is searched first, so a move found
+                # in unfinished iteration is at least as good
+                if current_best is not None:
+                    best, best_value, depth = current_best, value, current_depth
+                break
+            best, best_value, depth = current_best, value, current_depth
+            if perf_counter() > self.deadline:
+                break
+        return moves[best], best_value, depth
+
+
+# search engines of a worker process (key -> engine) and their evaluation cache, used by _search_root_task
+_worker_engines = dict()
+_worker_cache = EvaluationCache()
+_worker_stop_event = None   # stops searches of the worker process (set by init_search_worker)
+
+
+def init_search_worker(stop_event):
+    """
+    Initializes process of a pool used by ParallelAlphaBetaSearch (initializer of multiprocessing.Pool).
+    :param stop_event: Event shared with the process (multiprocessing.Event) which stops its searches
+    when it is set - the same one should be given to ParallelAlphaBetaSearch.
+    """
+    global _worker_stop_event
+    _worker_stop_event = stop_event
+
+
+def _search_root_task(task):
+    """
+    Searches part of moves from the root in a worker process of ParallelAlphaBetaSearch.
+    Engines (with their transposition tables) are kept in the process between tasks of the same game,
+    but use only entries of the same depth, so the result does not depend on earlier tasks of the process.
+    :param task: Tuple (pawn, board width, board height, points of fields as bytes, table size,
+    occupied fields, list of pairs (move order, move mask), depth, time for the search).
+    :return: Tuple (move order, value) of the best move and number of searched nodes or None if time is over.
+    """
+    pawn_data, width, height, values, table_size, occupied, candidates, depth, time_budget = task
+    key = (pawn_data, width, height, values)
+    engine = _worker_engines.get(key)
+    if engine is None:
+        if len(_worker_engines) >= 8:
+            _worker_engines.clear()
+        engine = AlphaBetaSearch(rules_for(pawn_data, width, height), values, table_size, cache=_worker_cache)
+        engine.exact_depth = True
+        _worker_engines[key] = engine
+
+    engine.stop_event = _worker_stop_event
+    engine.deadline = perf_counter() + time_budget
+    engine.nodes = 0
+    engine.table.new_search()
+    blocked = _blocked_by_moves(engine.rules, engine.cache, occupied, [mask for _, mask in candidates])
+    items = [(order, mask | b, engine.rules.sum_points(b, values)) for (order, mask), b in zip(candidates, blocked)]
+    best = None
+    try:
+        for best in engine._root_values(occupied, engine.zobrist.hash(occupied), items, depth):
+            pass
+    except SearchTimeout:
+        return None
+    return best, engine.nodes
+
+
+class ParallelAlphaBetaSearch(AlphaBetaSearch):
+    """
+    Alpha-beta search with moves from the root divided between processes of a pool.
+    Every depth of iterative deepening is finished by all the processes before the next one starts
+    and the best move is chosen by its value and then by the order of moves, so the result does not depend
+    on the timing of the processes nor on the tasks they searched before.
+    """
+    def __init__(self, rules, values, pool, workers, table_size=1 << 16, stop_event=None, cache=None):
+        """
+        Creates search engine for a game.
+        :param rules: Rules of the game (from rules.rules_for).
+        :param values: Points of the fields (see Rules.point_values).
+        :param pool: Pool of processes (multiprocessing.Pool), initialized with init_search_worker.
+        :param workers: Number of processes in the pool.
+        :param table_size: Number of entries of the transposition table of each process.
+        :param stop_event: Event which stops the search when it is set - the processes stop at once
+        if it is the event given to init_search_worker (multiprocessing.Event), otherwise it is checked
+        only between depths of iterative deepening.
+        :param cache: EvaluationCache used to find fields blocked by moves from the root (processes have their own).
+        """
+        super().__init__(rules, values, table_size=1, stop_event=stop_event, cache=cache)
+        self.pool = pool
+        self.workers = workers
+        self.table_size = table_size
+        # fields' points are sent to processes as bytes (points are small numbers)
+        self.values_buffer = bytes(values)
+
+    def search(self, occupied, time_budget, max_depth=None):
+        deadline = perf_counter() + time_budget
+        self.nodes = 0
+        moves, blocked, gains = self._children(occupied)
+        if not moves:
+            return None, 0, 0
+
+        best = max(range(len(moves)), key=gains.__getitem__)
+        best_value, depth = gains[best], 1
+        for current_depth in range(2, self._depth_limit(occupied, max_depth) + 1):
+            remaining = deadline - perf_counter()
+            if remaining <= 0 or (self.stop_event is not None and self.stop_event.is_set()):
+                break
+            order = self._order(moves, gains, moves[best][3])
+            tasks = []
+            for worker in range(min(self.workers, len(order))):
+                candidates = [(position, moves[order[position]][3])
+                              for position in range(worker, len(order), self.workers)]
+                tasks.append((self.rules.pawn_data, self.rules.width, self.rules.height, self.values_buffer,
+                              self.table_size, occupied, candidates, current_depth, remaining))
+            results = self.pool.map(_search_root_task, tasks)
+            if any(result is None for result in results):
+                break
+            self.nodes += sum(nodes for _, nodes in results)
+            # the best value, the first in order for equal values
+            value, negative_position = max((value, -position) for (position, value), _ in results)
+            best, best_value, depth = order[-negative_position], value, current_depth
+        return moves[best], best_value, depth
+
+
+class _TreeNode:
+    """
+    Node of Monte Carlo search tree - position after a move.
+    """
+    __slots__ = ('occupied', 'move', 'gain', 'children', 'untried', 'visits', 'wins')
+
+    def __init__(self, occupied, move, gain):
+        self.occupied = occupied
+        self.move = move        # move leading to the node (as in Rules.legal_moves)
+        self.gain = gain        # points gained by the move
+        self.children = []
+        self.untried = None     # moves not expanded yet - list of (move, blocked fields, gain)
+        self.visits = 0
+        self.wins = 0.          # from the point of view of the player who made the move
+
+
+class MonteCarloSearch:
+    """
+    Monte Carlo tree search with UCT selection and random playouts.
+    The tree is kept between moves - search starts from the node of the current position if it was searched before.
+    """
+    def __init__(self, rules, values, exploration=1.4, seed=None, stop_event=None, cache=None):
+        """
+        Creates search engine for a game.
+        :param rules: Rules of the game (from rules.rules_for).
+        :param values: Points of the fields (see Rules.point_values).
+        :param exploration: Exploration constant of UCT.
+        :param seed: Seed of the playouts (None to use random seed).
+        :param stop_event: Event (threading.Event) which stops the search when it is set (like end of time).
+        :param cache: EvaluationCache used to find fields blocked by moves (None to compute them every time).
+        """
+        self.rules = rules
+        self.values = values
+        self.cache = cache
+        self.exploration = exploration
+        self.stop_event = stop_event
+        self.generator = random.Random(seed)
+        self.root = None
+        self.playouts = 0
+        self.placements = 0
+        self.elapsed = 0.
+
+    def _find_root(self, occupied):
+        """
+        Finds node of the position in the tree kept from previous search (our move and opponent's reply).
+        :param occupied: Bitboard of occupied fields.
+        :return: The node (a new one if the position was not searched).
+        """
+        if self.root is not None:
+            if self.root.occupied == occupied:
+                return self.root
+            for child in self.root.children:
+                if child.occupied == occupied:
+                    return child
+        return _TreeNode(occupied, None, 0)
+
+    def _expand_moves(self, node):
+        moves = self.rules.legal_moves(node.occupied)
+        blocked = _blocked_by_moves(self.rules, self.cache, node.occupied, [m[3] for m in moves])
+        node.untried = [(m, b, self.rules.sum_points(b, self.values)) for m, b in zip(moves, blocked)]
+        self.generator.shuffle(node.untried)
+
+    def _select(self, node):
+        log_visits = math.log(node.visits)
+        exploration = self.exploration
+        return max(node.children,
+                   key=lambda c: c.wins / c.visits + exploration * math.sqrt(log_visits / c.visits))
+
+    def _iteration(self, root, difference):
+        """
+        Runs one iteration of the search: selection, expansion, playout and update of the statistics.
+        :param root: Root node.
+        :param difference: Points of the player to move minus points of the opponent at the root.
+        """
+        path = [root]
+        node = root
+        # difference from the point of view of the player to move at the current node
+        sign = 1
+        while True:
+            if node.untried is None:
+                self._expand_moves(node)
+            if node.untried:
+                move, blocked, gain = node.untried.pop()
+                child = _TreeNode(node.occupied | move[3] | blocked, move, gain)
+                node.children.append(child)
+                node = child
+                path.append(node)
+                difference += sign * gain
+                sign = -sign
+                break
+            if not node.children:
+                break
+            node = self._select(node)
+            path.append(node)
+            difference += sign * node.gain
+            sign = -sign
+
+        future, placements = self.rules.playout(node.occupied, self.values, self.generator)
+        difference += sign * future
+        self.playouts += 1
+        self.placements += placements
+
+        # result for the player to move at the root
+        result = 1. if difference > 0 else (0. if difference < 0 else .5)
+        for depth, visited in enumerate(path):
+            visited.visits += 1
+            # moves at odd depths were done by the player to move at the root
+            visited.wins += result if depth % 2 == 1 else 1. - result
+
+    def search(self, occupied, difference=0, time_budget=None, iterations=None):
+        """
+        Finds the best move within time or iteration budget.
+        :param occupied: Bitboard of occupied fields.
+        :param difference: Points of the player to move minus points of the opponent.
+        :param time_budget: Time for the search (in seconds).
+        :param iterations: Number of iterations of the search.
+        :return: Move as in Rules.legal_moves (None if there are no moves).
+        """
+        if time_budget is None and iterations is None:
+            raise ValueError("No budget for the search")
+        start = perf_counter()
+        self.playouts = 0
+        self.placements = 0
+        if occupied == self.rules.full:
+            self.root = None
+            return None
+        root = self._find_root(occupied)
+        count = 0
+        # at least one iteration is run, so a move is found even if the search is stopped at once
+        while count == 0 or (iterations is None or count < iterations) and \
+                (time_budget is None or perf_counter() - start < time_budget) and \
+                (self.stop_event is None or not self.stop_event.is_set()):
+            self._iteration(root, difference)
+            count += 1
+        self.elapsed = perf_counter() - start
+
+        if not root.children:
+            self.root = None
+            return None
+        best = max(root.children, key=lambda c: c.visits)
+        # the tree of the chosen move is used in the next search
+        self.root = best
+        return best.move
+
+    @property
+    def playouts_per_second(self):
+        """
+        Speed of the last search.
+        """
+        return self.playouts / self.elapsed if self.elapsed else 0.
+
+
+class EndgameSolver:
+    """
+    Exact search till the end of the game. Values of positions are memoised by their occupied fields
+    (bitboard is an exact and compact key), so transpositions are solved once.
+    """
+    def __init__(self, rules, values):
+        """
+        Creates solver for a game.
+        :param rules: Rules of the game (from rules.rules_for).
+        :param values: Points of the fields (see Rules.point_values).
+        """
+        self.rules = rules
+        self.values = values
+        self.memo = dict()  # occupied fields -> value of the position
+
+    def _children(self, occupied):
+        moves = self.rules.legal_moves(occupied)
+        blocked = self.rules.blocked_by_moves(occupied, [m[3] for m in moves])
+        return [(m, m[3] | b, self.rules.sum_points(b, self.values)) for m, b in zip(moves, blocked)]
+
+    def value(self, occupied):
+        """
+        Computes exact value of the position.
+        :param occupied: Bitboard of occupied fields.
+        :return: The best point difference the player to move can get till the end of the game.
+        """
+        result = self.memo.get(occupied)
+        if result is None:
+            children = self._children(occupied)
+            if children:
+                result = max(gain - self.value(occupied | changed) for _, changed, gain in children)
+            else:
+                result = 0
+            self.memo[occupied] = result
+        return result
+
+    def solve(self, occupied):
+        """
+        Finds the best move.
+        :param occupied: Bitboard of occupied fields.
+        :return: Tuple (move, value) - move as in Rules.legal_moves (None if there are no moves) and its value.
+        """
+        best, best_value = None, 0
+        for move, changed, gain in self._children(occupied):
+            value = gain - self.value(occupied | changed)
+            if best is None or value > best_value:
+                best, best_value = move, value
+        return best, best_value
@@ -9,19 +9,36 @@ import yaml
 from functools import reduce
 
 import random
+from collections import OrderedDict
+from threading import Lock
 from appdirs import AppDirs
-from sqlalchemy import desc
-from sqlalchemy.engine import create_engine
-from sqlalchemy.engine.url import URL
-from sqlalchemy.orm.session import sessionmaker
 
-from .orm import User, GameBoard, GamePawn, GameResult, create_schemes
-from .network import Server
+from .network import Server, Deferred
+from .repository import ConstraintError
+
+# SQLite settings (pragmas) applied on every connection
+_sqlite_pragmas = ('journal_mode', 'synchronous', 'cache_size', 'mmap_size', 'temp_store')
+_sqlite_profiles = {
+    'default': {},
+    'performance': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -16000,       # in KiB
+        'mmap_size': 268435456,
+        'temp_store': 'MEMORY',
+    },
+}
+
+
+class ConfigurationError(Exception):
+    """
+    Raised when the server configuration has an invalid value.
+    """
+    pass
 
 
 class ServerManager:
     def __init__(self, target_configuration=None, config_file=None, config_object=None, install=False):
-        self.server = Server(lambda x: x == 1)
         self.logger = logging.getLogger("ServerManager")
         self.dirs = AppDirs('dvdyellow', appauthor='yellow-team', multipath=True)
         self.config = None
@@ -29,10 +46,13 @@ class ServerManager:
         self._setup_server_configuration(target_configuration, config_file, config_object)
         self._setup_database()
 
-        self.user_manager = UserManager(self.server, self.db_session)
+        self.server = Server(lambda x: x == 1, workers=self.workers, outgoing_limit=self.outgoing_limit)
+
+        self.user_manager = UserManager(self.server, self.repository, self.name_cache_size)
         self.waiting_room = WaitingRoomManager(self)
-        self.game_manager = GameManager(self.server, self.user_manager, self.db_session)
-        if install:
+        self.game_manager = GameManager(self.server, self.user_manager, self.repository)
+        # in-memory repository starts empty every time, so it always needs the default pawn and boards
+        if install or self.db_backend == 'memory':
             self._install()
         self.on_run = None
 
@@ -56,13 +76,11 @@ class ServerManager:
             self._load_config_file(conf_file)
 
     def _install(self):
-        self.db_session.add(GamePawn(name='default_pawn', width=2, height=3, shapestring="101110"))
-        self.db_session.add(GameBoard(name='default_board', width=6, height=8, shapestring="1" * 48))
-        self.db_session.add(GameBoard(name='big_board', width=15, height=15,
-                                      shapestring=("00" + "1"*(15*15-4) + "00")))
-        # here can add other pawns and boards
-        self.db_session.flush()
-        pass
+        with self.repository.unit_of_work() as unit:
+            unit.add_pawn(name='default_pawn', width=2, height=3, shapestring="101110")
+            unit.add_board(name='default_board', width=6, height=8, shapestring="1" * 48)
+            unit.add_board(name='big_board', width=15, height=15, shapestring=("00" + "1"*(15*15-4) + "00"))
+            # here can add other pawns and boards
 
     def get_config_entry(self, getter, default, is_empty_default=False):
         """
@@ -117,27 +135,57 @@ class ServerManager:
         # NETWORK SETTINGS
         #
         self.port = self.get_config_entry('network.port', 42371)
+        self.workers = self.get_config_entry('network.workers', 4)
+        self.outgoing_limit = self.get_config_entry('network.outgoing_limit', 1 << 24)
+
+        #
+        # USERS SETTINGS
+        #
+        self.name_cache_size = self.get_config_entry('users.name_cache_size', 1024)
 
         #
         # DATABASE SETTINGS
         #
-        self.db_url = URL(
-            self.get_config_entry('database.driver', 'sqlite'),
-            self.get_config_entry('database.username', None, is_empty_default=True),
-            self.get_config_entry('database.password', None, is_empty_default=True),
-            self.get_config_entry('database.host', None, is_empty_default=True),
-            self.get_config_entry('database.port', None, is_empty_default=True),
-            self.get_config_entry('database.name', None, is_empty_default=True),
-            self.get_config_entry('database.options', None, is_empty_default=True)
-        )
+        self.db_backend = self.get_config_entry('database.backend', 'sqlalchemy')
+        if self.db_backend not in ('sqlalchemy', 'memory'):
+            raise ConfigurationError("Unknown database backend '{}' (available: sqlalchemy, memory).".format(
+                self.db_backend))
+        self.db_url_options = {
+            'drivername': self.get_config_entry('database.driver', 'sqlite'),
+            'username': self.get_config_entry('database.username', None, is_empty_default=True),
+            'password': self.get_config_entry('database.password', None, is_empty_default=True),
+            'host': self.get_config_entry('database.host', None, is_empty_default=True),
+            'port': self.get_config_entry('database.port', None, is_empty_default=True),
+            'database': self.get_config_entry('database.name', None, is_empty_default=True),
+            'query': self.get_config_entry('database.options', None, is_empty_default=True),
+        }
+        self.db_pool_options = {
+            'pool_size': self.get_config_entry('database.pool_size', 5),
+            'max_overflow': self.get_config_entry('database.max_overflow', 10),
+            'pool_recycle': self.get_config_entry('database.pool_recycle', 3600),
+            'pool_timeout': self.get_config_entry('database.pool_timeout', 30),
+        }
+
+        # 'performance' profile makes commits faster, but less durable (WAL with synchronous=NORMAL),
+        # so it has to be chosen explicitly
+        sqlite_profile = self.get_config_entry('database.sqlite.profile', 'default')
+        if sqlite_profile not in _sqlite_profiles:
+            raise ConfigurationError("Unknown SQLite profile '{}' (available: {}).".format(
+                sqlite_profile, ', '.join(sorted(_sqlite_profiles))))
+        self.db_sqlite_pragmas = dict()
+        for pragma in _sqlite_pragmas:
+            value = self.get_config_entry('database.sqlite.' + pragma, _sqlite_profiles[sqlite_profile].get(pragma))
+            if value is not None:
+                self.db_sqlite_pragmas[pragma] = value
 
     def _setup_database(self):
-        self.db = create_engine(self.db_url)
-        self.db_connection = self.db.connect()
-        create_schemes(self.db)
-
-        self.db_session_type = sessionmaker(bind=self.db)
-        self.db_session = self.db_session_type()
+        if self.db_backend == 'memory':
+            from .repository import MemoryRepository
+            self.repository = MemoryRepository()
+        else:
+            # SQLAlchemy is imported only when it is used
+            from .orm import SqlRepository
+            self.repository = SqlRepository(self.db_url_options, self.db_pool_options, self.db_sqlite_pragmas)
 
     def run(self):
         """
@@ -159,7 +207,7 @@ class ServerManager:
         self.server.close()
 
     def _finalize(self):
-        self.db_connection.close()
+        self.repository.close()
 
 
 class _UserAuthenticationData:
@@ -168,12 +216,60 @@ class _UserAuthenticationData:
         self.uid = uid
 
 
+class _UserNameCache:
+    """
+    Thread-safe LRU cache of users' names (user ID -> name or None if there is no such user).
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.lock = Lock()
+        self.names = OrderedDict()
+        self.generation = 0     # incremented on invalidation
+
+    def get(self, uid):
+        """
+        Finds user's name in the cache.
+        :param uid: User's ID.
+        :return: Tuple (found, name) - name is None for non-existing user.
+        """
+        with self.lock:
+            if uid not in self.names:
+                return False, None
+            self.names.move_to_end(uid)
+            return True, self.names[uid]
+
+    def put(self, uid, name, generation):
+        """
+        Stores user's name in the cache (removing the least recently used entries if needed).
+        :param uid: User's ID.
+        :param name: User's name or None for non-existing user.
+        :param generation: Generation of the cache read before the name was looked up - the name
+        is not stored when the cache was invalidated in the meantime.
+        """
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.names[uid] = name
+            self.names.move_to_end(uid)
+            while len(self.names) > self.capacity:
+                self.names.popitem(last=False)
+
+    def invalidate(self):
+        """
+        Removes all entries from the cache.
+        """
+        with self.lock:
+            self.names.clear()
+            self.generation += 1
+
+
 class UserManager:
-    def __init__(self, server, db_session):
+    def __init__(self, server, repository, name_cache_size=1024):
         """
         Creates user manager.
         :param server: server used to communication
-        :param db_session: connection to database
+        :param repository: storage of users' data
+        :param name_cache_size: maximal number of users' names cached
         :return:
         """
         self.disconnect_handlers = []
@@ -191,7 +287,8 @@ class UserManager:
         server.set_permission_checker(permission_checker)
         server.set_query_handler(3, query_handler)
 
-        self.database_session = db_session
+        self.repository = repository
+        self.name_cache = _UserNameCache(name_cache_size)
         self.auth_status = dict()
         self.client_users = dict()
 
@@ -253,16 +350,25 @@ class UserManager:
                 return {'status': 'error', 'code': 'NO_USERNAME'}
             if data.get('password') is None:
                 return {'status': 'error', 'code': 'NO_PASSWORD'}
-            this_user = self.database_session.query(User).filter(User.name == data['username']).first()
-            self.database_session.flush()
-            if not this_user:
-                return {'status': 'error', 'code': 'NO_SUCH_USER'}
-            if this_user.password == data['password']:
-                self.auth_status[client_id] = _UserAuthenticationData(this_user.name, this_user.id)
-                self.client_users[this_user.id] = client_id
-                return {'status': 'ok'}
-            else:
-                return {'status': 'error', 'code': 'WRONG_PASSWORD'}
+
+            def find_user():
+                with self.repository.unit_of_work() as unit:
+                    this_user = unit.get_user_by_name(data['username'])
+                    if this_user:
+                        return this_user.id, this_user.name, this_user.password
+
+            def authenticate(this_user):
+                if not this_user:
+                    return {'status': 'error', 'code': 'NO_SUCH_USER'}
+                uid, username, password = this_user
+                if password == data['password']:
+                    self.auth_status[client_id] = _UserAuthenticationData(username, uid)
+                    self.client_users[uid] = client_id
+                    return {'status': 'ok'}
+                else:
+                    return {'status': 'error', 'code': 'WRONG_PASSWORD'}
+
+            return Deferred(find_user, authenticate)
 
         elif data['command'] == 'sign-out':
             #
@@ -293,11 +399,21 @@ class UserManager:
                 return {'status': 'error', 'code': 'NO_USERNAME'}
             if 'password' not in data:
                 return {'status': 'error', 'code': 'NO_PASSWORD'}
-            if self.database_session.query(User).filter(User.name == data['username']).first():
-                return {'status': 'error', 'code': 'LOGIN_TAKEN'}
-            self.database_session.add(User(name=data['username'], password=data['password'], ranking=0))
-            self.database_session.flush()
-            return {'status': 'ok'}
+
+            def add_user():
+                try:
+                    with self.repository.unit_of_work() as unit:
+                        if unit.get_user_by_name(data['username']):
+                            return {'status': 'error', 'code': 'LOGIN_TAKEN'}
+                        unit.add_user(data['username'], data['password'], ranking=0)
+                except ConstraintError:
+                    # somebody has taken the login in the meantime
+                    return {'status': 'error', 'code': 'LOGIN_TAKEN'}
+                # ID of the new user could be cached as non-existing one
+                self.name_cache.invalidate()
+                return {'status': 'ok'}
+
+            return Deferred(add_user)
 
         elif data['command'] == 'get-name':
             #
@@ -305,11 +421,56 @@ class UserManager:
             #
             if 'id' not in data:
                 return {'status': 'error', 'code': 'NO_ID'}
-            this_user = self.database_session.query(User).filter(User.id == data['id']).first()
-            if this_user:
-                return {'status': 'ok', 'name': this_user.name}
-            else:
-                return {'status': 'error', 'code': 'NO_SUCH_USER'}
+
+            def name_response(name):
+                if name is not None:
+                    return {'status': 'ok', 'name': name}
+                else:
+                    return {'status': 'error', 'code': 'NO_SUCH_USER'}
+
+            found, name = self.name_cache.get(data['id'])
+            if found:
+                return name_response(name)
+
+            def get_name():
+                generation = self.name_cache.generation
+                with self.repository.unit_of_work() as unit:
+                    this_user = unit.get_user_by_id(data['id'])
+                    this_name = this_user.name if this_user else None
+                self.name_cache.put(data['id'], this_name, generation)
+                return this_name
+
+            return Deferred(get_name, name_response)
+
+        elif data['command'] == 'get-names':
+            #
+            # we return names of all existing users from the list (unknown ids are skipped)
+            #
+            if 'ids' not in data:
+                return {'status': 'error', 'code': 'NO_ID'}
+
+            names = dict()
+            missing = []
+            for uid in data['ids']:
+                found, name = self.name_cache.get(uid)
+                if not found:
+                    missing.append(uid)
+                elif name is not None:
+                    names[uid] = name
+
+            if not missing:
+                return {'status': 'ok', 'names': names}
+
+            def get_names():
+                generation = self.name_cache.generation
+                with self.repository.unit_of_work() as unit:
+                    found_names = {u.id: u.name for u in unit.get_users(missing)}
+                for uid in missing:
+                    self.name_cache.put(uid, found_names.get(uid), generation)
+                names.update(found_names)
+                return {'status': 'ok', 'names': names}
+
+            return Deferred(get_names)
 
         return {'status': 'error', 'code': 'INVALID_COMMAND'}
 
@@ -426,11 +587,12 @@ class GameData:
 
 
 class GameManager:
-    def __init__(self, server, user_manager, db_session):
+    def __init__(self, server, user_manager, repository):
         """
         Creates game manager.
         :param server: server used to communication
         :param user_manager: part of server manager responsible for authentication
+        :param repository: storage of games' data
         :return:
         """
 
@@ -444,22 +606,71 @@ class GameManager:
         self.random_one = None
         self.game_data = dict()
         self.counter = 0
-        self.db_session = db_session
+        self.repository = repository
         self.waiters = dict()
 
     def _update_ranking_after_game(self, player1, points1, player2, points2, winner):
-        player_1_record = self.db_session.query(User).filter(User.id == player1).first()
-        player_2_record = self.db_session.query(User).filter(User.id == player2).first()
-        self.db_session.flush()
-        winner = winner
-        self.db_session.add(
-            GameResult(player1=player1, player2=player2, points1=points1, points2=points2, winner=winner))
-        rank1 = player_1_record.ranking + (points1 / (points1 + points2) - 0.5) * 10
-        rank2 = player_2_record.ranking + (points2 / (points1 + points2) - 0.5) * 10
-        player_1_record.ranking = rank1
-        player_2_record.ranking = rank2
-        self.db_session.commit()
-        self.db_session.flush()
+        """
+        Stores result of the game and changes players' ranking (it can be run by many threads at once).
+        :param player1: ID of the first player (None if the player is not signed in any more)
+        :param points1: points of the first player
+        :param player2: ID of the second player (None if the player is not signed in any more)
+        :param points2: points of the second player
+        :param winner: number of the winner (0 if draw)
+        """
+        total = points1 + points2
+        with self.repository.unit_of_work() as unit:
+            unit.add_game_result(player1, points1, player2, points2, winner)
+            for player, points in ((player1, points1), (player2, points2)):
+                if player is not None and total:
+                    unit.add_to_ranking(player, (points / total - 0.5) * 10)
+
+    def _deferred_ranking_update(self, game_nr, points1, points2, winner, response):
+        """
+        Stores result of the game and updates players' ranking in a worker thread.
+        :param game_nr: number of finished game
+        :param points1: points of the first player
+        :param points2: points of the second player
+        :param winner: number of the winner (0 if draw)
+        :param response: response sent to the client after updating the ranking
+        :return: deferred response
+        """
+        player1 = self.user_manager.get_clients_user(self.game_data[game_nr].player_client[0])
+        player2 = self.user_manager.get_clients_user(self.game_data[game_nr].player_client[1])
+        return Deferred(lambda: self._update_ranking_after_game(player1, points1, player2, points2, winner),
+                        lambda _: response)
+
+    @staticmethod
+    def _summarize_games(games, games_inverted):
+        """
+        :param games: results of games in which the player was the first one
+        :param games_inverted: results of games in which the player was the second one
+        :return: tuple of player's points, player's wins, opponents' points, opponents' wins and draws
+        """
+        points1 = 0
+        points2 = 0
+        wins1 = 0
+        wins2 = 0
+        draws = 0
+        for game in games:
+            points1 += game.points1
+            points2 += game.points2
+            if game.winner == 1:
+                wins1 += 1
+            elif game.winner == 2:
+                wins2 += 1
+            else:
+                draws += 1
+        for game in games_inverted:
+            points1 += game.points2
+            points2 += game.points1
+            if game.winner == 2:
+                wins1 += 1
+            elif game.winner == 1:
+                wins2 += 1
+            else:
+                draws += 1
+        return points1, wins1, points2, wins2, draws
 
     def _check_move(self, x, y, board, pawn):
         """
@@ -551,40 +762,39 @@ class GameManager:
         #
         # we create game pawn, randomly selected from database
         #
-        game_pawns = self.db_session.query(GamePawn)
-        random_game_pawn_raw = game_pawns.offset(int(int(game_pawns.count() * random.random()))).first()
-        pawn_string = random_game_pawn_raw.shapestring
-        pawn_table = [[0 for j in range(random_game_pawn_raw.height)] for i in range(random_game_pawn_raw.width)]
-        for i in range(random_game_pawn_raw.width):
-            for j in range(random_game_pawn_raw.height):
-                if pawn_string[j * random_game_pawn_raw.width + i] == '1':
-                    pawn_table[i][j] = 1
-        #
-        # we create game board, randomly selected from database
-        #
-        game_boards = self.db_session.query(GameBoard)
-        random_game_board_raw = game_boards.offset(int(int(game_boards.count() * random.random()))).first()
-        game_string = random_game_board_raw.shapestring
-        board_table2 = [[-3 for j in range(random_game_board_raw.height)] for i in range(random_game_board_raw.width)]
-        for i in range(random_game_board_raw.width):
-            for j in range(random_game_board_raw.height):
-                if game_string[j * random_game_board_raw.width + i] == '1':
-                    board_table2[i][j] = 0
-        #
-        # we remove unreachable fields
-        #
-        self._transform_after_move(pawn_table, board_table2, -3)
-        board_table = [[0 for j in range(random_game_board_raw.height)] for i in range(random_game_board_raw.width)]
-        for i in range(random_game_board_raw.width):
-            for j in range(random_game_board_raw.height):
-                if board_table2[i][j] == 0:
-                    #
-                    # we assign point values to valid fields
-                    #
-                    board_table[i][j] = random.randint(1, 9)
-
-        self.game_data[game_number] = GameData(player_1_client, player_2_client, board_table, board_table2,
-                                               pawn_table)
+        with self.repository.unit_of_work() as unit:
+            random_game_pawn_raw = unit.get_random_pawn()
+            pawn_string = random_game_pawn_raw.shapestring
+            pawn_table = [[0 for j in range(random_game_pawn_raw.height)] for i in range(random_game_pawn_raw.width)]
+            for i in range(random_game_pawn_raw.width):
+                for j in range(random_game_pawn_raw.height):
+                    if pawn_string[j * random_game_pawn_raw.width + i] == '1':
+                        pawn_table[i][j] = 1
+            #
+            # we create game board, randomly selected from database
+            #
+            random_game_board_raw = unit.get_random_board()
+            game_string = random_game_board_raw.shapestring
+            board_table2 = [[-3 for j in range(random_game_board_raw.height)] for i in range(random_game_board_raw.width)]
+            for i in range(random_game_board_raw.width):
+                for j in range(random_game_board_raw.height):
+                    if game_string[j * random_game_board_raw.width + i] == '1':
+                        board_table2[i][j] = 0
+            #
+            # we remove unreachable fields
+            #
+            self._transform_after_move(pawn_table, board_table2, -3)
+            board_table = [[0 for j in range(random_game_board_raw.height)] for i in range(random_game_board_raw.width)]
+            for i in range(random_game_board_raw.width):
+                for j in range(random_game_board_raw.height):
+                    if board_table2[i][j] == 0:
+                        #
+                        # we assign point values to valid fields
+                        #
+                        board_table[i][j] = random.randint(1, 9)
+
+            self.game_data[game_number] = GameData(player_1_client, player_2_client, board_table, board_table2,
+                                                   pawn_table)
 
     def _query_handler(self, client_id, data):
         """
@@ -651,20 +861,13 @@ class GameManager:
                                 'game-nr': data['game-nr'],
                                 'game_move_board': self.game_data[data['game-nr']].game_board_move,
                                 'player_points': [player_1_score, player_2_score]})
+            to_return = {'status': 'ok', 'game-result': 'defeated', 'detail': 'game-abandoned'}
             if data['player-nr'] == 1:
-                self._update_ranking_after_game(
-                        self.user_manager.get_clients_user(self.game_data[data['game-nr']].player_client[0]),
-                        0,
-                        self.user_manager.get_clients_user(self.game_data[data['game-nr']].player_client[1]),
-                        1, 2)
+                deferred = self._deferred_ranking_update(data['game-nr'], 0, 1, 2, to_return)
             else:
-                self._update_ranking_after_game(
-                        self.user_manager.get_clients_user(self.game_data[data['game-nr']].player_client[0]),
-                        1,
-                        self.user_manager.get_clients_user(self.game_data[data['game-nr']].player_client[1]),
-                        0, 1)
+                deferred = self._deferred_ranking_update(data['game-nr'], 1, 0, 1, to_return)
             del self.game_data[data['game-nr']]
-            return {'status': 'ok', 'game-result': 'defeated', 'detail': 'game-abandoned'}
+            return deferred
         elif data['command'] == 'quit-searching':
             #
             # we check if client is waiting for a match, and then stop it
@@ -728,11 +931,6 @@ class GameManager:
                         player_2_score += self.game_data[data['game-nr']].game_board_point[i][j]
             if is_it_end:
                 if player_1_score > player_2_score:
-                    self._update_ranking_after_game(
-                        self.user_manager.get_clients_user(self.game_data[data['game-nr']].player_client[0]),
-                        player_1_score,
-                        self.user_manager.get_clients_user(self.game_data[data['game-nr']].player_client[1]),
-                        player_2_score, 1)
                     self.server.notify(self.game_data[data['game-nr']].player_client[2 - data['player-nr']], 15,
                                        {'notification': 'game-finished', 'winner': 1, 'detail': 'no-more-moves',
                                         'game-nr': data['game-nr'],
@@ -743,14 +941,11 @@ class GameManager:
                                  'game-nr': data['game-nr'],
                                  'game_move_board': self.game_data[data['game-nr']].game_board_move,
                                  'player_points': [player_1_score, player_2_score]}
+                    deferred = self._deferred_ranking_update(data['game-nr'], player_1_score, player_2_score,
+                                                             to_return['winner'], to_return)
                     del self.game_data[data['game-nr']]
-                    return to_return
+                    return deferred
                 elif player_2_score > player_1_score:
-                    self._update_ranking_after_game(
-                        self.user_manager.get_clients_user(self.game_data[data['game-nr']].player_client[0]),
-                        player_1_score,
-                        self.user_manager.get_clients_user(self.game_data[data['game-nr']].player_client[1]),
-                        player_2_score, 2)
                     self.server.notify(self.game_data[data['game-nr']].player_client[2 - data['player-nr']], 15,
                                        {'notification': 'game-finished', 'winner': 2, 'detail': 'no-more-moves',
                                         'game-nr': data['game-nr'],
@@ -760,14 +955,11 @@ class GameManager:
                                  'game-nr': data['game-nr'],
                                  'game_move_board': self.game_data[data['game-nr']].game_board_move,
                                  'player_points': [player_1_score, player_2_score]}
+                    deferred = self._deferred_ranking_update(data['game-nr'], player_1_score, player_2_score,
+                                                             to_return['winner'], to_return)
                     del self.game_data[data['game-nr']]
-                    return to_return
+                    return deferred
                 else:
-                    self._update_ranking_after_game(
-                        self.user_manager.get_clients_user(self.game_data[data['game-nr']].player_client[0]),
-                        player_1_score,
-                        self.user_manager.get_clients_user(self.game_data[data['game-nr']].player_client[1]),
-                        player_2_score, 0)
                     self.server.notify(self.game_data[data['game-nr']].player_client[2 - data['player-nr']], 15,
                                        {'notification': 'game-finished', 'winner': 0, 'detail': 'no-more-moves',
                                         'game-nr': data['game-nr'],
@@ -777,8 +969,10 @@ class GameManager:
                                  'game-nr': data['game-nr'],
                                  'game_move_board': self.game_data[data['game-nr']].game_board_move,
                                  'player_points': [player_1_score, player_2_score]}
+                    deferred = self._deferred_ranking_update(data['game-nr'], player_1_score, player_2_score,
+                                                             to_return['winner'], to_return)
                     del self.game_data[data['game-nr']]
-                    return to_return
+                    return deferred
             self.server.notify(self.game_data[data['game-nr']].player_client[2 - data['player-nr']], 15,
                                {'notification': 'your-new-turn',
                                 'game-nr': data['game-nr'],
@@ -794,15 +988,18 @@ class GameManager:
             #
             if data.get('id') is None:
                 return {'status': 'error', 'code': 'NO_ID'}
-            this_user = self.db_session.query(User).filter(User.id == data['id']).first()
-            self.db_session.flush()
-            if not this_user:
-                return {'status': 'error', 'code': 'NO_SUCH_USER'}
-            this_ranking = self.db_session.query(User).order_by(desc(User.ranking)).all()
-            self.db_session.flush()
-            for i in range(this_ranking.length()):
-                if this_ranking[i].id == this_user.id:
-                    return {'status': 'ok', 'ranking-position': i}
+
+            def get_ranking_position():
+                with self.repository.unit_of_work() as unit:
+                    this_user = unit.get_user_by_id(data['id'])
+                    if not this_user:
+                        return {'status': 'error', 'code': 'NO_SUCH_USER'}
+                    this_ranking = unit.get_users_by_ranking()
+                    for i in range(len(this_ranking)):
+                        if this_ranking[i].id == this_user.id:
+                            return {'status': 'ok', 'ranking-position': i}
+
+            return Deferred(get_ranking_position)
 
         elif data['command'] == 'match-history-between-2':
             #
@@ -812,37 +1009,16 @@ class GameManager:
                 return {'status': 'error', 'code': 'NO_ID1'}
             if data.get('id2') is None:
                 return {'status': 'error', 'code': 'NO_ID2'}
-            games = self.db_session.query(GameResult).filter(GameResult.player1 == data['id1'],
-                                                             GameResult.player2 == data['id2']).all()
-            games_inverted = self.db_session.query(GameResult).filter(GameResult.player1 == data['id2'],
-                                                                      GameResult.player2 == data['id1']).all()
-            self.db_session.flush()
-            points1 = 0
-            points2 = 0
-            wins1 = 0
-            wins2 = 0
-            draws = 0
-            for i in range(games.length()):
-                points1 += games[i].points1
-                points2 += games[i].points2
-                if games[i].winner == 1:
-                    wins1 += 1
-                elif games[i].winner == 2:
-                    wins2 += 1
-                else:
-                    draws += 1
-            for i in range(games_inverted.length()):
-                points1 += games[i].points2
-                points2 += games[i].points1
-                if games[i].winner == 2:
-                    wins1 += 1
-                elif games[i].winner == 1:
-                    wins2 += 1
-                else:
-                    draws += 1
 
-            return {'status': 'ok', 'points1': points1, 'wins1': wins1, 'points2': points2, 'wins2': wins2,
-                    'draws': 'draws'}
+            def get_match_history():
+                with self.repository.unit_of_work() as unit:
+                    games = unit.get_game_results(player1=data['id1'], player2=data['id2'])
+                    games_inverted = unit.get_game_results(player1=data['id2'], player2=data['id1'])
+                    points1, wins1, points2, wins2, draws = self._summarize_games(games, games_inverted)
+                return {'status': 'ok', 'points1': points1, 'wins1': wins1, 'points2': points2, 'wins2': wins2,
+                        'draws': draws}
+
+            return Deferred(get_match_history)
 
         elif data['command'] == 'match-history-summary':
             #
@@ -850,43 +1026,30 @@ class GameManager:
             #
             if data.get('id') is None:
                 return {'status': 'error', 'code': 'NO_ID'}
-            games = self.db_session.query(GameResult).filter(GameResult.player1 == data['id1']).all()
-            games_inverted = self.db_session.query(GameResult).filter(GameResult.player2 == data['id1']).all()
-            self.db_session.flush()
-            points1 = 0
-            points2 = 0
-            wins1 = 0
-            wins2 = 0
-            draws = 0
-            for i in range(games.length()):
-                points1 += games[i].points1
-                points2 += games[i].points2
-                if games[i].winner == 1:
-                    wins1 += 1
-                elif games[i].winner == 2:
-                    wins2 += 1
-                else:
-                    draws += 1
-            for i in range(games_inverted.length()):
-                points1 += games[i].points2
-                points2 += games[i].points1
-                if games[i].winner == 2:
-                    wins1 += 1
-                elif games[i].winner == 1:
-                    wins2 += 1
-                else:
-                    draws += 1
 
-            return {'status': 'ok', 'points-earned': points1, 'wins': wins1, 'points-lost': points2, 'defeats': wins2,
-                    'draws': 'draws'}
+            def get_match_summary():
+                with self.repository.unit_of_work() as unit:
+                    games = unit.get_game_results(player1=data['id'])
+                    games_inverted = unit.get_game_results(player2=data['id'])
+                    points1, wins1, points2, wins2, draws = self._summarize_games(games, games_inverted)
+                return {'status': 'ok', 'points-earned': points1, 'wins': wins1, 'points-lost': points2,
+                        'defeats': wins2, 'draws': draws}
+
+            return Deferred(get_match_summary)
 
         elif data['command'] == 'get-ranking':
-            pre_ranking = self.db_session.query(User).order_by(desc(User.ranking)).all()
-            ranking = []
-            for i in range(len(pre_ranking)):
-                rank_position = {'position': i, 'id': pre_ranking[i].id, 'username': pre_ranking[i].name, 'points': pre_ranking[i].ranking}
-                ranking.append(rank_position)
-            return {'status': 'ok', 'ranking': ranking}
+
+            def get_ranking():
+                with self.repository.unit_of_work() as unit:
+                    pre_ranking = unit.get_users_by_ranking()
+                    ranking = []
+                    for i in range(len(pre_ranking)):
+                        rank_position = {'position': i, 'id': pre_ranking[i].id, 'username': pre_ranking[i].name,
+                                         'points': pre_ranking[i].ranking}
+                        ranking.append(rank_position)
+                return {'status': 'ok', 'ranking': ranking}
+
+            return Deferred(get_ranking)
 
         elif data['command'] == 'challenge':
             if 'opponent' not in data or self.user_manager.get_users_client(data['opponent']) is None:
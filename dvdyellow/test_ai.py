@@ -0,0 +1,372 @@
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+from random import Random
+from time import perf_counter, sleep
+from unittest.case import TestCase
+
+import dvdyellow.game as g
+from dvdyellow import ai
+from dvdyellow.rules import rules_for
+from dvdyellow.search import AlphaBetaSearch, EndgameSolver, EvaluationCache, MonteCarloSearch, \
+    ParallelAlphaBetaSearch, TranspositionTable
+
+
+class _FakeQuery:
+    def __init__(self, result):
+        self.result = result
+        self.ready = True
+
+
+class _FakeSession:
+    def __init__(self):
+        self.games = dict()
+        self.on_game_found = None
+
+    def process_events(self, timeout=0):
+        pass
+
+
+def _exhaustive_value(rules, values, occupied):
+    """
+    Value of the position computed without any pruning.
+    """
+    if occupied == rules.full:
+        return 0
+    moves = [m[3] for m in rules.legal_moves(occupied)]
+    return max(rules.sum_points(b, values) - _exhaustive_value(rules, values, occupied | m | b)
+               for m, b in zip(moves, rules.blocked_by_moves(occupied, moves)))
+
+
+def _solved_move_value(rules, values, occupied, move):
+    """
+    Exact value of the move.
+    """
+    mask = [m[3] for m in rules.legal_moves(occupied) if m[:3] == move][0]
+    blocked = rules.blocked_by_moves(occupied, [mask])[0]
+    return rules.sum_points(blocked, values) - _exhaustive_value(rules, values, occupied | mask | blocked)
+
+
+class AiTests(TestCase):
+    def setUp(self):
+        # L-shaped pawn (list of columns)
+        self.pawn = [[1, 1, 1], [1, 0, 0]]
+
+    def make_game(self, point_board):
+        game = g.Game(None, 1, 1, None, g.Pawn(None, self.pawn), point_board)
+        game.moves = []
+
+        def move(point, pawn):
+            game.moves.append((point, pawn.rotation))
+            return _FakeQuery(True)
+        game.move = move
+        return game
+
+    def test_legal_moves(self):
+        """
+        Every enumerated move fits into the board and all of them are found.
+        """
+        board = [[0] * 4 for _ in range(4)]
+        board[1][1] = 1
+        rules = rules_for(self.pawn, 4, 4)
+        moves = rules.legal_moves(rules.board_to_mask(board))
+        for x, y, rotation, _ in moves:
+            self.assertTrue(ai._check_move(g.TransformablePawn(g.Pawn(None, self.pawn), rotation), (x, y), board))
+        expected = 0
+        for rotation in range(4):
+            pawn = g.TransformablePawn(g.Pawn(None, self.pawn), rotation)
+            expected += sum(ai._check_move(pawn, (x, y), board) for x in range(4) for y in range(4))
+        self.assertEqual(len(moves), expected)
+
+    def test_evaluate_moves(self):
+        """
+        Points are given for the fields which cannot be covered after the move.
+        """
+        domino = [[1], [1]]
+        rules = rules_for(domino, 4, 1)
+        values = rules.point_values([[1], [2], [3], [4]])
+        masks = [m for _, _, _, m in rules.legal_moves(0)]
+        # domino at x = 1 leaves two single fields, other moves leave a free pair
+        self.assertListEqual(sorted(zip(masks, rules.evaluate_moves(0, masks, values))),
+                             sorted([(0b0011, 0), (0b0110, 5), (0b1100, 0)]))
+        self.assertEqual(ai._calc_points(g.TransformablePawn(g.Pawn(None, domino)), (1, 0),
+                                         [[0], [0], [0], [0]], [[1], [2], [3], [4]]), 5)
+
+    def test_no_legal_moves(self):
+        """
+        Nearly full board has no moves and the bot does not move at all.
+        """
+        game = self.make_game([[1] * 3 for _ in range(3)])
+        game.move_board = [[1, 0, 1], [0, 1, 0], [1, 0, 1]]
+        rules = rules_for(self.pawn, 3, 3)
+        self.assertListEqual(rules.legal_moves(rules.board_to_mask(game.move_board)), [])
+        ai.my_turn(game)
+        self.assertListEqual(game.moves, [])
+
+    def test_my_turn_last_move(self):
+        """
+        The bot finds the only legal move left.
+        """
+        game = self.make_game([[1] * 3 for _ in range(3)])
+        game.move_board = [[0, 0, 0], [0, 1, 1], [1, 1, 1]]
+        ai.my_turn(game)
+        self.assertEqual(len(game.moves), 1)
+        (x, y), rotation = game.moves[0]
+        self.assertTrue(ai._check_move(g.TransformablePawn(game.pawn, rotation), (x, y), game.move_board))
+
+    def test_alpha_beta_exact(self):
+        """
+        Search till the end of the game finds the best point difference.
+        """
+        rules = rules_for([[1, 1], [1, 0]], 4, 3)
+        values = rules.point_values([[1, 5, 2], [3, 9, 1], [7, 1, 4], [2, 6, 8]])
+        occupied = rules.board_to_mask([[0, 0, 0], [0, 0, 1], [0, 1, 0], [0, 0, 0]])
+        occupied |= rules.blocked(occupied)
+        move, value, depth = AlphaBetaSearch(rules, values, table_size=256).search(occupied, 60.)
+        self.assertEqual(value, _exhaustive_value(rules, values, occupied))
+        blocked = rules.blocked_by_moves(occupied, [move[3]])[0]
+        self.assertEqual(rules.sum_points(blocked, values) -
+                         _exhaustive_value(rules, values, occupied | move[3] | blocked), value)
+
+    def test_parallel_alpha_beta(self):
+        """
+        Search in many processes finds the same move as the search in one process.
+        """
+        rules = rules_for([[1, 1], [1, 0]], 4, 3)
+        values = rules.point_values([[1, 5, 2], [3, 9, 1], [7, 1, 4], [2, 6, 8]])
+        occupied = rules.board_to_mask([[0, 0, 0], [0, 0, 1], [0, 0, 0], [0, 0, 0]])
+        expected = AlphaBetaSearch(rules, values).search(occupied, 60., max_depth=3)
+        with Pool(2) as pool:
+            for workers in (2, 3):
+                engine = ParallelAlphaBetaSearch(rules, values, pool, workers)
+                self.assertEqual(engine.search(occupied, 60., max_depth=3), expected)
+
+    def test_parallel_alpha_beta_history(self):
+        """
+        Result of the parallel search does not depend on the number of processes and on earlier searches
+        done by the processes (their transposition tables are kept between searches of the game).
+        """
+        rules = rules_for([[1, 1], [1, 0]], 5, 4)
+        values = rules.point_values([[1, 5, 2, 7], [3, 9, 1, 2], [7, 1, 4, 6], [2, 6, 8, 3], [5, 2, 9, 1]])
+        occupied = rules.board_to_mask([[0, 0, 0, 0], [0, 0, 1, 0], [0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0]])
+        expected = AlphaBetaSearch(rules, values).search(occupied, 60., max_depth=3)
+        with Pool(3) as pool:
+            for workers in (1, 2, 3, 3, 2, 1):
+                engine = ParallelAlphaBetaSearch(rules, values, pool, workers)
+                self.assertEqual(engine.search(occupied, 60., max_depth=3), expected)
+                # deeper searches of this and the next positions are spread over the processes differently
+                engine.search(occupied, 60., max_depth=5)
+                for move in rules.legal_moves(occupied)[:workers]:
+                    engine.search(occupied | move[3] | rules.blocked_by_moves(occupied, [move[3]])[0], 60.,
+                                  max_depth=4)
+
+    def test_interrupt_parallel_alpha_beta(self):
+        """
+        Interrupted parallel search stops in the middle of a depth and returns the best move found so far.
+        """
+        game = self.make_game([[(x * 7 + y * 3) % 10 for y in range(10)] for x in range(10)])
+        rules = rules_for(self.pawn, 10, 10)
+        strategy = ai.AlphaBetaStrategy(30., workers=2)
+        with ThreadPoolExecutor(1) as executor:
+            future = executor.submit(strategy.choose_move, game)
+            # the first depths are done quickly, the next one takes much longer than the test
+            sleep(2.)
+            start = perf_counter()
+            strategy.interrupt()
+            move = future.result()
+        self.assertLess(perf_counter() - start, 2.)
+        self.assertIn(move, [m[:3] for m in rules.legal_moves(0)])
+        strategy.resume()
+        strategy.close()
+
+    def test_transposition_table_replacement(self):
+        """
+        Deeper entries are kept within one search, entries of older searches are replaced.
+        """
+        table = TranspositionTable(4)
+        table.store(1, 5, 10, 0, 0b11)
+        table.store(5, 2, 20, 0, 0b11)
+        self.assertIsNone(table.probe(5))
+        self.assertEqual(table.probe(1), (5, 10, 0, 0b11))
+        table.new_search()
+        table.store(5, 2, 20, 0, 0b11)
+        self.assertIsNone(table.probe(1))
+        self.assertEqual(table.probe(5), (2, 20, 0, 0b11))
+
+    def test_evaluation_cache(self):
+        """
+        Cached evaluations are the same as computed ones, the least recently used are evicted.
+        """
+        rules = rules_for(self.pawn, 4, 4)
+        occupied = rules.board_to_mask([[0, 0, 0, 0], [0, 1, 1, 0], [0, 0, 0, 0], [0, 0, 0, 0]])
+        masks = [m[3] for m in rules.legal_moves(occupied)]
+        cache = EvaluationCache(len(masks) + 1)
+        self.assertListEqual(cache.blocked_by_moves(rules, occupied, masks), rules.blocked_by_moves(occupied, masks))
+        self.assertListEqual(cache.blocked_by_moves(rules, occupied, masks[::-1]),
+                             rules.blocked_by_moves(occupied, masks[::-1]))
+        self.assertEqual((cache.hits, cache.misses), (len(masks), len(masks)))
+
+        # the same boards with other pawn are different entries
+        domino = rules_for([[1], [1]], 4, 4)
+        cache.blocked_by_moves(domino, 0, [0b11, 0b110000])
+        self.assertEqual(cache.misses, len(masks) + 2)
+        self.assertEqual(len(cache.entries), len(masks) + 1)
+        # the last used entries of the second query are kept
+        cache.blocked_by_moves(rules, occupied, masks[:1])
+        self.assertEqual(cache.misses, len(masks) + 2)
+        cache.blocked_by_moves(rules, occupied, masks[-1:])
+        self.assertEqual(cache.misses, len(masks) + 3)
+
+        # boards of other sizes are different entries (rules put into the cache as the first and the third
+        # ones gave the same keys when the number of rules was put above the bitboard)
+        cache = EvaluationCache()
+        line = rules_for([[1, 1]], 1, 11)
+        rectangle = rules_for([[1, 1]], 2, 5)
+        # fields 4 and 5 are free - neighbours in the line, but not in the rectangle
+        self.assertListEqual(cache.blocked_by_moves(line, 0b11111001111, [0]), [0])
+        cache.blocked_by_moves(domino, 0, [0b11])
+        self.assertListEqual(cache.blocked_by_moves(rectangle, 0b1111001111, [0]), [0b110000])
+
+        hits = ai.evaluation_cache.hits
+        game = self.make_game([[1] * 4 for _ in range(4)])
+        ai.GreedyStrategy().choose_move(game)
+        ai.GreedyStrategy().choose_move(game)
+        self.assertGreater(ai.evaluation_cache.hits, hits)
+
+    def test_playout(self):
+        """
+        Random playouts end the game and give points to the right player.
+        """
+        rules = rules_for([[1], [1]], 4, 1)
+        values = rules.point_values([[1], [2], [3], [4]])
+        generator = Random(0)
+        results = {rules.playout(0, values, generator) for _ in range(50)}
+        # domino in the middle blocks both ends, otherwise each player moves once
+        self.assertSetEqual(results, {(5, 1), (0, 2)})
+
+    def test_monte_carlo(self):
+        """
+        Tree search finds the winning move and reuses the tree after opponent's reply.
+        """
+        rules = rules_for([[1], [1]], 4, 1)
+        engine = MonteCarloSearch(rules, rules.point_values([[1], [2], [3], [4]]), seed=0)
+        self.assertEqual(engine.search(0, iterations=200)[3], 0b0110)
+        self.assertIsNone(engine.search(rules.full, iterations=10))
+
+        rules = rules_for(self.pawn, 4, 4)
+        engine = MonteCarloSearch(rules, rules.point_values([[1] * 4 for _ in range(4)]), seed=0)
+        engine.search(0, iterations=500)
+        reply = max(engine.root.children, key=lambda c: c.visits)
+        self.assertIs(engine._find_root(reply.occupied), reply)
+        engine.search(reply.occupied, iterations=10)
+        self.assertGreater(engine.playouts_per_second, 0)
+
+    def test_endgame(self):
+        """
+        Solver finds the exact value and is used only when few fields are free.
+        """
+        rules = rules_for(self.pawn, 4, 3)
+        values = rules.point_values([[1, 5, 2], [3, 9, 1], [7, 1, 4], [2, 6, 8]])
+        occupied = rules.board_to_mask([[0, 0, 0], [0, 0, 1], [0, 0, 0], [0, 0, 0]])
+        occupied |= rules.blocked(occupied)
+        move, value = EndgameSolver(rules, values).solve(occupied)
+        self.assertEqual(value, _exhaustive_value(rules, values, occupied))
+
+        game = self.make_game([[1, 5, 2], [3, 9, 1], [7, 1, 4], [2, 6, 8]])
+        game.move_board = [[0, 0, 0], [0, 0, 1], [0, 0, 0], [0, 0, 0]]
+        strategy = ai.EndgameStrategy(ai.GreedyStrategy(), threshold=5)
+        strategy.choose_move(game)
+        self.assertDictEqual(strategy.solvers, {})
+        strategy.threshold = 11
+        ai.my_turn(game, strategy)
+        self.assertIn(game.gid, strategy.solvers)
+        (x, y), rotation = game.moves[0]
+        self.assertEqual(_solved_move_value(rules, values, occupied, (x, y, rotation)), value)
+
+    def test_pondering(self):
+        """
+        Answer to predicted opponent's move is prepared during opponent's turn.
+        """
+        game = self.make_game([[1, 5, 2, 3], [3, 9, 1, 1], [7, 1, 4, 2], [2, 6, 8, 5]])
+        rules = rules_for(self.pawn, 4, 4)
+        strategy = ai.PonderingStrategy(ai.AlphaBetaStrategy(0.05), replies=100)
+        strategy.move_done(game)
+        strategy.thread.join()
+        opponent_move = rules.legal_moves(0)[0][3]
+        game.move_board = rules.mask_to_board(opponent_move | rules.blocked_by_moves(0, [opponent_move])[0])
+        move = strategy.choose_move(game)
+        self.assertEqual(strategy.hits, 1)
+        self.assertIn(move, [m[:3] for m in rules.legal_moves(rules.board_to_mask(game.move_board))])
+
+        # unexpected position - the move is searched normally
+        strategy.move_done(game)
+        game.move_board = [[1, 1, 0, 0], [1, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0]]
+        self.assertIsNotNone(strategy.choose_move(game))
+        self.assertEqual(strategy.misses, 1)
+        strategy.close()
+
+    def test_pondering_keeps_search_tree(self):
+        """
+        Pondering does not lose the search tree of the real game, whether the prediction hits or misses.
+        """
+        game = self.make_game([[(x * 7 + y * 3) % 10 for y in range(10)] for x in range(10)])
+        rules = rules_for(self.pawn, 10, 10)
+        monte_carlo = ai.MonteCarloStrategy(None, iterations=300)
+        strategy = ai.PonderingStrategy(monte_carlo, replies=2)
+        strategy.choose_move(game)
+        engine = monte_carlo.engines[game.gid]
+        root = engine.root
+        game.move_board = rules.mask_to_board(root.occupied)
+
+        strategy.move_done(game)
+        strategy.thread.join()
+        self.assertIs(engine.root, root)
+        answers = dict(strategy.answers[game.gid])
+        self.assertTrue(answers)
+
+        # missed prediction - the search continues in the tree of the real position
+        reply = next(c for c in root.children if c.occupied not in answers)
+        game.move_board = rules.mask_to_board(reply.occupied)
+        strategy.choose_move(game)
+        self.assertEqual(strategy.misses, 2)
+        self.assertIn(engine.root, reply.children)
+
+        # hit - the tree is the one searched for the predicted position
+        strategy.move_done(game)
+        strategy.thread.join()
+        predicted_occupied, (move, state) = next(iter(strategy.answers[game.gid].items()))
+        game.move_board = rules.mask_to_board(predicted_occupied)
+        self.assertEqual(strategy.choose_move(game), move)
+        self.assertEqual(strategy.hits, 1)
+        self.assertIs(engine.root, state)
+        strategy.close()
+
+    def test_bot_runner(self):
+        """
+        Runner moves in many games at once (also as the first player) and forgets finished games.
+        """
+        session = _FakeSession()
+        with ThreadPoolExecutor(2, initializer=ai._init_worker, initargs=(ai.GreedyStrategy,)) as executor:
+            runner = ai.BotRunner(session, executor)
+            games = []
+            for gid in range(6):
+                game = self.make_game([[1] * 4 for _ in range(4)])
+                game.gid = gid
+                game.player_number = 1 + gid % 2
+                session.games[gid] = game
+                session.on_game_found(game)
+                games.append(game)
+            for game in games[1::2]:
+                game.on_your_turn(game)
+            for _ in range(1000):
+                if not runner.thinking and not runner.moving:
+                    break
+                runner.step(0.01)
+
+        rules = rules_for(self.pawn, 4, 4)
+        for game in games:
+            self.assertEqual(len(game.moves), 1)
+            (x, y), rotation = game.moves[0]
+            self.assertIn((x, y, rotation), [m[:3] for m in rules.legal_moves(0)])
+        games[0].on_finish(games[0])
+        self.assertEqual(runner.active_games, 5)
+        self.assertNotIn(0, session.games)
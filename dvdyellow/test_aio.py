@@ -0,0 +1,213 @@
+import asyncio
+import gc
+import pickle
+import struct
+from unittest.case import TestCase
+
+from dvdyellow import aio
+from dvdyellow.aio import AsyncSession
+from dvdyellow.game import TransformablePawn
+from dvdyellow.network import _accept_message, _hello_message_size
+
+
+class _FakeServer:
+    """
+    Server speaking the protocol of network.Server, answering queries with a function.
+    """
+    def __init__(self, handler):
+        self.handler = handler      # (server, module, data) -> response
+        self.writers = []
+        self.queries = []
+
+    def notify(self, channel, data):
+        for writer in self.writers:
+            self._send(writer, channel, data)
+
+    @staticmethod
+    def _send(writer, channel, data):
+        msg = pickle.dumps((channel, data))
+        writer.write(struct.pack('I', len(msg)) + msg)
+
+    async def serve(self, reader, writer):
+        await reader.readexactly(_hello_message_size)
+        writer.write(_accept_message.ljust(_hello_message_size, b'\x00'))
+        self.writers.append(writer)
+        try:
+            while True:
+                size = struct.unpack('I', await reader.readexactly(4))[0]
+                module, data = pickle.loads(await reader.readexactly(size))
+                self.queries.append(data.get('command'))
+                response = self.handler(self, module, data)
+                if asyncio.iscoroutine(response):
+                    response = await response
+                self._send(writer, 0, response)
+        except asyncio.IncompleteReadError:
+            pass
+
+
+class AsyncSessionTests(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def run_with_server(self, handler, client):
+        async def main():
+            fake = _FakeServer(handler)
+            server = await asyncio.start_server(fake.serve, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                session = await AsyncSession.create('127.0.0.1', port)
+                try:
+                    return await client(session, fake)
+                finally:
+                    await session.close()
+            finally:
+                server.close()
+                await server.wait_closed()
+        return self.loop.run_until_complete(asyncio.wait_for(main(), 10))
+
+    def test_queries(self):
+        """
+        Queries of many sessions run concurrently and responses are matched to queries in order.
+        """
+        async def slow_handler(server, module, data):
+            await asyncio.sleep(0.01)
+            return {'status': 'ok' if data['password'] == 'good' else 'error'}
+
+        def handler(server, module, data):
+            if data['command'] == 'sign-in':
+                return slow_handler(server, module, data)
+            if data['command'] == 'get-names':
+                return {'status': 'ok', 'names': {uid: 'user{}'.format(uid) for uid in data['ids']}}
+            return {'status': 'ok', 'waiting-dict': {1: 'connected'}}
+
+        async def client(session, server):
+            results = await asyncio.gather(session.sign_in('a', 'good'), session.sign_in('a', 'bad'),
+                                           session.sign_in('a', 'good'))
+            room = await session.get_waiting_room()
+            users = await session.prefetch_users(room.get_online_users() + [2])
+            names = [await u.name for u in users]
+            return results, server.queries, names
+
+        results, queries, names = self.run_with_server(handler, client)
+        self.assertListEqual(results, [True, False, True])
+        self.assertListEqual(queries[3:], ['set-status', 'start-listening', 'get-waiting-room', 'get-names'])
+        self.assertListEqual(names, ['user1', 'user2'])
+
+    def test_waiting_room_failure(self):
+        """
+        When joining Waiting Room fails, responses of all the steps are awaited and the room gets no notifications.
+        """
+        errors = []
+        self.loop.set_exception_handler(lambda loop, context: errors.append(context))
+
+        def handler(server, module, data):
+            if data['command'] == 'set-status':
+                return {'status': 'error'}
+            # the next steps are not answered
+            server.writers[0].transport.abort()
+            return {'status': 'ok'}
+
+        async def client(session, server):
+            room = await session.get_waiting_room()
+            return room, session.connection.notification_handler.get(13)
+
+        room, notification_handler = self.run_with_server(handler, client)
+        gc.collect()
+        self.assertIsNone(room)
+        self.assertIsNone(notification_handler)
+        self.assertListEqual(errors, [])
+
+    def test_game_notifications(self):
+        """
+        New game and turns are delivered to coroutine handlers and notification iterators.
+        """
+        def handler(server, module, data):
+            if data['command'] == 'move':
+                return {'status': 'ok', 'game-status': 'finished', 'game-nr': 7, 'winner': 2,
+                        'player_points': [0, 3], 'game_move_board': [[1, -2], [2, 2]]}
+            server.notify(14, {'notification': 'opponent-found', 'opponent-id': 1, 'game-nr': 7,
+                               'player-number': 2, 'game-board': [[1, 3], [1, 1]], 'game-pawn': [[1, 1]]})
+            server.notify(15, {'notification': 'your-new-turn', 'game-nr': 7, 'player_points': [0, 0],
+                               'game_move_board': [[1, 0], [0, 0]]})
+            return {'status': 'ok', 'game-status': 'waiting'}
+
+        async def client(session, server):
+            finished = asyncio.Future()
+            notifications = session.notifications(14, 15)
+
+            def on_game_found(game):
+                game.on_finish = finished.set_result
+                game.on_your_turn = on_your_turn
+
+            async def on_your_turn(game):
+                self.assertTrue(await game.move((1, 0), TransformablePawn(game.pawn)))
+
+            session.on_game_found = on_game_found
+            self.assertIsNone(await session.set_want_to_play())
+            game = await finished
+            channels = [(await notifications.__anext__())[0] for _ in range(2)]
+            notifications.close()
+            rest = []
+            async for item in notifications:
+                rest.append(item)
+            return game, channels, rest
+
+        game, channels, rest = self.run_with_server(handler, client)
+        self.assertEqual(game.result, 'won')
+        self.assertListEqual(game.player_points, [0, 3])
+        self.assertListEqual(channels, [14, 15])
+        self.assertListEqual(rest, [])
+
+    def test_notifications_overflow(self):
+        """
+        Iterator which is not read keeps only the newest notifications and still ends when the connection is closed.
+        """
+        def handler(server, module, data):
+            for i in range(10):
+                server.notify(14, {'number': i})
+            return {'status': 'ok'}
+
+        async def client(session, server):
+            notifications = session.notifications(14, maxsize=3)
+            self.assertTrue(await session.sign_in('a', 'good'))
+            await session.close()
+            numbers = []
+            async for channel, data in notifications:
+                numbers.append(data['number'])
+            return numbers, notifications.dropped
+
+        numbers, dropped = self.run_with_server(handler, client)
+        self.assertListEqual(numbers, [8, 9])
+        self.assertEqual(dropped, 8)
+
+    def test_handler_errors(self):
+        """
+        Coroutine handlers are kept till they finish and their errors are logged.
+        """
+        def handler(server, module, data):
+            server.notify(13, {'notification': 'status-changed'})
+            return {'status': 'ok'}
+
+        async def client(session, server):
+            done = asyncio.Future()
+
+            async def on_notification(channel, data):
+                await asyncio.sleep(0.01)
+                done.set_result(channel)
+                raise ValueError('handler failed')
+
+            session.connection.set_notification_handler(13, on_notification)
+            self.assertTrue(await session.sign_in('a', 'good'))
+            with self.assertLogs('Network', 'ERROR') as logs:
+                await done
+                await asyncio.sleep(0.01)
+            return logs.output, len(aio._handler_tasks)
+
+        output, tasks = self.run_with_server(handler, client)
+        self.assertIn('handler failed', output[0])
+        self.assertEqual(tasks, 0)
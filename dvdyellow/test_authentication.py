@@ -5,7 +5,6 @@ from time import sleep
 from unittest.case import TestCase
 
 from dvdyellow.game import make_session
-from dvdyellow.orm import User
 from dvdyellow.server import ServerManager
 
 
@@ -22,10 +21,9 @@ class AuthenticationTests(TestCase):
                 test_case.server_started = True
             test_case.server_manager.on_run = on_run
 
-            dbs = test_case.server_manager.db_session_type()
-            dbs.add(User(name='john', password='best123'))
-            dbs.add(User(name='lazy', password=''))
-            dbs.flush()
+            with test_case.server_manager.repository.unit_of_work() as unit:
+                unit.add_user('john', 'best123')
+                unit.add_user('lazy', '')
             test_case.server_manager.run()
 
         self.server_thread = Thread(target=server_thread, args=(self,))
@@ -1,11 +1,10 @@
 import threading
 from random import Random, randint
 from threading import Thread
-from sfml import sleep, milliseconds
+from time import sleep
 from unittest.case import TestCase
 
-from dvdyellow.game import make_session
-from dvdyellow.orm import User, GameBoard, GamePawn
+from dvdyellow.game import AsyncQuery, AsyncQueryChain, Game, Pawn, TransformablePawn, make_session
 from dvdyellow.server import ServerManager
 
 
@@ -22,20 +21,19 @@ class GameTests(TestCase):
                 test_case.server_started = True
             test_case.server_manager.on_run = on_run
 
-            dbs = test_case.server_manager.db_session_type()
-            dbs.add(User(name='john', password='best123'))
-            dbs.add(User(name='lazy', password=''))
-            dbs.add(GamePawn(name='test_pawn', width=2, height=3, shapestring="100110"))
-            dbs.add(GameBoard(name='test_board', width=6, height=8, shapestring="0"*48))
-            dbs.flush()
+            with test_case.server_manager.repository.unit_of_work() as unit:
+                unit.add_user('john', 'best123')
+                unit.add_user('lazy', '')
+                unit.add_pawn(name='test_pawn', width=2, height=3, shapestring="100110")
+                unit.add_board(name='test_board', width=6, height=8, shapestring="0"*48)
             test_case.server_manager.run()
 
         self.server_thread = Thread(target=server_thread, args=(self,))
         self.server_thread.start()
 
         while not self.server_started:
-            sleep(milliseconds(10))
-        sleep(milliseconds(100))
+            sleep(0.01)
+        sleep(0.1)
 
     def tearDown(self):
         self.server_manager.stop()
@@ -119,4 +117,132 @@ class GameTests(TestCase):
         session2.process_events()
 
         session2.del_waiting_room().result
-        session2.sign_out().result
\ No newline at end of file
+        session2.sign_out().result
+
+
+class AsyncQueryChainTests(TestCase):
+    def make_query(self, log, name, result):
+        """
+        Query answered after the previous queries (like responses of the server).
+        """
+        def start():
+            log.append(('sent', name))
+            return name
+
+        def get_result(_):
+            log.append(('processed', name))
+            return result
+        return AsyncQuery(start, lambda _: ('sent', name) in log, get_result), lambda r: r[-1]
+
+    def test_pipelined_chain(self):
+        """
+        All queries are sent at once, results after the first failure are discarded.
+        """
+        log = []
+        chain = AsyncQueryChain(self.make_query(log, 'a', True), self.make_query(log, 'b', True),
+                                self.make_query(log, 'c', 'room'), pipelined=True).run()
+        self.assertListEqual(log, [('sent', 'a'), ('sent', 'b'), ('sent', 'c')])
+        self.assertEqual(chain.result, 'room')
+        self.assertListEqual(chain.all_results, [True, True, 'room'])
+
+        log = []
+        chain = AsyncQueryChain(self.make_query(log, 'a', True), self.make_query(log, 'b', False),
+                                self.make_query(log, 'c', 'room'), pipelined=True).run()
+        self.assertIsNone(chain.result)
+        self.assertNotIn(('processed', 'c'), log)
+
+        log = []
+        chain = AsyncQueryChain(self.make_query(log, 'a', True), self.make_query(log, 'b', True)).run()
+        self.assertListEqual(log, [('sent', 'a')])
+        self.assertTrue(chain.result)
+        self.assertListEqual(log, [('sent', 'a'), ('processed', 'a'), ('sent', 'b'), ('processed', 'b')])
+
+
+class _FakeQuery:
+    """
+    Network query answered by the test.
+    """
+    def __init__(self):
+        self.response = None
+
+    def check(self):
+        return self.response is not None
+
+
+class _FakeClient:
+    def __init__(self):
+        self.queries = []
+
+    def query(self, channel, data):
+        self.queries.append(_FakeQuery())
+        return self.queries[-1]
+
+
+class _FakeSession:
+    def __init__(self):
+        self.client = _FakeClient()
+
+
+class GameLegalityTests(TestCase):
+    @staticmethod
+    def brute_force(game):
+        """
+        Finds legal moves checking every field covered by the pawn.
+        """
+        moves = []
+        for rotation in range(4):
+            pawn = TransformablePawn(game.pawn, rotation)
+            for x in range(game.width):
+                for y in range(game.height):
+                    if all(game.get_field(x + ix, y + iy)[0] == 0 for ix in range(pawn.width)
+                           for iy in range(pawn.height) if pawn.get_pawn_point(ix, iy)):
+                        moves.append((x, y, rotation))
+        return sorted(moves)
+
+    def test_legal_placements(self):
+        """
+        Legality is checked locally and follows changes of the move board.
+        """
+        # corner pawn: (0, 0), (0, 1) and (1, 1)
+        game = Game(None, 1, 1, None, Pawn(None, [[1, 1], [0, 1]]), [[1, 1, 1], [1, 1, 1], [0, 1, 1]])
+        pawn = TransformablePawn(game.pawn)
+        self.assertTrue(game.is_legal((0, 0), pawn))
+        self.assertTrue(game.is_legal((1, 1), pawn))
+        self.assertFalse(game.is_legal((2, 0), pawn))     # outside of the board
+        self.assertFalse(game.is_legal((-1, 0), pawn))
+        pawn.rotate_clockwise()
+        self.assertFalse(game.is_legal((1, 0), pawn))     # covers field without points
+        self.assertListEqual(sorted(game.legal_placements()), self.brute_force(game))
+
+        game.move_board = [[1, 1, 0], [0, 1, 0], [-3, 0, 0]]
+        self.assertFalse(game.is_legal((0, 0), TransformablePawn(game.pawn)))
+        self.assertListEqual(game.legal_placements(), [(1, 1, 3)])
+
+        # symmetric pawn - rotations 2 and 3 are the same as 0 and 1
+        game = Game(None, 1, 2, None, Pawn(None, [[1, 1]]), [[1, 2, 3], [4, 5, 6]])
+        self.assertListEqual(sorted(game.legal_placements()), self.brute_force(game))
+        self.assertEqual(len(game.legal_placements()), 2 * (2 * 2 + 3))
+
+    def test_optimistic_move(self):
+        """
+        Optimistic move is applied at once, rolled back when rejected and replaced by the server's board.
+        """
+        session = _FakeSession()
+        game = Game(session, 1, 1, None, Pawn(None, [[1, 1]]), [[1, 2, 3]])
+        query = game.move((0, 0), TransformablePawn(game.pawn), optimistic=True)
+        self.assertFalse(query.ready)
+        self.assertListEqual(game.move_board, [[1, 1, -1]])     # the last field cannot be covered any more
+        self.assertListEqual(game.player_points, [3, 0])
+        session.client.queries[-1].response = {'status': 'error', 'code': 'WRONG_MOVE'}
+        self.assertFalse(query.result)
+        self.assertListEqual(game.move_board, [[0, 0, 0]])
+        self.assertListEqual(game.player_points, [0, 0])
+
+        query = game.move((0, 1), TransformablePawn(game.pawn), optimistic=True)
+        self.assertListEqual(game.move_board, [[-1, 1, 1]])
+        server_board = [[-1, 1, 1]]
+        session.client.queries[-1].response = {'status': 'ok', 'game-status': 'opponents-turn',
+                                               'game_move_board': server_board, 'player_points': [1, 0]}
+        self.assertTrue(query.result)
+        self.assertIs(game.move_board, server_board)
+        self.assertListEqual(game.player_points, [1, 0])
@@ -1,22 +1,32 @@
 from unittest.case import TestCase
 from threading import Thread
 
-from sfml.system import sleep, milliseconds
+from time import sleep
 
-from dvdyellow.network import Server, Client
+from dvdyellow.network import Server, Client, Deferred
 
 
 class NetworkTests(TestCase):
     def _connect_loop(self, connector, seconds):
         for i in range(int(seconds * 10)):
             if connector.is_connected: break
-            sleep(milliseconds(100))
+            sleep(0.1)
+
+    def _start_server(self, server, port):
+        """
+        Starts the server in a new thread and waits until it listens.
+        """
+        thread = Thread(target=Server.listen, args=(server, '127.0.0.1', port))
+        thread.start()
+        for i in range(100):
+            if server.working: break
+            sleep(0.01)
+        return thread
 
     def test_connect(self):
         server = Server(lambda x: True)
         client = Client(123)
-        srv_th = Thread(target=Server.listen, args=(server, '127.0.0.1', 1236))
-        srv_th.start()
+        srv_th = self._start_server(server, 1236)
 
         def stop_network(timeout):
             client.disconnect()
@@ -39,8 +49,7 @@ class NetworkTests(TestCase):
         # some echo module ;-)
         server.set_query_handler(7, lambda cid, msg: msg)
         client = Client(1)
-        srv_th = Thread(target=Server.listen, args=(server, '127.0.0.1', 1235))
-        srv_th.start()
+        srv_th = self._start_server(server, 1235)
 
         def stop_network(timeout):
             client.disconnect()
@@ -84,8 +93,7 @@ class NetworkTests(TestCase):
         consumer = Client(1)    # client wanting notification
         producer = Client(1)    # client making notification sending
 
-        srv_th = Thread(target=Server.listen, args=(server, '127.0.0.1', 1234))
-        srv_th.start()
+        srv_th = self._start_server(server, 1234)
 
         def stop_network(timeout):
             consumer.disconnect()
@@ -124,7 +132,7 @@ class NetworkTests(TestCase):
         for i in range(30):
             consumer.receive_all()
             if got_notification: break
-            sleep(milliseconds(100))
+            sleep(0.1)
 
         try:
             self.assertTrue(got_notification)
@@ -134,3 +142,140 @@ class NetworkTests(TestCase):
 
         stop_network(2.)
         self.assertFalse(srv_th.is_alive())
+
+    def test_deferred_query(self):
+        """
+        Deferred responses are computed in worker threads, but queries of a client are answered in order.
+        """
+        server = Server(lambda x: x == 1)
+        server.set_query_handler(7, lambda cid, msg: msg)
+
+        def slow_echo(cid, msg):
+            def work():
+                sleep(0.3)
+                if msg is None:
+                    raise ValueError("Nothing to echo")
+                return msg
+            return Deferred(work, lambda r: {'deferred': r})
+        server.set_query_handler(8, slow_echo)
+
+        client = Client(1)
+        srv_th = self._start_server(server, 1237)
+
+        def stop_network(timeout):
+            client.disconnect()
+            server.close()
+            srv_th.join(timeout=timeout)
+
+        c = client.connect('127.0.0.1', 1237)
+        self._connect_loop(c, 3.)
+        try:
+            self.assertTrue(c.is_connected)
+        except AssertionError:
+            stop_network(2.)
+            raise
+
+        r1 = client.query(8, 'first')
+        r2 = client.query(7, 'second')
+        r3 = client.query(8, None)
+        try:
+            self.assertEqual(r2.response, 'second')
+            self.assertTrue(r1.ready)
+            self.assertDictEqual(r1.response, {'deferred': 'first'})
+            # failed work is reported as an error
+            self.assertDictEqual(r3.response, {'status': 'error', 'code': 'INTERNAL_ERROR'})
+        except AssertionError:
+            stop_network(2.)
+            raise
+
+        stop_network(2.)
+        self.assertFalse(srv_th.is_alive())
+
+    def test_query_wait(self):
+        """
+        Waiting for the response ends with the timeout or as soon as the response comes.
+        """
+        server = Server(lambda x: x == 1)
+
+        def slow_echo(cid, msg):
+            def work():
+                sleep(0.3)
+                return msg
+            return Deferred(work)
+        server.set_query_handler(8, slow_echo)
+
+        client = Client(1)
+        srv_th = self._start_server(server, 1238)
+
+        def stop_network(timeout):
+            client.disconnect()
+            server.close()
+            srv_th.join(timeout=timeout)
+
+        c = client.connect('127.0.0.1', 1238)
+        self._connect_loop(c, 3.)
+        try:
+            self.assertTrue(c.is_connected)
+        except AssertionError:
+            stop_network(2.)
+            raise
+
+        r = client.query(8, 'slow')
+        try:
+            self.assertFalse(r.wait(0.05))
+            self.assertFalse(r.ready)
+            self.assertTrue(r.wait(3.))
+            self.assertEqual(r.response, 'slow')
+            self.assertFalse(client.wait(0.05))
+        except AssertionError:
+            stop_network(2.)
+            raise
+
+        stop_network(2.)
+        self.assertFalse(srv_th.is_alive())
+
+    def test_slow_client(self):
+        """
+        Client which does not receive its notifications does not stop the server from answering others
+        and is disconnected when too much data waits for it.
+        """
+        server = Server(lambda x: x == 1, outgoing_limit=1 << 23)
+        server.set_query_handler(7, lambda cid, msg: msg)
+        flooded = []
+        disconnected = []
+        server.set_disconnect_handler(disconnected.append)
+
+        def flood(cid, msg):
+            flooded.append(cid)
+            for i in range(64):
+                server.notify(cid, 12, b'x' * (1 << 20))
+            return 'flooded'
+        server.set_query_handler(9, flood)
+
+        slow = Client(1)
+        fast = Client(1)
+        srv_th = self._start_server(server, 1239)
+
+        def stop_network(timeout):
+            slow.disconnect()
+            fast.disconnect()
+            server.close()
+            srv_th.join(timeout=timeout)
+
+        try:
+            for client in (slow, fast):
+                c = client.connect('127.0.0.1', 1239)
+                self._connect_loop(c, 3.)
+                self.assertTrue(c.is_connected)
+
+            # the slow client sends a query, but never reads the notifications sent before the response
+            slow.query(9, None)
+            sleep(0.1)
+            r = fast.query(7, 'echo')
+            self.assertTrue(r.wait(3.))
+            self.assertEqual(r.response, 'echo')
+            self.assertListEqual(disconnected, flooded)
+            self.assertEqual(len(server.clients), 1)
+        finally:
+            stop_network(2.)
+        self.assertFalse(srv_th.is_alive())
@@ -0,0 +1,294 @@
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from unittest.case import TestCase
+
+from dvdyellow.repository import MemoryRepository, ConstraintError
+
+
+class RepositoryTests:
+    """
+    Tests run for each implementation of the repository.
+    """
+    def create_repository(self):
+        raise NotImplementedError()
+
+    def setUp(self):
+        self.repository = self.create_repository()
+        with self.repository.unit_of_work() as unit:
+            unit.add_user('john', 'best123', ranking=3)
+            unit.add_user('lazy', '', ranking=7)
+
+    def tearDown(self):
+        self.repository.close()
+
+    def test_get_user(self):
+        """
+        Users can be found by name and by ID.
+        """
+        with self.repository.unit_of_work() as unit:
+            john = unit.get_user_by_name('john')
+            self.assertEqual(john.password, 'best123')
+            self.assertEqual(unit.get_user_by_id(john.id).name, 'john')
+            self.assertIsNone(unit.get_user_by_name('johnny'))
+
+    def test_get_users(self):
+        """
+        Many users can be found by IDs at once (unknown IDs are skipped).
+        """
+        with self.repository.unit_of_work() as unit:
+            ids = [unit.get_user_by_name('john').id, unit.get_user_by_name('lazy').id]
+            users = unit.get_users(ids + [1000])
+            self.assertSetEqual({u.name for u in users}, {'john', 'lazy'})
+            self.assertListEqual(unit.get_users([]), [])
+
+    def test_add_user_used_name(self):
+        """
+        User names are unique.
+        """
+        with self.assertRaises(ConstraintError):
+            with self.repository.unit_of_work() as unit:
+                unit.add_user('john', 'other')
+
+    def test_ranking(self):
+        """
+        Changed ranking is stored and users are ordered by it.
+        """
+        with self.repository.unit_of_work() as unit:
+            unit.get_user_by_name('john').ranking = 10
+        with self.repository.unit_of_work() as unit:
+            self.assertListEqual([u.name for u in unit.get_users_by_ranking()], ['john', 'lazy'])
+
+    def test_add_to_ranking(self):
+        """
+        Ranking is changed by the given value.
+        """
+        with self.repository.unit_of_work() as unit:
+            uid = unit.get_user_by_name('john').id
+            unit.add_to_ranking(uid, 2.5)
+            unit.add_to_ranking(uid, -1)
+        with self.repository.unit_of_work() as unit:
+            self.assertEqual(unit.get_user_by_id(uid).ranking, 4.5)
+
+    def test_game_results(self):
+        """
+        Game results can be filtered by players.
+        """
+        with self.repository.unit_of_work() as unit:
+            unit.add_game_result(1, 10, 2, 20, 2)
+            unit.add_game_result(2, 5, 1, 3, 1)
+        with self.repository.unit_of_work() as unit:
+            self.assertEqual(len(unit.get_game_results()), 2)
+            self.assertEqual(len(unit.get_game_results(player1=1)), 1)
+            self.assertEqual(unit.get_game_results(player1=2, player2=1)[0].points1, 5)
+            self.assertEqual(len(unit.get_game_results(player1=2, player2=2)), 0)
+
+    def test_boards_and_pawns(self):
+        """
+        Random board and pawn are chosen from the added ones.
+        """
+        with self.repository.unit_of_work() as unit:
+            self.assertIsNone(unit.get_random_board())
+            unit.add_board('board', 6, 8, '1' * 48)
+            unit.add_pawn('pawn', 2, 3, '101110')
+        with self.repository.unit_of_work() as unit:
+            self.assertEqual(unit.get_random_board().shapestring, '1' * 48)
+            self.assertEqual(unit.get_random_pawn().width, 2)
+
+
+class MemoryRepositoryTests(RepositoryTests, TestCase):
+    def create_repository(self):
+        return MemoryRepository()
+
+
+class SqlRepositoryTests(RepositoryTests, TestCase):
+    def create_repository(self):
+        from dvdyellow.orm import SqlRepository
+        return SqlRepository({'drivername': 'sqlite'})
+
+
+class SqlEngineConfigurationTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def make_repository(self, database_config):
+        from dvdyellow.server import ServerManager
+        return ServerManager(config_object={'database': database_config}).repository
+
+    def test_pool_from_configuration(self):
+        """
+        Connection pool of a database file is built from the configuration.
+        """
+        from sqlalchemy.pool import QueuePool
+        repository = self.make_repository({'name': os.path.join(self.directory.name, 'test.db'),
+                                           'pool_size': 2, 'max_overflow': 3, 'pool_recycle': 60})
+        try:
+            pool = repository.engine.pool
+            self.assertIsInstance(pool, QueuePool)
+            self.assertEqual(pool.size(), 2)
+            self.assertEqual(pool._max_overflow, 3)
+            self.assertEqual(pool._recycle, 60)
+            self.assertIsNone(repository.lock)
+        finally:
+            repository.close()
+
+    def test_in_memory_database_pool(self):
+        """
+        In-memory database is shared by one connection and its units of work are serialized.
+        """
+        from sqlalchemy.pool import StaticPool
+        repository = self.make_repository({'pool_size': 2})
+        try:
+            self.assertIsInstance(repository.engine.pool, StaticPool)
+            self.assertIsNotNone(repository.lock)
+        finally:
+            repository.close()
+
+    def test_session_per_unit_of_work(self):
+        """
+        Every unit of work gets its own session, which is closed when the unit ends.
+        """
+        repository = self.make_repository({'name': os.path.join(self.directory.name, 'test.db')})
+        try:
+            with repository.unit_of_work() as unit:
+                first = unit.db_session
+                unit.add_user('john', 'best123')
+            with repository.unit_of_work() as unit:
+                second = unit.db_session
+                self.assertEqual(unit.get_user_by_name('john').name, 'john')
+            self.assertIsNot(first, second)
+            self.assertListEqual(list(first), [])   # closed session keeps no objects
+        finally:
+            repository.close()
+
+
+class SqlHotQueriesTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'test.db')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_sqlite_pragmas(self):
+        """
+        Pragmas of the storage profile are set on every new connection, by default SQLite's settings are kept.
+        """
+        from dvdyellow.orm import SqlRepository
+        from dvdyellow.server import ServerManager
+        server_manager = ServerManager(config_object={'database': {'name': self.path}})
+        self.assertDictEqual(server_manager.db_sqlite_pragmas, dict())
+        server_manager.repository.close()
+
+        repository = SqlRepository({'drivername': 'sqlite', 'database': self.path},
+                                   sqlite_pragmas={'journal_mode': 'WAL', 'synchronous': 'NORMAL'})
+        try:
+            connections = [repository.engine.connect() for i in range(2)]
+            for connection in connections:
+                self.assertEqual(connection.execute('PRAGMA journal_mode').scalar().lower(), 'wal')
+                self.assertEqual(connection.execute('PRAGMA synchronous').scalar(), 1)     # NORMAL
+            for connection in connections:
+                connection.close()
+        finally:
+            repository.close()
+
+    def test_unknown_profile(self):
+        """
+        Unknown storage profile is a configuration error.
+        """
+        from dvdyellow.server import ConfigurationError, ServerManager
+        with self.assertRaises(ConfigurationError):
+            ServerManager(config_object={'database': {'name': self.path, 'sqlite': {'profile': 'fastest'}}})
+
+    def test_prepared_queries(self):
+        """
+        Prepared hot queries return the same data as the queries built by the ORM.
+        """
+        from dvdyellow import orm
+        from dvdyellow.orm import GameResult, SqlRepository, User
+        repository = SqlRepository({'drivername': 'sqlite', 'database': self.path})
+        try:
+            with repository.unit_of_work() as unit:
+                unit.add_user('john', 'best123', ranking=3)
+                unit.add_user('lazy', '', ranking=7)
+
+            db_session = repository.session_type()
+            try:
+                for name in ('john', 'lazy', 'johnny'):
+                    self.assertIs(orm.get_user_by_name(db_session, name),
+                                  db_session.query(User).filter(User.name == name).first())
+                for uid in (1, 2, 3):
+                    self.assertIs(orm.get_user_by_id(db_session, uid),
+                                  db_session.query(User).filter(User.id == uid).first())
+
+                orm.add_game_result(db_session, 1, 10, 2, 20, 2)
+                db_session.add(GameResult(player1=1, points1=10, player2=2, points2=20, winner=2))
+                db_session.commit()
+                rows = [(r.player1, r.points1, r.player2, r.points2, r.winner)
+                        for r in db_session.query(GameResult).order_by(GameResult.id)]
+                self.assertListEqual(rows, [(1, 10, 2, 20, 2)] * 2)
+            finally:
+                db_session.close()
+        finally:
+            repository.close()
+
+
+class MemoryBackendServerTests(TestCase):
+    def test_default_pawn_and_boards(self):
+        """
+        Server with in-memory repository has pawns and boards for games without installing.
+        """
+        from dvdyellow.server import ServerManager
+        server_manager = ServerManager(config_object={'database': {'backend': 'memory'}})
+        with server_manager.repository.unit_of_work() as unit:
+            self.assertIsNotNone(unit.get_random_pawn())
+            self.assertIsNotNone(unit.get_random_board())
+
+    def test_unknown_backend(self):
+        """
+        Unknown database backend is a configuration error.
+        """
+        from dvdyellow.server import ConfigurationError, ServerManager
+        with self.assertRaises(ConfigurationError):
+            ServerManager(config_object={'database': {'backend': 'mongo'}})
+
+
+class ConcurrentRankingTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_concurrent_games(self):
+        """
+        Rankings changed by many games finished at once are not lost.
+        """
+        from dvdyellow.server import ServerManager
+        server_manager = ServerManager(config_object={'database': {'name': os.path.join(self.directory.name,
+                                                                                        'test.db')}})
+        repository = server_manager.repository
+        try:
+            with repository.unit_of_work() as unit:
+                unit.add_user('john', 'best123')
+                unit.add_user('lazy', '')
+                john = unit.get_user_by_name('john').id
+                lazy = unit.get_user_by_name('lazy').id
+
+            update = server_manager.game_manager._update_ranking_after_game
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                futures = [executor.submit(update, john, 10, lazy, 0, 1) for _ in range(200)]
+                for future in futures:
+                    future.result()
+            # the opponent is not signed in any more - the result is stored without changing the ranking
+            update(john, 10, None, 0, 1)
+
+            with repository.unit_of_work() as unit:
+                self.assertEqual(unit.get_user_by_id(john).ranking, 1005.)
+                self.assertEqual(unit.get_user_by_id(lazy).ranking, -1000.)
+                self.assertEqual(len(unit.get_game_results(player1=john)), 201)
+        finally:
+            repository.close()
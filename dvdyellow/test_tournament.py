@@ -0,0 +1,70 @@
+from random import Random
+from unittest.case import TestCase
+
+from dvdyellow import ai, tournament
+
+
+class _IllegalStrategy(ai.Strategy):
+    def choose_move(self, game):
+        return 0, 0, 0
+
+
+class TournamentTests(TestCase):
+    def test_make_boards(self):
+        """
+        Fields which cannot be covered by the pawn get no points like on the server.
+        """
+        pawn = tournament._shape_to_table(*tournament.PAWNS['corner'])
+        point_board, move_board = tournament.make_boards((3, 3, "110" "110" "001"), pawn, Random(0))
+        self.assertEqual(move_board, [[0, 0, -3], [0, 0, -3], [-3, -3, -3]])
+        self.assertEqual(point_board[2], [0, 0, 0])
+        self.assertTrue(all(1 <= point_board[x][y] <= 9 for x in range(2) for y in range(2)))
+
+    def test_play_game(self):
+        """
+        Game is played till the end and points are given for blocked fields only.
+        """
+        result = tournament.play_game((1, (ai.GreedyStrategy, ai.GreedyStrategy), 'small', 'corner', 3))
+        pawn = tournament._shape_to_table(*tournament.PAWNS['corner'])
+        point_board, _ = tournament.make_boards(tournament.BOARDS['small'], pawn, Random(3))
+        self.assertIsNone(result['forfeit'])
+        self.assertLessEqual(sum(result['points']), sum(map(sum, point_board)))
+        # the first player starts, so it makes the same number of moves or one more
+        self.assertIn(len(result['times'][0]) - len(result['times'][1]), (0, 1))
+        self.assertGreater(len(result['times'][0]), 1)
+
+        result = tournament.play_game((2, (ai.GreedyStrategy, _IllegalStrategy), 'small', 'domino', 0))
+        self.assertEqual(result['forfeit'], 2)
+        self.assertEqual(result['winner'], 1)
+
+    def test_separate_evaluation_caches(self):
+        """
+        Each strategy evaluates moves with its own cache, new for every game.
+        """
+        created = []
+
+        def factory(cache):
+            created.append(ai.GreedyStrategy(cache))
+            return created[-1]
+
+        shared = (ai.evaluation_cache.hits, ai.evaluation_cache.misses)
+        for gid in (1, 2):
+            tournament.play_game((gid, (factory, factory), 'small', 'corner', 3))
+        self.assertEqual(len({id(s.cache) for s in created}), 4)
+        self.assertTrue(all(s.cache.misses > 0 for s in created))
+        self.assertTupleEqual((ai.evaluation_cache.hits, ai.evaluation_cache.misses), shared)
+
+    def test_run_tournament(self):
+        """
+        Both strategies play every game once as each player and confidence intervals contain the score.
+        """
+        stats = tournament.run_tournament({'greedy': ai.GreedyStrategy, 'illegal': _IllegalStrategy},
+                                          ['small'], ['domino', 'corner'], rounds=2)
+        self.assertEqual(stats['greedy'].games, 8)
+        self.assertEqual(stats['greedy'].wins, 8)
+        self.assertEqual(stats['illegal'].forfeits, 8)
+        low, high = stats['greedy'].interval
+        self.assertTrue(0.6 < low < 1. and high == 1.)
+        self.assertAlmostEqual(sum(tournament.wilson_interval(5, 10)), 1.)
+        self.assertEqual(tournament.percentile([1, 2, 3, 4], 50), 2)
+        self.assertEqual(tournament.percentile([1, 2, 3, 4], 99), 4)
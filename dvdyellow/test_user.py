@@ -1,11 +1,10 @@
 import threading
 from random import Random, randint
 from threading import Thread
-from sfml import sleep, milliseconds
+from time import sleep
 from unittest.case import TestCase
 
 from dvdyellow.game import make_session
-from dvdyellow.orm import User
 from dvdyellow.server import ServerManager
 
 
@@ -22,18 +21,17 @@ class UserTests(TestCase):
                 test_case.server_started = True
             test_case.server_manager.on_run = on_run
 
-            dbs = test_case.server_manager.db_session_type()
-            dbs.add(User(name='john', password='best123'))
-            dbs.add(User(name='lazy', password=''))
-            dbs.flush()
+            with test_case.server_manager.repository.unit_of_work() as unit:
+                unit.add_user('john', 'best123')
+                unit.add_user('lazy', '')
             test_case.server_manager.run()
 
         self.server_thread = Thread(target=server_thread, args=(self,))
         self.server_thread.start()
 
         while not self.server_started:
-            sleep(milliseconds(10))
-        sleep(milliseconds(100))
+            sleep(0.01)
+        sleep(0.1)
 
     def tearDown(self):
         self.server_manager.stop()
@@ -50,6 +48,19 @@ class UserTests(TestCase):
         self.assertEqual(user.name.result, 'john')
         session.sign_out()
 
+    def test_user_prefetch_names(self):
+        """
+        Gets names of many users (including a not existing one) with one query.
+        """
+        session = make_session('localhost', self.port).result
+        session.sign_in('john', 'best123').result
+        users = session.prefetch_users([1, 2, 1000]).result
+        self.assertEqual([u.id for u in users], [1, 2, 1000])
+        self.assertEqual(users[0]._name, 'john')
+        self.assertEqual(users[1]._name, 'lazy')
+        self.assertIsNone(users[2]._name)
+        session.sign_out()
+
     def test_user_get_status(self):
         """
         Check if signed in user has status 'connected'
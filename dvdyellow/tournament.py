@@ -0,0 +1,323 @@
+"""
+Tournament of bot strategies played locally (without server) to compare their strength and speed.
+
+Every pair of strategies plays on every board with every pawn, each strategy being once the first
+and once the second player on the same point board. Games are spread over processes, e.g.:
+    python -m dvdyellow.tournament greedy alphabeta:0.2 mcts:0.2 --rounds 10 --processes 4
+"""
+import argparse
+import math
+import multiprocessing
+import random
+from functools import partial
+from itertools import combinations
+from time import perf_counter
+
+import dvdyellow.game as g
+from .ai import _make_strategy
+from .rules import rules_for
+from .search import EvaluationCache
+
+# name -> (width, height, shapestring), shapestrings are row by row like in the database
+PAWNS = {
+    'default': (2, 3, "101110"),
+    'domino': (1, 2, "11"),
+    'corner': (2, 2, "1011"),
+    'line': (1, 3, "111"),
+    't': (3, 2, "111010"),
+}
+
+BOARDS = {
+    'default': (6, 8, "1" * 48),
+    'small': (5, 5, "1" * 25),
+    'ring': (6, 6, "111111" + "111111" + "110011" + "110011" + "111111" + "111111"),
+    'big': (15, 15, "00" + "1" * (15 * 15 - 4) + "00"),
+}
+
+
+def _shape_to_table(width, height, shapestring):
+    """
+    Converts shape from the database format to list of columns.
+    :param width: Width of the shape.
+    :param height: Height of the shape.
+    :param shapestring: Fields of the shape (row by row, '1' for existing field).
+    :return: List of columns (1 for existing field, 0 otherwise).
+    """
+    return [[1 if shapestring[y * width + x] == '1' else 0 for y in range(height)] for x in range(width)]
+
+
+def make_boards(board, pawn, generator):
+    """
+    Creates boards of a new game the same way as the server does.
+    :param board: Board from the catalogue (width, height, shapestring).
+    :param pawn: Pawn data (list of columns).
+    :param generator: Random number generator (random.Random object).
+    :return: Tuple (point board, move board) - fields which cannot be covered have 0 points and -3 in move board.
+    """
+    shape = _shape_to_table(*board)
+    rules = rules_for(pawn, board[0], board[1])
+    missing = rules.board_to_mask([[1 - v for v in column] for column in shape])
+    unusable = rules.mask_to_board(missing | rules.blocked(missing))
+    point_board = [[0 if unusable[x][y] else generator.randint(1, 9) for y in range(board[1])]
+                   for x in range(board[0])]
+    move_board = [[-3 if unusable[x][y] else 0 for y in range(board[1])] for x in range(board[0])]
+    return point_board, move_board
+
+
+class _LocalGame:
+    """
+    State of the game seen by a strategy (has the same attributes as game.Game used by strategies).
+    """
+    def __init__(self, gid, pawn, point_board, move_board):
+        self.gid = gid
+        self.pawn = pawn
+        self.width = len(point_board)
+        self.height = len(point_board[0])
+        self.point_board = point_board
+        self.move_board = move_board
+        self.player_number = 1
+        self.player_points = [0, 0]
+
+
+def play_game(task):
+    """
+    Plays one game between two strategies.
+    :param task: Tuple (game ID, (factory of the first strategy, factory of the second one), board name,
+        pawn name, seed of the point board). Factories are called with evaluation cache as cache argument.
+    :return: Dictionary with 'points' of the players, 'winner' (0 if draw), 'forfeit' (number of the player
+        who made illegal move or None) and 'times' (list of think times of each player, in seconds).
+    """
+    gid, factories, board_name, pawn_name, seed = task
+    pawn_data = _shape_to_table(*PAWNS[pawn_name])
+    point_board, move_board = make_boards(BOARDS[board_name], pawn_data, random.Random(seed))
+    game = _LocalGame(gid, g.Pawn(None, pawn_data), point_board, move_board)
+    rules = rules_for(pawn_data, game.width, game.height)
+    values = rules.point_values(point_board)
+    occupied = rules.board_to_mask(move_board)
+
+    # every strategy gets a new evaluation cache, so its think times do not depend on moves evaluated
+    # by the opponent or in earlier games
+    strategies = [factory(cache=EvaluationCache()) for factory in factories]
+    times = [[], []]
+    forfeit = None
+    try:
+        while True:
+            legal = {m[3] for m in rules.legal_moves(occupied)}
+            if not legal:
+                break
+            player = game.player_number
+            start = perf_counter()
+            move = strategies[player - 1].choose_move(game)
+            times[player - 1].append(perf_counter() - start)
+
+            mask = None
+            if move is not None:
+                x, y, rotation = move
+                pawn = g.TransformablePawn(game.pawn, rotation)
+                if 0 <= x <= game.width - pawn.width and 0 <= y <= game.height - pawn.height:
+                    mask = rules.move_mask(pawn, (x, y))
+            if mask not in legal:
+                forfeit = player
+                break
+
+            blocked = rules.blocked_by_moves(occupied, [mask])[0]
+            occupied |= mask | blocked
+            game.player_points[player - 1] += rules.sum_points(blocked, values)
+            for bit in range(game.width * game.height):
+                if (mask >> bit) & 1:
+                    x, y = rules.field(bit)
+                    move_board[x][y] = player
+                elif (blocked >> bit) & 1:
+                    x, y = rules.field(bit)
+                    move_board[x][y] = -player
+            strategies[player - 1].move_done(game)
+            game.player_number = 3 - player
+    finally:
+        for strategy in strategies:
+            strategy.game_finished(game)
+            strategy.close()
+
+    points = game.player_points
+    if forfeit:
+        winner = 3 - forfeit
+    else:
+        winner = 0 if points[0] == points[1] else (1 if points[0] > points[1] else 2)
+    return {'points': list(points), 'winner': winner, 'forfeit': forfeit, 'times': times}
+
+
+def wilson_interval(score, n, z=1.96):
+    """
+    Computes Wilson score interval of the win rate.
+    :param score: Number of won games (draws count as half of the win).
+    :param n: Number of games.
+    :param z: Quantile of the normal distribution (1.96 for 95% confidence).
+    :return: Tuple (lower bound, upper bound).
+    """
+    if n == 0:
+        return 0., 1.
+    p = score / n
+    denominator = 1 + z * z / n
+    center = (p + z * z / (2 * n)) / denominator
+    margin = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / denominator
+    return max(0., center - margin), min(1., center + margin)
+
+
+def percentile(values, p):
+    """
+    Computes percentile using the nearest-rank method.
+    :param values: Sorted list of values.
+    :param p: Percentile (from 0 to 100).
+    :return: The percentile (or 0 for empty list).
+    """
+    if not values:
+        return 0.
+    return values[max(0, math.ceil(p / 100. * len(values)) - 1)]
+
+
+class StrategyStats:
+    """
+    Results of a strategy in the tournament.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.wins = 0
+        self.draws = 0
+        self.losses = 0
+        self.forfeits = 0
+        self.times = []     # think times of all moves (in seconds)
+
+    @property
+    def games(self):
+        return self.wins + self.draws + self.losses
+
+    @property
+    def score(self):
+        """
+        Win rate (draws count as half of the win).
+        """
+        return (self.wins + 0.5 * self.draws) / self.games if self.games else 0.
+
+    @property
+    def interval(self):
+        """
+        95% confidence interval of the win rate.
+        """
+        return wilson_interval(self.wins + 0.5 * self.draws, self.games)
+
+    @property
+    def moves_per_second(self):
+        total = sum(self.times)
+        return len(self.times) / total if total else 0.
+
+    def add(self, result, player):
+        """
+        Adds result of a game.
+        :param result: Result returned by play_game.
+        :param player: Number of the player played by the strategy.
+        """
+        if result['winner'] == 0:
+            self.draws += 1
+        elif result['winner'] == player:
+            self.wins += 1
+        else:
+            self.losses += 1
+        if result['forfeit'] == player:
+            self.forfeits += 1
+        self.times.extend(result['times'][player - 1])
+
+
+def run_tournament(strategies, boards, pawns, rounds=1, processes=1, seed=0):
+    """
+    Plays every pair of strategies on every board with every pawn.
+    :param strategies: Dictionary name -> function creating strategy with given evaluation cache (cache argument,
+        picklable if processes > 1).
+    :param boards: Names of boards from BOARDS.
+    :param pawns: Names of pawns from PAWNS.
+    :param rounds: Number of point boards for every pair, board and pawn (each is played twice - with both
+        strategies starting).
+    :param processes: Number of processes playing games (1 to play in this process).
+    :param seed: Seed of point boards.
+    :return: Dictionary name -> StrategyStats.
+    """
+    tasks = []
+    players = []
+    for first, second in combinations(sorted(strategies), 2):
+        for board in boards:
+            for pawn in pawns:
+                for _ in range(rounds):
+                    seed += 1
+                    for pair in ((first, second), (second, first)):
+                        tasks.append((len(tasks) + 1, (strategies[pair[0]], strategies[pair[1]]), board, pawn, seed))
+                        players.append(pair)
+
+    stats = {name: StrategyStats(name) for name in strategies}
+    if processes > 1:
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.map(play_game, tasks, chunksize=1)
+    else:
+        results = map(play_game, tasks)
+    for pair, result in zip(players, results):
+        for player, name in enumerate(pair, 1):
+            stats[name].add(result, player)
+    return stats
+
+
+def _parse_strategy(spec, time_budget, iterations, endgame):
+    """
+    Creates factory of strategy described as name[:seconds per move].
+    """
+    name, _, seconds = spec.partition(':')
+    if name not in ('greedy', 'alphabeta', 'mcts'):
+        raise argparse.ArgumentTypeError("Unknown strategy '{}'".format(name))
+    return partial(_make_strategy, name, float(seconds) if seconds else time_budget,
+                   None if seconds else iterations, 1, endgame, False)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="DVD Yellow Project tournament of bots")
+    arg_parser.add_argument('strategies', metavar='strategy', nargs='+',
+                            help="Strategy (greedy, alphabeta or mcts) with optional time for a move, "
+                                 "e.g. alphabeta:0.5")
+    arg_parser.add_argument('--board', metavar='name', dest='boards', nargs='+', default=['default', 'small'],
+                            choices=sorted(BOARDS), help="Boards to play on")
+    arg_parser.add_argument('--pawn', metavar='name', dest='pawns', nargs='+', default=['default', 'corner'],
+                            choices=sorted(PAWNS), help="Pawns to play with")
+    arg_parser.add_argument('--rounds', metavar='n', dest='rounds', type=int, default=5,
+                            help="Number of point boards for every pair of strategies, board and pawn")
+    arg_parser.add_argument('--processes', metavar='n', dest='processes', type=int,
+                            default=multiprocessing.cpu_count(), help="Number of processes playing games")
+    arg_parser.add_argument('--time', metavar='seconds', dest='time', type=float, default=0.2,
+                            help="Default time for a move")
+    arg_parser.add_argument('--iterations', metavar='n', dest='iterations', type=int, default=None,
+                            help="Number of iterations for a move (for mcts strategy without time given)")
+    arg_parser.add_argument('--endgame', metavar='n', dest='endgame', type=int, default=None,
+                            help="Number of free fields from which the game is solved exactly (0 to turn off)")
+    arg_parser.add_argument('--seed', metavar='n', dest='seed', type=int, default=0,
+                            help="Seed of point boards")
+    args = arg_parser.parse_args()
+
+    if len(set(args.strategies)) < 2:
+        arg_parser.error("at least two different strategies are needed")
+    try:
+        strategies = {spec: _parse_strategy(spec, args.time, args.iterations, args.endgame)
+                      for spec in args.strategies}
+    except (argparse.ArgumentTypeError, ValueError) as e:
+        arg_parser.error(str(e))
+
+    stats = run_tournament(strategies, args.boards, args.pawns, args.rounds, args.processes, args.seed)
+
+    print('{:<20}{:>7}{:>6}{:>6}{:>6}{:>8}{:>16}{:>10}{:>9}{:>9}{:>9}'.format(
+        'strategy', 'games', 'won', 'draw', 'lost', 'score', '95% interval', 'moves/s', 'p50 ms', 'p90 ms', 'p99 ms'))
+    for s in sorted(stats.values(), key=lambda s: s.score, reverse=True):
+        times = sorted(s.times)
+        low, high = s.interval
+        print('{:<20}{:>7}{:>6}{:>6}{:>6}{:>8.3f}{:>16}{:>10.1f}{:>9.1f}{:>9.1f}{:>9.1f}'.format(
+            s.name, s.games, s.wins, s.draws, s.losses, s.score, '{:.3f}-{:.3f}'.format(low, high),
+            s.moves_per_second, 1000 * percentile(times, 50), 1000 * percentile(times, 90),
+            1000 * percentile(times, 99)))
+        if s.forfeits:
+            print('  {} games lost by illegal moves'.format(s.forfeits))
+
+
+if __name__ == '__main__':
+    main()
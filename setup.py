@@ -38,5 +38,7 @@ setup(
     },
     test_suite='tests.load_tests',
 
-    install_requires=['appdirs', 'sqlalchemy', 'pyyaml']
+    install_requires=['appdirs', 'sqlalchemy', 'pyyaml'],
+    # only the graphical client needs SFML
+    extras_require={'gui': ['pySFML']}
 )